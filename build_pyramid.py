@@ -0,0 +1,165 @@
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+SOURCE_DATASET = "Dataset001_MSLesSeg"
+
+# factor de submuestreo -> dataset hermano en nnUNet_raw
+LEVELS = {
+    2: "Dataset012_MSLesSeg2x",
+    4: "Dataset014_MSLesSeg4x",
+}
+NUM_WORKERS = 4
+# ============================
+
+
+def block_factors(shape, factor):
+    """Factor por eje: los ejes de tamaño 1 (slices 2D guardadas como (X, Y, 1)) no se reducen."""
+    return tuple(factor if n > 1 else 1 for n in shape)
+
+
+def block_reduce(array, factors, reducer, pad_mode):
+    """
+    Reduce bloques factors[0] x factors[1] x ... con reducer (np.mean / np.max)
+    de forma vectorizada: se rellena hasta múltiplo del factor y se hace
+    reshape a (n0, f0, n1, f1, ...) para reducir los ejes impares.
+    """
+    pad = [(0, (-n) % f) for n, f in zip(array.shape, factors)]
+    if any(p for _, p in pad):
+        array = np.pad(array, pad, mode=pad_mode)
+    shape = []
+    for n, f in zip(array.shape, factors):
+        shape += [n // f, f]
+    return reducer(array.reshape(shape), axis=tuple(range(1, 2 * array.ndim, 2)))
+
+
+def downsample_image(data, factors):
+    """Media por área; el relleno replica el borde para no oscurecer el último bloque."""
+    return block_reduce(data, factors, np.mean, "edge").astype(np.float32)
+
+
+def downsample_label(data, factors):
+    """Max-pooling: una lesión de un solo vóxel sigue presente en el nivel reducido."""
+    return block_reduce(data, factors, np.max, "constant")
+
+
+def downsample_affine(affine, factors):
+    """
+    Affine del volumen reducido: cada columna se escala por su factor y el
+    origen pasa al centro del primer bloque (índice (f-1)/2 del volumen original).
+    """
+    factors = np.asarray(factors, dtype=np.float64)
+    new = affine.copy()
+    new[:3, :3] = affine[:3, :3] * factors
+    new[:3, 3] = affine[:3, 3] + affine[:3, :3] @ ((factors - 1) / 2)
+    return new
+
+
+def process_case(args):
+    """
+    Genera todos los niveles de un caso con una sola decodificación: cada
+    nivel se obtiene del anterior (4x = 2x de 2x), así que el coste lo marca
+    el primer nivel.
+    """
+    channel_paths, label_path, out_names, factors = args
+    level_factors = sorted(factors)
+
+    for kind, paths in (("image", channel_paths), ("label", [label_path] if label_path else [])):
+        for path in paths:
+            img = nib.load(str(path))
+            if kind == "image":
+                data = img.get_fdata(dtype=np.float32)
+            else:
+                data = np.asanyarray(img.dataobj).astype(np.uint8)
+            affine = img.affine
+            current = 1
+            for factor in level_factors:
+                step = block_factors(data.shape, factor // current)
+                data = downsample_image(data, step) if kind == "image" else downsample_label(data, step)
+                affine = downsample_affine(affine, step)
+                current = factor
+
+                out = nib.Nifti1Image(data, affine)
+                out.set_data_dtype(np.float32 if kind == "image" else np.uint8)
+                out.header.set_xyzt_units(*img.header.get_xyzt_units())
+                nib.save(out, str(out_names[factor][str(path)]))
+    return len(channel_paths)
+
+
+def pyramid_jobs(source_root, dataset_json, targets):
+    """Un trabajo por caso con las rutas de salida de cada nivel."""
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    channel_keys = sorted(dataset_json["channel_names"].keys(), key=lambda x: int(x))
+
+    entries = [(item["image"], item["label"]) for item in dataset_json["training"]]
+    for entry in dataset_json.get("test", []):
+        if isinstance(entry, dict):
+            entries.append((entry["image"], entry["label"]))
+        else:
+            # labelsTs no referenciadas en dataset.json (Dataset001)
+            label_ts = f"./labelsTs/{Path(entry).name}{file_ending}"
+            entries.append((entry, label_ts if (source_root / label_ts).exists() else None))
+
+    jobs = []
+    for image, label in entries:
+        image_rel = image.replace("./", "")
+        rels = [f"{image_rel}_{int(k):04d}{file_ending}" for k in channel_keys]
+        channel_paths = [source_root / r for r in rels]
+        label_path = source_root / label.replace("./", "") if label else None
+        if label:
+            rels.append(label.replace("./", ""))
+        sources = channel_paths + ([label_path] if label_path else [])
+        out_names = {
+            factor: {str(src): Path(target_root) / rel for src, rel in zip(sources, rels)}
+            for factor, target_root in targets.items()
+        }
+        jobs.append((channel_paths, label_path, out_names, list(targets)))
+    return jobs
+
+
+def main():
+    source_root = BASE_RAW / SOURCE_DATASET
+    with open(source_root / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+
+    targets = {factor: BASE_RAW / name for factor, name in LEVELS.items()}
+    for target_root in targets.values():
+        for sub in ["imagesTr", "labelsTr", "imagesTs", "labelsTs"]:
+            (target_root / sub).mkdir(parents=True, exist_ok=True)
+
+    jobs = pyramid_jobs(source_root, dataset_json, targets)
+    print(f"Generando niveles {sorted(LEVELS)}x de {len(jobs)} casos de {SOURCE_DATASET}...")
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        for _ in pool.map(process_case, jobs):
+            pass
+
+    # Mismos case_ids en todos los niveles: dataset.json y splits se copian
+    splits_src = BASE_PREPROCESSED / SOURCE_DATASET / "splits_final.json"
+    for factor, target_root in targets.items():
+        with open(target_root / "dataset.json", "w") as f:
+            json.dump(dataset_json, f, indent=4)
+        if splits_src.exists():
+            dst = BASE_PREPROCESSED / LEVELS[factor]
+            dst.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(splits_src, dst / "splits_final.json")
+    if not splits_src.exists():
+        print(f"[AVISO] No existe {splits_src}; los niveles no tendrán splits_final.json.")
+
+    print("\n========================================")
+    for factor, name in sorted(LEVELS.items()):
+        print(f" {factor}x: {BASE_RAW / name}")
+    print(" Imágenes por media de área, máscaras por max-pooling, affines escaladas")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
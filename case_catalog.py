@@ -0,0 +1,339 @@
+import json
+import re
+import sqlite3
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from json_stream import iter_splits
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+
+DATASETS = ["Dataset001_MSLesSeg", "Dataset002_MSLesSeg"]
+CATALOG_PATH = BASE_RAW / "case_catalog.sqlite"
+
+READ_HEADERS = True  # shape y spacing desde la cabecera del canal 0000 (sin decodificar)
+LABEL_INDEX_FILENAME = "label_index.npz"   # de label_index.py, si existe
+SLICE_INDEX_FILENAME = "slice_index.json"  # de From3D_2D.py, si existe
+SPLITS_FILENAME = "splits_final.json"
+# ============================
+
+# P1_T1 -> (P1, 1, None);  P1_T1_001 -> (P1, 1, 1);  P54 -> (P54, None, None)
+CASE_ID_RE = re.compile(r"^(?P<patient>P\d+)(?:_T(?P<timepoint>\d+))?(?:_(?P<slice>\d{3}))?$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    dataset TEXT NOT NULL,
+    case_id TEXT NOT NULL,
+    base_id TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    timepoint INTEGER,
+    slice_idx INTEGER,
+    z INTEGER,
+    subset TEXT NOT NULL,
+    label_path TEXT,
+    shape TEXT,
+    spacing TEXT,
+    n_lesions INTEGER,
+    lesion_volume_mm3 REAL,
+    PRIMARY KEY (dataset, case_id)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    dataset TEXT NOT NULL,
+    case_id TEXT NOT NULL,
+    channel_idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (dataset, case_id, channel_idx)
+);
+CREATE TABLE IF NOT EXISTS splits (
+    dataset TEXT NOT NULL,
+    fold INTEGER NOT NULL,
+    subset TEXT NOT NULL,
+    case_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cases_patient ON cases (dataset, patient_id);
+CREATE INDEX IF NOT EXISTS idx_cases_base ON cases (dataset, base_id);
+CREATE INDEX IF NOT EXISTS idx_cases_volume ON cases (dataset, lesion_volume_mm3);
+CREATE INDEX IF NOT EXISTS idx_channels_name ON channels (dataset, channel);
+CREATE INDEX IF NOT EXISTS idx_splits_fold ON splits (dataset, fold, subset);
+"""
+
+
+def parse_case_id(case_id):
+    """
+    Separa un identificador de caso en (patient_id, timepoint, slice_idx, base_id).
+    Sustituye a get_patient_id / get_case_id_from_filename / "_".join(parts[:-2]).
+    """
+    m = CASE_ID_RE.match(case_id)
+    if m is None:
+        return case_id.split("_")[0], None, None, case_id
+    timepoint = int(m["timepoint"]) if m["timepoint"] else None
+    slice_idx = int(m["slice"]) if m["slice"] else None
+    base_id = case_id[: -len(m["slice"]) - 1] if slice_idx is not None else case_id
+    return m["patient"], timepoint, slice_idx, base_id
+
+
+def _load_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _dataset_entries(dataset_root, dataset_json):
+    """(case_id, subset, image_rel, label_rel o None) de dataset.json."""
+    for item in dataset_json["training"]:
+        yield Path(item["image"]).name, "Tr", item["image"].replace("./", ""), item["label"].replace("./", "")
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    for entry in dataset_json.get("test", []):
+        if isinstance(entry, dict):
+            yield Path(entry["image"]).name, "Ts", entry["image"].replace("./", ""), entry["label"].replace("./", "")
+        else:
+            case_id = Path(entry).name
+            label_rel = f"labelsTs/{case_id}{file_ending}"
+            exists = (Path(dataset_root) / label_rel).exists()
+            yield case_id, "Ts", entry.replace("./", ""), label_rel if exists else None
+
+
+def _lesion_index(dataset_root, raw_root):
+    """
+    Índice de lesiones (label_index.npz de label_index.py) del dataset.
+    Para datasets 2D sin índice propio se usa el de su dataset 3D de origen.
+    Devuelve (LabelIndex o None, True si es el índice 3D de origen).
+    """
+    candidates = [(Path(dataset_root) / LABEL_INDEX_FILENAME, False)]
+    slice_index_path = Path(dataset_root) / SLICE_INDEX_FILENAME
+    if slice_index_path.exists():
+        source = _load_json(slice_index_path)["source_dataset"]
+        candidates.append((Path(raw_root) / source / LABEL_INDEX_FILENAME, True))
+
+    for path, from_source in candidates:
+        if path.exists():
+            from label_index import LabelIndex
+
+            return LabelIndex.load(path), from_source
+    return None, False
+
+
+def _lesion_stats(index, from_source, case_id, base_id, z):
+    """
+    (n_lesions, volume_mm3) de un caso, o (None, None) si no está indexado.
+    Con el índice 3D de origen, una slice 2D toma las estadísticas de su z:
+    lesiones 3D que cortan la slice y vóxeles de lesión de la slice por el
+    volumen del vóxel.
+    """
+    if index is None or (from_source and z is None):
+        return None, None
+    try:
+        case = index.case(base_id if from_source else case_id)
+    except KeyError:
+        return None, None
+    if not from_source:
+        return case["n_lesions"], case["volume_mm3"]
+    per_slice = index.slices(base_id)
+    voxel_mm3 = float(np.prod(case["spacing"]))
+    return int(per_slice["lesions"][z]), float(per_slice["voxels"][z]) * voxel_mm3
+
+
+def build_catalog(catalog_path, datasets, raw_root=BASE_RAW, preprocessed_root=BASE_PREPROCESSED,
+                  read_headers=READ_HEADERS):
+    """
+    (Re)construye el catálogo SQLite de los datasets indicados. Cada dataset se
+    reemplaza entero dentro de una transacción.
+    """
+    conn = sqlite3.connect(str(catalog_path))
+    conn.executescript(SCHEMA)
+
+    for dataset in datasets:
+        dataset_root = Path(raw_root) / dataset
+        if not (dataset_root / "dataset.json").exists():
+            print(f"[AVISO] No existe {dataset_root / 'dataset.json'}, se omite {dataset}.")
+            continue
+
+        dataset_json = _load_json(dataset_root / "dataset.json")
+        file_ending = dataset_json.get("file_ending", ".nii.gz")
+        channel_names = {int(k): v for k, v in dataset_json["channel_names"].items()}
+
+        slice_index_path = dataset_root / SLICE_INDEX_FILENAME
+        slice_z = {}
+        if slice_index_path.exists():
+            for base_id, info in _load_json(slice_index_path)["cases"].items():
+                for pos, z in enumerate(info["slices"]):
+                    slice_z[f"{base_id}_{pos + 1:03d}"] = z
+        lesion_index, from_source = _lesion_index(dataset_root, raw_root)
+
+        case_rows, channel_rows = [], []
+        for case_id, subset, image_rel, label_rel in _dataset_entries(dataset_root, dataset_json):
+            patient_id, timepoint, slice_idx, base_id = parse_case_id(case_id)
+            channel_paths = {
+                idx: str(dataset_root / f"{image_rel}_{idx:04d}{file_ending}") for idx in channel_names
+            }
+
+            shape = spacing = None
+            if read_headers and Path(channel_paths[0]).exists():
+                header = nib.load(channel_paths[0]).header
+                shape = json.dumps([int(s) for s in header.get_data_shape()])
+                spacing = json.dumps([float(z) for z in header.get_zooms()])
+
+            n_lesions, lesion_volume = _lesion_stats(lesion_index, from_source, case_id, base_id, slice_z.get(case_id))
+            case_rows.append((
+                dataset, case_id, base_id, patient_id, timepoint, slice_idx, slice_z.get(case_id), subset,
+                str(dataset_root / label_rel) if label_rel else None, shape, spacing,
+                n_lesions, lesion_volume,
+            ))
+            channel_rows.extend(
+                (dataset, case_id, idx, channel_names[idx], path) for idx, path in channel_paths.items()
+            )
+
+        split_rows = []
+        splits_path = Path(preprocessed_root) / dataset / SPLITS_FILENAME
+        if splits_path.exists():
+            for fold, split in enumerate(iter_splits(splits_path)):
+                for subset in ("train", "val"):
+                    split_rows.extend((dataset, fold, subset, c) for c in split[subset])
+
+        with conn:
+            for table in ("cases", "channels", "splits"):
+                conn.execute(f"DELETE FROM {table} WHERE dataset = ?", (dataset,))
+            conn.executemany(f"INSERT INTO cases VALUES ({','.join('?' * 13)})", case_rows)
+            conn.executemany("INSERT INTO channels VALUES (?, ?, ?, ?, ?)", channel_rows)
+            conn.executemany("INSERT INTO splits VALUES (?, ?, ?, ?)", split_rows)
+
+        print(f"  {dataset}: {len(case_rows)} casos, {len(split_rows)} entradas de splits")
+
+    conn.close()
+
+
+class CaseCatalog:
+    """
+    API de consulta sobre el catálogo. Ejemplos:
+      cat = CaseCatalog()
+      cat.channel_paths("FLAIR", fold=2, subset="val")
+      cat.cases(min_lesion_volume=1000)
+      cat.slices_by_base("Dataset002_MSLesSeg", subset="Tr")
+    """
+
+    def __init__(self, catalog_path=CATALOG_PATH, dataset="Dataset001_MSLesSeg"):
+        self.conn = sqlite3.connect(str(catalog_path))
+        self.conn.row_factory = sqlite3.Row
+        self.dataset = dataset
+
+    def close(self):
+        self.conn.close()
+
+    def _split_filter(self, fold, subset):
+        if fold is None:
+            return "", []
+        sql = " AND c.case_id IN (SELECT case_id FROM splits WHERE dataset = c.dataset AND fold = ?"
+        params = [fold]
+        if subset is not None:
+            sql += " AND subset = ?"
+            params.append(subset)
+        return sql + ")", params
+
+    def cases(self, fold=None, subset=None, patient_id=None, min_lesion_volume=None, dataset=None):
+        """
+        case_ids que cumplen los filtros. subset es 'train'/'val' si se da fold,
+        o 'Tr'/'Ts' (imagesTr/imagesTs) si no.
+        """
+        sql = "SELECT c.case_id FROM cases c WHERE c.dataset = ?"
+        params = [dataset or self.dataset]
+        if fold is not None:
+            split_sql, split_params = self._split_filter(fold, subset)
+            sql += split_sql
+            params += split_params
+        elif subset is not None:
+            sql += " AND c.subset = ?"
+            params.append(subset)
+        if patient_id is not None:
+            sql += " AND c.patient_id = ?"
+            params.append(patient_id)
+        if min_lesion_volume is not None:
+            sql += " AND c.lesion_volume_mm3 > ?"
+            params.append(min_lesion_volume)
+        return [r["case_id"] for r in self.conn.execute(sql + " ORDER BY c.case_id", params)]
+
+    def channel_paths(self, channel, fold=None, subset=None, dataset=None):
+        """Rutas del canal (nombre, p.ej. 'FLAIR') para los casos del fold/subset."""
+        sql = (
+            "SELECT ch.path FROM channels ch JOIN cases c "
+            "ON c.dataset = ch.dataset AND c.case_id = ch.case_id "
+            "WHERE ch.dataset = ? AND ch.channel = ?"
+        )
+        params = [dataset or self.dataset, channel]
+        if fold is not None:
+            split_sql, split_params = self._split_filter(fold, subset)
+            sql += split_sql
+            params += split_params
+        elif subset is not None:
+            sql += " AND c.subset = ?"
+            params.append(subset)
+        return [r["path"] for r in self.conn.execute(sql + " ORDER BY ch.case_id", params)]
+
+    def case(self, case_id, dataset=None):
+        row = self.conn.execute(
+            "SELECT * FROM cases WHERE dataset = ? AND case_id = ?", (dataset or self.dataset, case_id)
+        ).fetchone()
+        if row is None:
+            raise KeyError(case_id)
+        out = dict(row)
+        for key in ("shape", "spacing"):
+            out[key] = json.loads(out[key]) if out[key] else None
+        return out
+
+    def patients(self, dataset=None):
+        """patient_id -> [case_ids] ordenados (timepoints o slices)."""
+        out = {}
+        rows = self.conn.execute(
+            "SELECT patient_id, case_id FROM cases WHERE dataset = ? ORDER BY patient_id, case_id",
+            (dataset or self.dataset,),
+        )
+        for r in rows:
+            out.setdefault(r["patient_id"], []).append(r["case_id"])
+        return out
+
+    def records(self, dataset=None, subset=None):
+        """Filas (case_id, base_id, patient_id, timepoint, slice_idx, subset, label_path) ordenadas por case_id."""
+        sql = (
+            "SELECT case_id, base_id, patient_id, timepoint, slice_idx, subset, label_path "
+            "FROM cases WHERE dataset = ?"
+        )
+        params = [dataset or self.dataset]
+        if subset is not None:
+            sql += " AND subset = ?"
+            params.append(subset)
+        return self.conn.execute(sql + " ORDER BY case_id", params).fetchall()
+
+    def slices_by_base(self, dataset=None, subset=None):
+        """base_id -> [case_ids de slice] (mapping de create_splits_dataset2)."""
+        sql = "SELECT base_id, case_id FROM cases WHERE dataset = ? AND slice_idx IS NOT NULL"
+        params = [dataset or self.dataset]
+        if subset is not None:
+            sql += " AND subset = ?"
+            params.append(subset)
+        out = {}
+        for r in self.conn.execute(sql + " ORDER BY base_id, case_id", params):
+            out.setdefault(r["base_id"], []).append(r["case_id"])
+        return out
+
+
+def main():
+    print(f"Construyendo catálogo de casos en {CATALOG_PATH}...")
+    build_catalog(CATALOG_PATH, DATASETS)
+
+    catalog = CaseCatalog(CATALOG_PATH)
+    n_patients = len(catalog.patients())
+    catalog.close()
+
+    print("\n========================================")
+    print(f" Catálogo guardado en: {CATALOG_PATH}")
+    print(f" Pacientes en {DATASETS[0]}: {n_patients}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from case_catalog import parse_case_id
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+DATASET = "Dataset002_MSLesSeg"
+# ============================
+
+SUBSETS = ("Tr", "Ts")
+NO_VALUE = -1  # timepoint / slice ausente (p.ej. casos 3D no tienen slice)
+
+
+class CaseRecord:
+    """Vista de una fila de CaseTable (sin copiar las columnas)."""
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def case_id(self):
+        return self.table.case_id(self.row)
+
+    @property
+    def base_id(self):
+        return self.table.base_id(self.row)
+
+    @property
+    def patient_id(self):
+        return self.table.patients[self.table.patient[self.row]]
+
+    @property
+    def timepoint(self):
+        tp = int(self.table.timepoint[self.row])
+        return None if tp == NO_VALUE else tp
+
+    @property
+    def slice_idx(self):
+        sl = int(self.table.slice[self.row])
+        return None if sl == NO_VALUE else sl
+
+    @property
+    def subset(self):
+        return SUBSETS[self.table.subset[self.row]]
+
+    @property
+    def has_label(self):
+        return bool(self.table.has_label[self.row])
+
+    def __repr__(self):
+        return f"CaseRecord({self.case_id!r}, subset={self.subset!r})"
+
+
+class CaseTable:
+    """
+    Casos de un dataset como columnas numpy (struct-of-arrays) en lugar de
+    dicts por caso:
+      ids       list   case_id originales (P1_T1_001), internados
+      base      int32  -> índice en self.bases (base_id internados, 'P1_T1', ...)
+      patient   int32  -> índice en self.patients (ids internados, 'P1', 'P2', ...)
+      timepoint int16  (NO_VALUE si no hay)
+      slice     int16  (NO_VALUE en casos 3D)
+      subset    int8   -> SUBSETS
+      has_label bool
+    Los ids se guardan tal cual: no se reconstruyen a partir de los códigos.
+    """
+
+    def __init__(self, ids, bases, base, patients, patient, timepoint, slice_, subset, has_label):
+        self.ids = [sys.intern(c) for c in ids]
+        self.bases = [sys.intern(b) for b in bases]
+        self.base_index = {b: i for i, b in enumerate(self.bases)}
+        self.base = np.asarray(base, dtype=np.int32)
+        self.patients = [sys.intern(p) for p in patients]
+        self.patient_index = {p: i for i, p in enumerate(self.patients)}
+        self.patient = np.asarray(patient, dtype=np.int32)
+        self.timepoint = np.asarray(timepoint, dtype=np.int16)
+        self.slice = np.asarray(slice_, dtype=np.int16)
+        self.subset = np.asarray(subset, dtype=np.int8)
+        self.has_label = np.asarray(has_label, dtype=bool)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        return CaseRecord(self, row)
+
+    def __iter__(self):
+        return (CaseRecord(self, i) for i in range(len(self)))
+
+    # ---------- construcción ----------
+
+    @classmethod
+    def from_case_ids(cls, case_ids, subsets, has_label):
+        bases, base_index = [], {}
+        patients, patient_index = [], {}
+        n = len(case_ids)
+        base = np.empty(n, dtype=np.int32)
+        patient = np.empty(n, dtype=np.int32)
+        timepoint = np.full(n, NO_VALUE, dtype=np.int16)
+        slice_ = np.full(n, NO_VALUE, dtype=np.int16)
+
+        for i, case_id in enumerate(case_ids):
+            patient_id, tp, sl, base_id = parse_case_id(case_id)
+            if base_id not in base_index:
+                base_index[base_id] = len(bases)
+                bases.append(base_id)
+            if patient_id not in patient_index:
+                patient_index[patient_id] = len(patients)
+                patients.append(patient_id)
+            base[i] = base_index[base_id]
+            patient[i] = patient_index[patient_id]
+            if tp is not None:
+                timepoint[i] = tp
+            if sl is not None:
+                slice_[i] = sl
+
+        subset = np.array([SUBSETS.index(s) for s in subsets], dtype=np.int8)
+        return cls(case_ids, bases, base, patients, patient, timepoint, slice_, subset, has_label)
+
+    @classmethod
+    def from_catalog(cls, catalog, dataset=None, subset=None):
+        """Tabla a partir del catálogo SQLite (case_catalog.CaseCatalog), sin leer dataset.json."""
+        rows = catalog.records(dataset=dataset, subset=subset)
+        return cls.from_case_ids(
+            [r["case_id"] for r in rows], [r["subset"] for r in rows], [r["label_path"] is not None for r in rows]
+        )
+
+    @classmethod
+    def from_dataset_json(cls, dataset_json):
+        case_ids, subsets, has_label = [], [], []
+        for item in dataset_json["training"]:
+            case_ids.append(Path(item["image"]).name)
+            subsets.append("Tr")
+            has_label.append(True)
+        for entry in dataset_json.get("test", []):
+            image = entry["image"] if isinstance(entry, dict) else entry
+            case_ids.append(Path(image).name)
+            subsets.append("Ts")
+            has_label.append(isinstance(entry, dict))
+        return cls.from_case_ids(case_ids, subsets, has_label)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(
+                npz["ids"].tolist(), npz["bases"].tolist(), npz["base"], npz["patients"].tolist(),
+                npz["patient"], npz["timepoint"], npz["slice"], npz["subset"], npz["has_label"],
+            )
+
+    def save(self, path):
+        np.savez_compressed(
+            path, ids=np.array(self.ids), bases=np.array(self.bases), base=self.base,
+            patients=np.array(self.patients), patient=self.patient, timepoint=self.timepoint,
+            slice=self.slice, subset=self.subset, has_label=self.has_label,
+        )
+
+    # ---------- ids ----------
+
+    def base_id(self, row):
+        return self.bases[self.base[row]]
+
+    def case_id(self, row):
+        return self.ids[row]
+
+    def case_ids(self, rows=None):
+        if rows is None:
+            return list(self.ids)
+        return [self.ids[int(r)] for r in rows]
+
+    def encode_base_ids(self, base_ids):
+        """base_ids ('P11_T1') -> índices en self.bases; -1 si el caso base no existe."""
+        return np.array([self.base_index.get(b, -1) for b in base_ids], dtype=np.int64)
+
+    def rows(self, subset=None, patient_id=None):
+        mask = np.ones(len(self), dtype=bool)
+        if subset is not None:
+            mask &= self.subset == SUBSETS.index(subset)
+        if patient_id is not None:
+            mask &= self.patient == self.patient_index.get(patient_id, -1)
+        return np.flatnonzero(mask)
+
+    # ---------- splits ----------
+
+    def expand_splits(self, base_splits, subset="Tr"):
+        """
+        Expande splits de casos base (Dataset001) a filas de esta tabla
+        (todas las slices de cada caso base), sin dicts intermedios:
+        se ordenan las filas por (base, slice) una vez y cada fold se resuelve
+        con searchsorted. Devuelve [{"train": filas, "val": filas}, ...].
+        """
+        rows = self.rows(subset=subset)
+        order = rows[np.lexsort((self.slice[rows], self.base[rows]))]
+        sorted_base = self.base[order]
+
+        out = []
+        for fold_idx, fold in enumerate(base_splits):
+            new_fold = {}
+            for key in ("train", "val"):
+                codes = self.encode_base_ids(fold[key])
+                lo = np.searchsorted(sorted_base, codes, side="left")
+                hi = np.searchsorted(sorted_base, codes, side="right")
+                lengths = hi - lo
+                missing = [b for b, n in zip(fold[key], lengths) if n == 0]
+                if missing:
+                    print(f"[AVISO] Fold {fold_idx}: {len(missing)} casos sin slices (p.ej. {missing[0]})")
+                offsets = np.cumsum(lengths) - lengths
+                within = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+                new_fold[key] = order[np.repeat(lo, lengths) + within]
+            out.append(new_fold)
+        return out
+
+    def splits_to_json(self, splits_rows):
+        """Filas por fold -> formato splits_final.json (listas de case_ids)."""
+        return [{key: self.case_ids(fold[key]) for key in ("train", "val")} for fold in splits_rows]
+
+    # ---------- dataset.json ----------
+
+    def dataset_json_entries(self, file_ending):
+        """Listas 'training' y 'test' de dataset.json en el mismo formato que From3D_2D.py."""
+        training, test = [], []
+        for row in range(len(self)):
+            case_id = self.case_id(row)
+            subset = SUBSETS[self.subset[row]]
+            if self.has_label[row]:
+                entry = {
+                    "image": f"./images{subset}/{case_id}",
+                    "label": f"./labels{subset}/{case_id}{file_ending}",
+                }
+            else:
+                entry = f"./images{subset}/{case_id}"
+            (training if subset == "Tr" else test).append(entry)
+        return training, test
+
+
+def main():
+    dataset_root = BASE_RAW / DATASET
+    with open(dataset_root / "dataset.json", "r") as f:
+        table = CaseTable.from_dataset_json(json.load(f))
+
+    out_path = dataset_root / "case_table.npz"
+    table.save(out_path)
+
+    print("\n========================================")
+    print(f" {DATASET}: {len(table)} casos de {len(table.patients)} pacientes")
+    print(f" Tabla de casos guardada en: {out_path}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import copy
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+from scipy import ndimage
+
+import nnunet_compat  # noqa: F401  (shim de GradScaler y trainers del repo, antes de nnunetv2)
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_RESULTS = Path("nnUNet_results")
+
+DATASET = "Dataset001_MSLesSeg"
+CONFIGURATION = "3d_fullres"  # o "2d"
+TRAINER = "nnUNetTrainer"
+PLANS = "nnUNetPlans"
+FOLDS = (0,)
+CHECKPOINT = "checkpoint_final.pth"
+
+MODEL_DIR = BASE_RESULTS / DATASET / f"{TRAINER}__{PLANS}__{CONFIGURATION}"
+OUTPUT_DIR = BASE_RESULTS / DATASET / f"predictions_imagesTs_{CONFIGURATION}"
+
+BATCH_SIZE = 4          # tiles por forward (pueden ser de casos distintos)
+TILE_STEP_SIZE = 0.5    # solape entre tiles, igual que nnU-Net
+USE_MIRRORING = False   # test-time mirroring multiplica el coste por 2^n_ejes
+SAVE_PROBABILITIES = False
+
+EXPORT_THREADS = 2                 # hilos torch del hilo de exportación (remuestreo a la resolución original)
+INTRA_OP_THREADS = max(os.cpu_count() - EXPORT_THREADS, 1)  # hilos de cada operación (convoluciones)
+INTER_OP_THREADS = 1               # hilos entre operaciones independientes
+PREFETCH_CASES = 2                 # casos preprocesados en cola mientras se computa
+
+# Solo configuración 2D: no pasar por la red las slices sin cerebro
+SKIP_EMPTY_SLICES = True
+BACKGROUND_LOGIT = 10.0     # logit de fondo asignado directamente a las slices omitidas
+# ============================
+
+
+def list_test_cases(dataset_root):
+    """
+    Casos de imagesTs listados en dataset.json: [(case_id, [paths de canales])].
+    """
+    dataset_root = Path(dataset_root)
+    with open(dataset_root / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    channel_keys = sorted(dataset_json["channel_names"].keys(), key=lambda x: int(x))
+
+    cases = []
+    for entry in dataset_json["test"]:
+        image_rel = (entry["image"] if isinstance(entry, dict) else entry).replace("./", "")
+        files = [str(dataset_root / f"{image_rel}_{int(k):04d}{file_ending}") for k in channel_keys]
+        cases.append((Path(image_rel).name, files))
+    return cases
+
+
+def gaussian_importance_map(tile_size, sigma_scale=1.0 / 8):
+    """Mapa gaussiano de pesos por tile (mismo criterio que nnU-Net)."""
+    tmp = np.zeros(tile_size, dtype=np.float32)
+    tmp[tuple(s // 2 for s in tile_size)] = 1
+    gaussian = ndimage.gaussian_filter(tmp, [s * sigma_scale for s in tile_size], 0, mode="constant", cval=0)
+    gaussian /= gaussian.max()
+    gaussian[gaussian == 0] = gaussian[gaussian != 0].min()
+    return torch.from_numpy(gaussian)
+
+
+def nonempty_slices(data, tol=1e-6):
+    """
+    Máscara booleana (Z,) de las slices con algún vóxel distinto del fondo,
+    comprobando todos los vóxeles del volumen preprocesado (C, Z, X, Y), sin
+    submuestrear: basta un vóxel (p.ej. una lesión pequeña) para conservar la slice.
+    Las slices fuera del bounding box del cerebro ya las quita nnU-Net al
+    recortar (bbox_used_for_cropping en las propiedades del caso); esto cubre
+    las que quedan vacías dentro del recorte. El valor de fondo de cada canal
+    se toma de la esquina del volumen, así vale tanto si la normalización usa
+    máscara (fondo 0) como si no.
+    """
+    background = data[:, :1, :1, :1]
+    return np.any(np.abs(data - background) > tol, axis=(0, 2, 3))
+
+
+def compute_steps(image_size, tile_size, step_size):
+    """Posiciones de inicio de los tiles en cada eje, cubriendo toda la imagen."""
+    steps = []
+    for dim, tile in zip(image_size, tile_size):
+        n = int(np.ceil((dim - tile) / (tile * step_size))) + 1
+        max_start = dim - tile
+        if n > 1:
+            steps.append([int(np.round(max_start / (n - 1) * i)) for i in range(n)])
+        else:
+            steps.append([0])
+    return steps
+
+
+class CaseState:
+    """
+    Estado de un caso durante la inferencia: datos preprocesados (con padding
+    hasta el tamaño de patch si hace falta), acumuladores de logits/pesos y la
+    lista de tiles pendientes.
+    """
+
+    def __init__(self, case_id, data, properties, patch_size, num_classes, skip_empty=False):
+        self.case_id = case_id
+        self.properties = properties
+        self.is_2d = len(patch_size) == 2 and data.ndim == 4
+        keep_z = nonempty_slices(data) if (self.is_2d and skip_empty) else None
+
+        spatial = data.shape[1:]
+        eff_spatial = spatial[1:] if self.is_2d else spatial
+        pad = [max(p - s, 0) for p, s in zip(patch_size, eff_spatial)]
+        pad_width = [(0, 0)] * (data.ndim - len(pad)) + [(p // 2, p - p // 2) for p in pad]
+        self.unpad = tuple(slice(lo, lo + s) for (lo, _), s in zip(pad_width[1:], spatial))
+
+        data = np.pad(data, pad_width, mode="constant") if any(pad) else data
+        self.data = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+        padded = self.data.shape[1:]
+
+        self.logits = torch.zeros((num_classes, *padded), dtype=torch.float32)
+        self.weights = torch.zeros(padded, dtype=torch.float32)
+
+        if self.is_2d:
+            z_list = range(padded[0]) if keep_z is None else np.flatnonzero(keep_z).tolist()
+            self.skipped_slices = padded[0] - len(z_list)
+            if keep_z is not None:
+                # Las slices omitidas reciben fondo directamente (peso 1)
+                skipped = torch.from_numpy(np.flatnonzero(~keep_z))
+                self.logits[0, skipped] = BACKGROUND_LOGIT
+                self.weights[skipped] = 1.0
+            steps = compute_steps(padded[1:], patch_size, TILE_STEP_SIZE)
+            self.tiles = [
+                (z, *[slice(s, s + p) for s, p in zip(start, patch_size)])
+                for z in z_list
+                for start in itertools.product(*steps)
+            ]
+        else:
+            self.skipped_slices = 0
+            steps = compute_steps(padded, patch_size, TILE_STEP_SIZE)
+            self.tiles = [
+                tuple(slice(s, s + p) for s, p in zip(start, patch_size))
+                for start in itertools.product(*steps)
+            ]
+        self.remaining = len(self.tiles)
+
+    def input_tile(self, tile):
+        return self.data[(slice(None), *tile)]
+
+    def accumulate(self, tile, logits, gaussian):
+        self.logits[(slice(None), *tile)] += logits * gaussian
+        self.weights[tile] += gaussian
+        self.remaining -= 1
+
+    def finalize(self):
+        logits = self.logits / self.weights.clamp_min(1e-8)
+        return logits[(slice(None), *self.unpad)]
+
+
+class CPUInferenceEngine:
+    """
+    Inferencia por ventana deslizante en CPU que agrupa tiles de varios casos
+    en cada batch. El preprocesado (decodificación NIfTI incluida) se hace en un
+    hilo aparte que mantiene PREFETCH_CASES casos listos en cola, y la
+    exportación de cada caso terminado también va en segundo plano.
+    """
+
+    def __init__(self, predictor, batch_size=BATCH_SIZE, use_mirroring=USE_MIRRORING,
+                 skip_empty_slices=SKIP_EMPTY_SLICES):
+        self.predictor = predictor
+        self.skip_empty_slices = skip_empty_slices
+        self.batch_size = batch_size
+        self.patch_size = tuple(predictor.configuration_manager.patch_size)
+        self.num_classes = predictor.label_manager.num_segmentation_heads
+        self.gaussian = gaussian_importance_map(self.patch_size)
+
+        self.mirror_combos = []
+        if use_mirroring and predictor.allowed_mirroring_axes is not None:
+            axes = [a + 2 for a in predictor.allowed_mirroring_axes]
+            self.mirror_combos = [
+                c for i in range(len(axes)) for c in itertools.combinations(axes, i + 1)
+            ]
+
+        # Una red por fold con sus pesos ya cargados: sin load_state_dict en cada batch
+        self.networks = []
+        for i, params in enumerate(predictor.list_of_parameters):
+            network = predictor.network if i == 0 else copy.deepcopy(predictor.network)
+            network.load_state_dict(params)
+            network.eval()
+            self.networks.append(network)
+
+    @staticmethod
+    def _network_forward(network, x):
+        out = network(x)
+        return out[0] if isinstance(out, (list, tuple)) else out
+
+    def _forward(self, network, x):
+        out = self._network_forward(network, x)
+        for axes in self.mirror_combos:
+            out += torch.flip(self._network_forward(network, torch.flip(x, axes)), axes)
+        return out / (len(self.mirror_combos) + 1)
+
+    @torch.inference_mode()
+    def predict_batch(self, x):
+        total = self._forward(self.networks[0], x)
+        for network in self.networks[1:]:
+            total += self._forward(network, x)
+        return total / len(self.networks)
+
+    def _prefetch(self, cases, out_queue):
+        """
+        Hilo productor. Termina siempre poniendo en la cola None (fin) o la
+        excepción que lo interrumpió, que run() relanza: un caso corrupto no
+        puede dejar run() bloqueado esperando en la cola.
+        """
+        end = None
+        try:
+            preprocessor = self.predictor.configuration_manager.preprocessor_class(verbose=False)
+            for case_id, files in cases:
+                data, _, properties = preprocessor.run_case(
+                    files,
+                    None,
+                    self.predictor.plans_manager,
+                    self.predictor.configuration_manager,
+                    self.predictor.dataset_json,
+                )
+                out_queue.put(
+                    CaseState(case_id, data, properties, self.patch_size, self.num_classes, self.skip_empty_slices)
+                )
+        except Exception as exc:
+            end = exc
+        finally:
+            out_queue.put(end)
+
+    def _export(self, case):
+        export_prediction_from_logits(
+            case.finalize(),
+            case.properties,
+            self.predictor.configuration_manager,
+            self.predictor.plans_manager,
+            self.predictor.dataset_json,
+            str(self.output_dir / case.case_id),
+            SAVE_PROBABILITIES,
+            num_threads_torch=EXPORT_THREADS,  # presupuesto propio: no compite con los hilos de la red
+        )
+        return case.case_id
+
+    def run(self, cases, output_dir):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        case_queue = queue.Queue(maxsize=PREFETCH_CASES)
+        producer = threading.Thread(target=self._prefetch, args=(cases, case_queue), daemon=True)
+        producer.start()
+
+        exporter = ThreadPoolExecutor(max_workers=1)
+        exports = []
+
+        active = []        # casos con tiles pendientes de acumular
+        pending = []       # (caso, tile) aún no enviados a la red
+        exhausted = False
+        n_tiles = 0
+        t0 = time.time()
+
+        while True:
+            # Rellenar la cola de tiles hasta tener un batch completo
+            while len(pending) < self.batch_size and not exhausted:
+                case = case_queue.get()
+                if case is None:
+                    exhausted = True
+                    break
+                if isinstance(case, Exception):
+                    exporter.shutdown(wait=True)
+                    raise case
+                if case.remaining == 0:
+                    # todas las slices vacías: no hay nada que pasar por la red
+                    exports.append(exporter.submit(self._export, case))
+                    continue
+                active.append(case)
+                pending.extend((case, tile) for tile in case.tiles)
+
+            if not pending:
+                break
+
+            batch, pending = pending[: self.batch_size], pending[self.batch_size:]
+            x = torch.stack([case.input_tile(tile) for case, tile in batch])
+            out = self.predict_batch(x)
+            n_tiles += len(batch)
+
+            for (case, tile), logits in zip(batch, out):
+                case.accumulate(tile, logits, self.gaussian)
+
+            for case in [c for c in active if c.remaining == 0]:
+                active.remove(case)
+                case.data = None  # liberar la entrada; los logits se exportan en segundo plano
+                exports.append(exporter.submit(self._export, case))
+                skipped = f", {case.skipped_slices} slices vacías omitidas" if case.skipped_slices else ""
+                print(f"  Caso {case.case_id} terminado ({n_tiles / (time.time() - t0):.2f} tiles/s{skipped})")
+
+        for future in exports:
+            future.result()
+        exporter.shutdown()
+        producer.join()
+        return n_tiles, time.time() - t0
+
+
+def build_predictor(model_dir=MODEL_DIR, folds=FOLDS, use_mirroring=USE_MIRRORING):
+    predictor = nnUNetPredictor(
+        tile_step_size=TILE_STEP_SIZE,
+        use_gaussian=True,
+        use_mirroring=use_mirroring,
+        device=torch.device("cpu"),
+        verbose=False,
+        verbose_preprocessing=False,
+        allow_tqdm=False,
+    )
+    predictor.initialize_from_trained_model_folder(str(model_dir), use_folds=folds, checkpoint_name=CHECKPOINT)
+    return predictor
+
+
+def configure_threads(intra_op=INTRA_OP_THREADS, inter_op=INTER_OP_THREADS):
+    """
+    Fija los hilos de torch. Debe llamarse antes de cualquier operación de
+    torch (set_num_interop_threads falla si el pool ya está creado).
+    """
+    torch.set_num_threads(intra_op)
+    torch.set_num_interop_threads(inter_op)
+
+
+def main():
+    configure_threads()
+    print(f"Hilos torch: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+    predictor = build_predictor()
+    cases = list_test_cases(BASE_RAW / DATASET)
+    print(f"Inferencia {CONFIGURATION} en CPU de {len(cases)} casos de imagesTs (batch={BATCH_SIZE}, "
+          f"mirroring={'sí' if USE_MIRRORING else 'no'})...")
+
+    engine = CPUInferenceEngine(predictor)
+    n_tiles, elapsed = engine.run(cases, OUTPUT_DIR)
+
+    print("\n========================================")
+    print(f" Casos: {len(cases)}  Tiles: {n_tiles}  Tiempo: {elapsed:.1f} s")
+    print(f" Throughput: {n_tiles / max(elapsed, 1e-6):.2f} tiles/s")
+    print(f" Predicciones en: {OUTPUT_DIR}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from case_catalog import parse_case_id
+from json_stream import load_splits, write_splits
+from virtual_2d_dataset import iter_source_cases, load_slice_index, read_dataset_json, save_slice_index, slice_id_for
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+DATASET2 = "Dataset002_MSLesSeg"
+SLICE_INDEX_FILENAME = "slice_index.json"
+SPLITS_FILENAME = "splits_final.json"
+
+HASH_SIZE = 8          # hash de 8 x 8 = 64 bits por slice (average hash), un uint64
+HASH_CHANNEL = "0"     # canal de Dataset001 usado para el hash (FLAIR)
+MAX_HAMMING = 4        # bits distintos para considerar dos slices casi iguales
+SUBSETS = ["Tr"]       # las slices de test no se tocan
+# "drop":   se mueven a <dataset>/duplicates/ y se quitan de dataset.json y splits
+#           (las slices con lesión en la etiqueta nunca se quitan)
+# "weight": se conservan y se guarda en el índice un peso 1/tamaño_del_grupo por slice.
+#           Solo lo usa VirtualSliceDataset.sample_indices (virtual_2d_dataset.py);
+#           el entrenamiento de nnU-Net lo ignora y sigue viendo todas las slices
+MODE = "drop"
+DUPLICATES_DIRNAME = "duplicates"
+NUM_WORKERS = 4
+# ============================
+
+
+def slice_hashes(volume, zs, hash_size=HASH_SIZE):
+    """
+    Average hash de las slices zs de un volumen (X, Y, Z), todas a la vez:
+    se reduce cada slice a hash_size x hash_size por media de bloques (recorte
+    central a múltiplo del bloque), se compara con la media de la slice y los
+    bits se empaquetan en un uint64 por slice.
+    """
+    stack = np.asarray(volume[:, :, zs], dtype=np.float32)  # (X, Y, n)
+    bx, by = stack.shape[0] // hash_size, stack.shape[1] // hash_size
+    x0 = (stack.shape[0] - bx * hash_size) // 2
+    y0 = (stack.shape[1] - by * hash_size) // 2
+    stack = stack[x0:x0 + bx * hash_size, y0:y0 + by * hash_size]
+    small = stack.reshape(hash_size, bx, hash_size, by, -1).mean(axis=(1, 3))  # (h, h, n)
+    bits = small > small.mean(axis=(0, 1), keepdims=True)
+    packed = np.packbits(bits.reshape(hash_size * hash_size, -1).T, axis=1)  # (n, h*h/8)
+    return np.frombuffer(np.ascontiguousarray(packed).tobytes(), dtype=">u8").astype(np.uint64)
+
+
+def hash_case(args):
+    """(base_id, hashes por slice, True por slice si la etiqueta tiene lesión)."""
+    base_id, channel_path, label_path, zs = args
+    volume = np.asanyarray(nib.load(str(channel_path), mmap=True).dataobj)
+    if label_path is None:
+        foreground = np.zeros(len(zs), dtype=bool)
+    else:
+        label = np.asanyarray(nib.load(str(label_path), mmap=True).dataobj)
+        foreground = np.asarray(label[:, :, zs] > 0).any(axis=(0, 1))
+    return base_id, slice_hashes(volume, zs), foreground
+
+
+def hamming_matrix(hashes):
+    """Distancias de Hamming (n, n) entre hashes uint64."""
+    xor = hashes[:, None] ^ hashes[None, :]
+    return np.unpackbits(xor.view(np.uint8).reshape(*xor.shape, 8), axis=-1).sum(axis=-1)
+
+
+def cluster_near_duplicates(hashes, max_distance=MAX_HAMMING):
+    """Etiqueta de grupo por slice: union-find sobre los pares a distancia <= max_distance."""
+    parent = np.arange(len(hashes))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    dist = hamming_matrix(hashes)
+    for i, j in zip(*np.nonzero(np.triu(dist <= max_distance, k=1))):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.array([find(i) for i in range(len(hashes))])
+
+
+def find_duplicates(slice_index, source_root, num_workers=NUM_WORKERS):
+    """
+    Agrupa las slices casi duplicadas dentro de cada paciente (todas sus
+    visitas juntas, nunca entre pacientes, así los splits por paciente no se
+    mezclan). Devuelve {base_id: (posiciones redundantes, pesos por posición)}.
+    Las slices con lesión en la etiqueta nunca se marcan como redundantes: el
+    hash solo mira HASH_CHANNEL y dos slices parecidas pueden tener etiquetas
+    distintas.
+    """
+    dataset_json = read_dataset_json(source_root)
+    channel_idx = sorted(dataset_json["channel_names"], key=int).index(HASH_CHANNEL)
+    paths = {base_id: (ch[channel_idx], label) for base_id, _, ch, label in iter_source_cases(source_root, dataset_json)}
+
+    cases = {b: info for b, info in slice_index["cases"].items() if info["subset"] in SUBSETS}
+    jobs = [(base_id, *paths[base_id], info["slices"]) for base_id, info in cases.items()]
+    hashes, foreground = {}, {}
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for base_id, h, fg in pool.map(hash_case, jobs):
+            hashes[base_id], foreground[base_id] = h, fg
+
+    patients = {}
+    for base_id in cases:
+        patients.setdefault(parse_case_id(base_id)[0], []).append(base_id)
+
+    result = {}
+    for base_ids in patients.values():
+        owners = [(b, pos) for b in base_ids for pos in range(len(cases[b]["slices"]))]
+        groups = cluster_near_duplicates(np.concatenate([hashes[b] for b in base_ids]))
+        sizes = np.bincount(groups, minlength=len(groups))
+        for base_id in base_ids:
+            result[base_id] = ([], [1.0] * len(cases[base_id]["slices"]))
+        for k, (base_id, pos) in enumerate(owners):
+            # el representante de cada grupo es su primer miembro
+            if groups[k] != k and not foreground[base_id][pos]:
+                result[base_id][0].append(pos)
+            result[base_id][1][pos] = 1.0 / sizes[groups[k]]
+    return result
+
+
+def move_slice_files(dataset_root, slice_id, subset, file_ending, n_channels):
+    dataset_root = Path(dataset_root)
+    target = dataset_root / DUPLICATES_DIRNAME
+    names = [f"images{subset}/{slice_id}_{c:04d}{file_ending}" for c in range(n_channels)]
+    names.append(f"labels{subset}/{slice_id}{file_ending}")
+    for name in names:
+        src = dataset_root / name
+        if src.exists():
+            (target / name).parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(src), str(target / name))
+
+
+def drop_duplicates(dataset_root, slice_index, duplicates, splits_path):
+    """Mueve las slices redundantes fuera del dataset y las quita de dataset.json y de los splits."""
+    dataset_json = read_dataset_json(dataset_root)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    n_channels = len(dataset_json["channel_names"])
+
+    dropped_ids = set()
+    for base_id, (positions, _) in duplicates.items():
+        info = slice_index["cases"][base_id]
+        already = set(info.get("dropped", []))
+        for pos in positions:
+            slice_id = slice_id_for(base_id, pos)
+            dropped_ids.add(slice_id)
+            if pos not in already:
+                move_slice_files(dataset_root, slice_id, info["subset"], file_ending, n_channels)
+        info["dropped"] = sorted(already | set(positions))
+
+    def keep(entry):
+        image = entry["image"] if isinstance(entry, dict) else entry
+        return Path(image).name not in dropped_ids
+
+    dataset_json["training"] = [e for e in dataset_json["training"] if keep(e)]
+    dataset_json["test"] = [e for e in dataset_json.get("test", []) if keep(e)]
+    dataset_json["numTraining"] = len(dataset_json["training"])
+    dataset_json["numTest"] = len(dataset_json["test"])
+    with open(Path(dataset_root) / "dataset.json", "w") as f:
+        json.dump(dataset_json, f, indent=4)
+
+    if Path(splits_path).exists():
+        splits = load_splits(splits_path)
+        splits = [{k: [c for c in fold[k] if c not in dropped_ids] for k in ("train", "val")} for fold in splits]
+        write_splits(splits_path, splits)
+    return len(dropped_ids)
+
+
+def main():
+    dataset_root = BASE_RAW / DATASET2
+    slice_index = load_slice_index(dataset_root / SLICE_INDEX_FILENAME)
+    source_root = BASE_RAW / slice_index["source_dataset"]
+
+    print(f"Calculando hashes de {HASH_SIZE}x{HASH_SIZE} de las slices de {DATASET2}...")
+    duplicates = find_duplicates(slice_index, source_root)
+    n_slices = sum(len(w) for _, w in duplicates.values())
+    n_redundant = sum(len(p) for p, _ in duplicates.values())
+
+    if MODE == "drop":
+        n_dropped = drop_duplicates(dataset_root, slice_index, duplicates, BASE_PREPROCESSED / DATASET2 / SPLITS_FILENAME)
+        result = f"{n_dropped} slices movidas a {dataset_root / DUPLICATES_DIRNAME}"
+    elif MODE == "weight":
+        for base_id, (_, weights) in duplicates.items():
+            slice_index["cases"][base_id]["weights"] = weights
+        result = f"pesos de muestreo guardados en {dataset_root / SLICE_INDEX_FILENAME}"
+    else:
+        raise ValueError(f"MODE desconocido: {MODE}")
+
+    save_slice_index(slice_index, dataset_root / SLICE_INDEX_FILENAME)
+
+    print("\n========================================")
+    print(f" Slices analizadas: {n_slices} ({', '.join(SUBSETS)})")
+    print(f" Casi duplicadas (Hamming <= {MAX_HAMMING}): {n_redundant}")
+    print(f" {result}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import os
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from postprocess_lesions import remove_small_lesions
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_RESULTS = Path("nnUNet_results")
+DATASET = "Dataset001_MSLesSeg"
+CONFIGURATION = "3d_fullres"
+
+# Una carpeta por fold con los <case>.npz de probabilidades (cpu_inference.py
+# con SAVE_PROBABILITIES = True y FOLDS = (k,), o nnUNetv2_predict --save_probabilities)
+FOLD_DIRS = [BASE_RESULTS / DATASET / f"predictions_imagesTs_{CONFIGURATION}_fold{k}" for k in range(5)]
+OUTPUT_DIR = BASE_RESULTS / DATASET / f"predictions_imagesTs_{CONFIGURATION}_ensemble"
+
+LESION_CHANNEL = 1          # canal de "lesion" en las probabilidades (labels de dataset.json)
+THRESHOLD = 0.5
+MIN_LESION_SIZE_MM3 = 0     # lesiones menores se eliminan (ver postprocess_lesions.py)
+CHUNK_Z = 16                # slices por bloque al acumular
+SAVE_MEAN_PROBABILITIES = False  # True: conserva <case>_lesion_prob.npy (float16, z y x)
+NUM_WORKERS = 4
+# ============================
+
+PROBABILITIES_KEY = "probabilities"
+
+
+class ProbabilityStream:
+    """
+    Lee un array de probabilidades (C, Z, Y, X) guardado por nnU-Net en .npz
+    (o en .npy) por bloques de Z, sin descomprimir el array entero: se lee la
+    cabecera .npy del miembro del zip y después solo los bytes necesarios.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._stack = ExitStack()
+
+    def __enter__(self):
+        if self.path.suffix == ".npy":
+            self.f = self._stack.enter_context(open(self.path, "rb"))
+        else:
+            zf = self._stack.enter_context(zipfile.ZipFile(self.path))
+            self.f = self._stack.enter_context(zf.open(PROBABILITIES_KEY + ".npy"))
+        version = np.lib.format.read_magic(self.f)
+        if version == (1, 0):
+            self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_1_0(self.f)
+        else:
+            self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_2_0(self.f)
+        if fortran_order:
+            raise ValueError(f"{self.path}: array en orden Fortran, no se puede leer por bloques de Z")
+        self._offset = 0  # bytes leídos desde el inicio de los datos
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stack.close()
+        return False
+
+    def chunks(self, channel, chunk_z=CHUNK_Z):
+        """(z0, bloque float32 (n, Y, X)) del canal indicado. Los canales se leen en orden."""
+        nz = self.shape[1]
+        plane = int(np.prod(self.shape[2:]))
+        itemsize = self.dtype.itemsize
+        start = channel * nz * plane * itemsize
+        if start < self._offset:
+            raise ValueError("Los canales se deben leer en orden creciente")
+        self.f.seek(start - self._offset, os.SEEK_CUR)
+        self._offset = start
+
+        for z0 in range(0, nz, chunk_z):
+            n = min(chunk_z, nz - z0)
+            nbytes = n * plane * itemsize
+            buf = self.f.read(nbytes)
+            if len(buf) != nbytes:
+                raise ValueError(f"{self.path}: fichero truncado")
+            self._offset += nbytes
+            yield z0, np.frombuffer(buf, dtype=self.dtype).reshape((n, *self.shape[2:])).astype(np.float32)
+
+
+def find_probability_file(fold_dir, case_id):
+    for ending in (".npz", ".npy"):
+        path = Path(fold_dir) / f"{case_id}{ending}"
+        if path.exists():
+            return path
+    return None
+
+
+def list_ensemble_cases(fold_dirs):
+    """Casos con probabilidades en todas las carpetas de fold."""
+    cases = None
+    for fold_dir in fold_dirs:
+        ids = {p.name.rsplit(".", 1)[0] for p in Path(fold_dir).glob("*.np[yz]")}
+        cases = ids if cases is None else cases & ids
+    return sorted(cases or [])
+
+
+def ensemble_case(args):
+    """
+    Media de la probabilidad de lesión de todos los folds en un memmap
+    float16 (Z, Y, X), acumulada fold a fold y bloque a bloque:
+      media_k = media_{k-1} + (p_k - media_{k-1}) / k
+    Después umbraliza y guarda la máscara en NIfTI (X, Y, Z) con la affine
+    de la imagen original.
+    """
+    case_id, fold_dirs, reference_path, output_dir, work_dir = args
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    mean_path = work_dir / f"{case_id}_lesion_prob.npy"
+
+    mean = None
+    for k, fold_dir in enumerate(fold_dirs, start=1):
+        with ProbabilityStream(find_probability_file(fold_dir, case_id)) as stream:
+            if mean is None:
+                mean = np.lib.format.open_memmap(mean_path, mode="w+", dtype=np.float16, shape=stream.shape[1:])
+            elif tuple(stream.shape[1:]) != mean.shape:
+                raise ValueError(f"{case_id}: shape {stream.shape[1:]} en {fold_dir} distinta de {mean.shape}")
+            for z0, p in stream.chunks(LESION_CHANNEL):
+                block = slice(z0, z0 + p.shape[0])
+                if k == 1:
+                    mean[block] = p
+                else:
+                    m = mean[block].astype(np.float32)
+                    m += (p - m) / k
+                    mean[block] = m
+
+    mask = np.empty(mean.shape, dtype=np.uint8)
+    for z0 in range(0, mean.shape[0], CHUNK_Z):
+        block = slice(z0, z0 + CHUNK_Z)
+        mask[block] = mean[block] >= THRESHOLD
+    mean.flush()
+    del mean
+
+    # SimpleITK (z, y, x) -> nibabel (x, y, z)
+    mask = mask.transpose(2, 1, 0)
+    reference = nib.load(str(reference_path))
+    if mask.shape != reference.shape[:3]:
+        raise ValueError(f"{case_id}: máscara {mask.shape} y referencia {reference.shape} no coinciden")
+    mask = remove_small_lesions(mask, reference.header.get_zooms()[:3], MIN_LESION_SIZE_MM3)
+    img = nib.Nifti1Image(mask, reference.affine, header=reference.header)
+    img.set_data_dtype(np.uint8)
+    nib.save(img, str(Path(output_dir) / f"{case_id}.nii.gz"))
+
+    if SAVE_MEAN_PROBABILITIES:
+        shutil.move(str(mean_path), str(Path(output_dir) / mean_path.name))
+    else:
+        mean_path.unlink()
+    return case_id, int(mask.sum())
+
+
+def find_reference_image(images_ts, case_id):
+    """Canal 0000 del caso en imagesTs (affine y cabecera de la máscara del ensemble)."""
+    path = next(Path(images_ts).glob(f"{case_id}_0000.*"), None)
+    if path is None:
+        raise FileNotFoundError(f"{case_id}: no hay imagen de referencia {case_id}_0000.* en {images_ts}")
+    return path
+
+
+def main():
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    work_dir = OUTPUT_DIR / "_ensemble_tmp"
+    images_ts = BASE_RAW / DATASET / "imagesTs"
+
+    missing = [str(d) for d in FOLD_DIRS if not d.is_dir()]
+    if missing:
+        raise FileNotFoundError(f"Faltan carpetas de predicción por fold: {missing}")
+
+    cases = list_ensemble_cases(FOLD_DIRS)
+    print(f"Ensemble de {len(FOLD_DIRS)} folds para {len(cases)} casos (umbral {THRESHOLD})...")
+
+    jobs = [
+        (case_id, FOLD_DIRS, find_reference_image(images_ts, case_id), OUTPUT_DIR, work_dir)
+        for case_id in cases
+    ]
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        for case_id, n_voxels in pool.map(ensemble_case, jobs):
+            print(f"  {case_id}: {n_voxels} vóxeles de lesión")
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\n========================================")
+    print(f" Máscaras del ensemble en: {OUTPUT_DIR}")
+    print(f" Evaluar con evaluate_predictions.py (PREDICTIONS_DIR = {OUTPUT_DIR})")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
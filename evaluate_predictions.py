@@ -0,0 +1,269 @@
+import csv
+import json
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_RESULTS = Path("nnUNet_results")
+
+DATASET = "Dataset001_MSLesSeg"
+PREDICTIONS_DIR = BASE_RESULTS / DATASET / "predictions_imagesTs"
+LABELS_DIR = BASE_RAW / DATASET / "labelsTs"
+
+OUTPUT_CSV = PREDICTIONS_DIR / "metrics_per_case.csv"
+OUTPUT_SUMMARY = PREDICTIONS_DIR / "metrics_summary.json"
+
+CONNECTIVITY = 3  # conectividad de las componentes para las métricas por lesión
+NUM_WORKERS = 4
+# ============================
+
+METRICS = [
+    "dice",
+    "lesion_precision",
+    "lesion_recall",
+    "lesion_f1",
+    "n_lesions_gt",
+    "n_lesions_pred",
+    "volume_gt_mm3",
+    "volume_pred_mm3",
+    "avd_mm3",
+    "avd_percent",
+    "hd95_mm",
+    "assd_mm",
+]
+
+
+def strip_ending(filename, file_ending):
+    return filename[: -len(file_ending)] if filename.endswith(file_ending) else filename
+
+
+def base_case_id(name):
+    """P1_T1_001 (slice de Dataset002) -> P1_T1."""
+    return "_".join(name.split("_")[:-1])
+
+
+def group_pairs(labels_dir, predictions_dir, file_ending, is_2d):
+    """
+    Empareja cada máscara de labels_dir con su predicción (mismo nombre).
+    Devuelve dict case_id -> [(label_path, pred_path), ...]:
+      - 3D: un único par por caso
+      - 2D: todas las slices P1_T1_001, P1_T1_002, ... agrupadas en P1_T1
+    """
+    groups = defaultdict(list)
+    missing = 0
+    for label_path in sorted(Path(labels_dir).glob(f"*{file_ending}")):
+        pred_path = Path(predictions_dir) / label_path.name
+        if not pred_path.exists():
+            missing += 1
+            continue
+        name = strip_ending(label_path.name, file_ending)
+        case_id = base_case_id(name) if is_2d else name
+        groups[case_id].append((label_path, pred_path))
+
+    if missing:
+        print(f"[AVISO] {missing} máscaras sin predicción en {predictions_dir}, se omiten.")
+    return dict(groups)
+
+
+def load_pair_stack(pairs):
+    """
+    Carga las máscaras (en su dtype nativo) y las predicciones de un caso.
+    En 2D apila las slices en el último eje, en el orden de los nombres.
+    """
+    gts, preds = [], []
+    spacing = None
+    for label_path, pred_path in pairs:
+        gt_img = nib.load(str(label_path))
+        if spacing is None:
+            spacing = np.array(gt_img.header.get_zooms()[:3], dtype=np.float64)
+        gts.append(np.asanyarray(gt_img.dataobj) > 0)
+        preds.append(np.asanyarray(nib.load(str(pred_path)).dataobj) > 0)
+
+    if gts[0].ndim == 2 or len(pairs) > 1:
+        # slices 2D guardadas como (X, Y) o (X, Y, 1)
+        gt = np.stack([g.reshape(g.shape[:2]) for g in gts], axis=-1)
+        pred = np.stack([p.reshape(p.shape[:2]) for p in preds], axis=-1)
+        spacing = np.concatenate([spacing[:2], [1.0]])
+    else:
+        gt, pred = gts[0], preds[0]
+    return pred, gt, spacing
+
+
+def count_matched(labels, other):
+    """Nº de componentes de 'labels' que solapan con algún vóxel de 'other'."""
+    hits = labels[other & (labels > 0)]
+    return np.unique(hits).size
+
+
+def lesion_scores(n_gt, n_pred, tp_gt, tp_pred):
+    """(precision, recall, F1) a nivel de lesión a partir de los recuentos de componentes."""
+    precision = tp_pred / n_pred if n_pred > 0 else float("nan")
+    recall = tp_gt / n_gt if n_gt > 0 else float("nan")
+    if n_gt == 0 and n_pred == 0:
+        f1 = 1.0
+    elif tp_gt + tp_pred == 0:
+        f1 = 0.0
+    else:
+        p = precision if n_pred > 0 else 0.0
+        r = recall if n_gt > 0 else 0.0
+        f1 = 2 * p * r / (p + r) if (p + r) > 0 else 0.0
+    return precision, recall, f1
+
+
+def surface(mask, structure):
+    return mask & ~ndimage.binary_erosion(mask, structure=structure, border_value=0)
+
+
+def surface_distances(pred, gt, spacing):
+    """
+    Distancias (mm) de cada vóxel de superficie de pred a la superficie de gt
+    y viceversa. Se recorta al bounding box común para que la EDT sea barata.
+    """
+    if not pred.any() or not gt.any():
+        return None
+
+    union = pred | gt
+    bbox = ndimage.find_objects(union.astype(np.uint8))[0]
+    bbox = tuple(
+        slice(max(s.start - 1, 0), min(s.stop + 1, n)) for s, n in zip(bbox, union.shape)
+    )
+    pred, gt = pred[bbox], gt[bbox]
+
+    structure = ndimage.generate_binary_structure(pred.ndim, 1)
+    pred_surf = surface(pred, structure)
+    gt_surf = surface(gt, structure)
+
+    dist_to_gt = ndimage.distance_transform_edt(~gt_surf, sampling=spacing)
+    dist_to_pred = ndimage.distance_transform_edt(~pred_surf, sampling=spacing)
+    return np.concatenate([dist_to_gt[pred_surf], dist_to_pred[gt_surf]])
+
+
+def compute_metrics(pred, gt, spacing, planar=False, distances=True):
+    """
+    Métricas de un caso (arrays booleanos de igual forma).
+    planar=True para slices 2D apiladas: las componentes y las superficies se
+    calculan en cada plano, sin conectar slices que no son contiguas.
+    distances=False omite HD95/ASSD (NaN), que son lo más caro.
+    """
+    voxel_mm3 = float(np.prod(spacing))
+    vol_gt = int(np.count_nonzero(gt))
+    vol_pred = int(np.count_nonzero(pred))
+    inter = int(np.count_nonzero(pred & gt))
+
+    dice = 2.0 * inter / (vol_gt + vol_pred) if (vol_gt + vol_pred) > 0 else 1.0
+
+    structure = ndimage.generate_binary_structure(3, CONNECTIVITY)
+    if planar:
+        structure[:, :, 0] = False
+        structure[:, :, 2] = False
+    gt_lab, n_gt = ndimage.label(gt, structure=structure)
+    pred_lab, n_pred = ndimage.label(pred, structure=structure)
+
+    tp_gt = count_matched(gt_lab, pred)
+    tp_pred = count_matched(pred_lab, gt)
+    precision, recall, f1 = lesion_scores(n_gt, n_pred, tp_gt, tp_pred)
+
+    if not distances:
+        dists = None
+    elif planar:
+        per_slice = [surface_distances(pred[..., z], gt[..., z], spacing[:2]) for z in range(gt.shape[-1])]
+        per_slice = [d for d in per_slice if d is not None]
+        dists = np.concatenate(per_slice) if per_slice else None
+    else:
+        dists = surface_distances(pred, gt, spacing)
+
+    avd = abs(vol_pred - vol_gt) * voxel_mm3
+    return {
+        "dice": dice,
+        "lesion_precision": precision,
+        "lesion_recall": recall,
+        "lesion_f1": f1,
+        "n_lesions_gt": n_gt,
+        "n_lesions_pred": n_pred,
+        "volume_gt_mm3": vol_gt * voxel_mm3,
+        "volume_pred_mm3": vol_pred * voxel_mm3,
+        "avd_mm3": avd,
+        "avd_percent": 100.0 * avd / (vol_gt * voxel_mm3) if vol_gt > 0 else float("nan"),
+        "hd95_mm": float(np.percentile(dists, 95)) if dists is not None and dists.size else float("nan"),
+        "assd_mm": float(dists.mean()) if dists is not None and dists.size else float("nan"),
+    }
+
+
+def evaluate_case(item):
+    case_id, pairs, is_2d = item
+    pred, gt, spacing = load_pair_stack(pairs)
+    metrics = compute_metrics(pred, gt, spacing, planar=is_2d)
+    return {"case_id": case_id, "n_files": len(pairs), **metrics}
+
+
+def evaluate(labels_dir, predictions_dir, file_ending=".nii.gz", is_2d=False, num_workers=NUM_WORKERS):
+    """
+    Evalúa todos los casos en paralelo (un proceso por caso) y devuelve la
+    lista de filas por caso, en el orden de los case_id.
+    """
+    groups = group_pairs(labels_dir, predictions_dir, file_ending, is_2d)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        items = [(case_id, pairs, is_2d) for case_id, pairs in sorted(groups.items())]
+        rows = list(pool.map(evaluate_case, items, chunksize=1))
+    return rows
+
+
+def summarize(rows):
+    """Media, desviación y mediana de cada métrica ignorando NaN."""
+    summary = {"n_cases": len(rows)}
+    for metric in METRICS:
+        values = np.array([r[metric] for r in rows], dtype=np.float64)
+        valid = values[~np.isnan(values)]
+        summary[metric] = {
+            "mean": float(valid.mean()) if valid.size else None,
+            "std": float(valid.std()) if valid.size else None,
+            "median": float(np.median(valid)) if valid.size else None,
+            "n": int(valid.size),
+        }
+    return summary
+
+
+def write_csv(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["case_id", "n_files"] + METRICS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    with open(BASE_RAW / DATASET / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    is_2d = dataset_json.get("tensorImageSize") == "2D"
+
+    print(f"Evaluando {PREDICTIONS_DIR} contra {LABELS_DIR} ({'2D' if is_2d else '3D'})...")
+    rows = evaluate(LABELS_DIR, PREDICTIONS_DIR, file_ending, is_2d)
+    if not rows:
+        raise FileNotFoundError(f"No hay pares predicción/máscara en {PREDICTIONS_DIR}")
+
+    summary = summarize(rows)
+    write_csv(rows, OUTPUT_CSV)
+    with open(OUTPUT_SUMMARY, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    print("\n========================================")
+    print(f" Casos evaluados: {summary['n_cases']}")
+    for metric in ["dice", "lesion_f1", "avd_percent", "hd95_mm", "assd_mm"]:
+        m = summary[metric]
+        if m["mean"] is not None:
+            print(f" {metric}: {m['mean']:.4f} ± {m['std']:.4f}")
+    print(f" Tabla por caso: {OUTPUT_CSV}")
+    print(f" Resumen: {OUTPUT_SUMMARY}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
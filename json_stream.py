@@ -0,0 +1,294 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+JSON_INDENT = 4          # None: formato compacto (una línea, sin espacios)
+READ_CHUNK_SIZE = 1 << 20
+# ============================
+
+_COMPACT_SEPARATORS = (",", ":")
+
+
+class StreamingJSONWriter:
+    """
+    Escribe un objeto JSON de nivel superior clave a clave, y las listas
+    grandes elemento a elemento, sin construir el documento en memoria.
+    Con indent=4 la salida es idéntica a json.dump(obj, f, indent=4).
+
+      with StreamingJSONWriter(path) as w:
+          w.write("name", "MSLesSeg")
+          w.begin_list("training")
+          for entry in entries:
+              w.append(entry)
+          w.end_list()
+    """
+
+    def __init__(self, path, indent=JSON_INDENT):
+        self.path = Path(path)
+        self.indent = indent
+        self.f = None
+        self._n_keys = 0
+        self._n_items = None  # != None mientras hay una lista abierta
+
+    def __enter__(self):
+        self.f = open(self.path, "w")
+        self.f.write("{")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            if self._n_items is not None:
+                self.end_list()
+            self.f.write(self._newline(0) + "}" if self._n_keys else "}")
+        self.f.close()
+        return False
+
+    def _newline(self, level):
+        return "" if self.indent is None else "\n" + " " * (self.indent * level)
+
+    def _dumps(self, value, level):
+        if self.indent is None:
+            return json.dumps(value, separators=_COMPACT_SEPARATORS)
+        return json.dumps(value, indent=self.indent).replace("\n", self._newline(level))
+
+    def _key(self, key):
+        if self._n_items is not None:
+            raise RuntimeError("Hay una lista abierta: llama a end_list() antes de escribir otra clave.")
+        sep = ": " if self.indent is not None else ":"
+        self.f.write(("," if self._n_keys else "") + self._newline(1) + json.dumps(key) + sep)
+        self._n_keys += 1
+
+    def write(self, key, value):
+        self._key(key)
+        self.f.write(self._dumps(value, 1))
+
+    def begin_list(self, key):
+        self._key(key)
+        self.f.write("[")
+        self._n_items = 0
+
+    def append(self, item):
+        self.f.write(("," if self._n_items else "") + self._newline(2) + self._dumps(item, 2))
+        self._n_items += 1
+
+    def end_list(self):
+        self.f.write(self._newline(1) + "]" if self._n_items else "]")
+        self._n_items = None
+
+
+class ListSpool:
+    """
+    Lista JSON que se va guardando en disco a medida que se produce (una
+    entrada por línea) para escribirla al final con StreamingJSONWriter sin
+    haberla tenido en memoria:
+
+      spool = ListSpool(tmp_path)
+      spool.append(entry)       # durante el procesado
+      ...
+      w.begin_list("training")
+      for entry in spool:       # al escribir dataset.json
+          w.append(entry)
+      w.end_list()
+      spool.discard()
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.f = open(self.path, "w")
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, item):
+        self.f.write(json.dumps(item, separators=_COMPACT_SEPARATORS) + "\n")
+        self.n += 1
+
+    def __iter__(self):
+        if not self.f.closed:
+            self.f.close()
+        with open(self.path, "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def discard(self):
+        if not self.f.closed:
+            self.f.close()
+        self.path.unlink(missing_ok=True)
+
+
+def write_splits(path, folds, indent=JSON_INDENT):
+    """
+    Escribe splits_final.json fold a fold y caso a caso. folds es un iterable
+    de dicts {"train": iterable de ids, "val": iterable de ids}, que pueden ser
+    generadores. Con indent=4 la salida es idéntica a json.dump(splits, indent=4).
+    """
+    nl = (lambda level: "") if indent is None else (lambda level: "\n" + " " * (indent * level))
+    sep = ":" if indent is None else ": "
+    with open(path, "w") as f:
+        f.write("[")
+        n_folds = 0
+        for fold in folds:
+            f.write(("," if n_folds else "") + nl(1) + "{")
+            for key_idx, key in enumerate(("train", "val")):
+                f.write(("," if key_idx else "") + nl(2) + json.dumps(key) + sep + "[")
+                n = 0
+                for case_id in fold[key]:
+                    f.write(("," if n else "") + nl(3) + json.dumps(case_id))
+                    n += 1
+                f.write(nl(2) + "]" if n else "]")
+            f.write(nl(1) + "}")
+            n_folds += 1
+        f.write(nl(0) + "]" if n_folds else "]")
+
+
+class _ChunkReader:
+    """Buffer de texto sobre un fichero que se rellena bajo demanda."""
+
+    def __init__(self, f, chunk_size=READ_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Siguiente carácter no blanco (sin consumirlo); '' al final del fichero."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSON inesperado: se esperaba '{char}' y hay '{self.peek()}'")
+        self.pos += 1
+
+    def value(self, decoder=json.JSONDecoder()):
+        """Decodifica el siguiente valor completo con raw_decode, leyendo más si está cortado."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # un número al final del buffer puede estar cortado
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array(reader):
+    """Elementos de la lista JSON que empieza en la posición actual del reader."""
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == ",":
+            reader.pos += 1
+            continue
+        reader.expect("]")
+        return
+
+
+def iter_top_level(path, stream_keys=("training", "test")):
+    """
+    Recorre un objeto JSON de nivel superior (dataset.json) sin cargarlo
+    entero. Produce (clave, valor) para las claves normales y, para las de
+    stream_keys, (clave, iterador de elementos); el iterador se debe consumir
+    antes de pedir la siguiente clave.
+    """
+    with open(path, "r") as f:
+        reader = _ChunkReader(f)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key in stream_keys and reader.peek() == "[":
+                items = iter_array(reader)
+                yield key, items
+                for _ in items:  # por si el llamante no lo consumió
+                    pass
+            else:
+                yield key, reader.value()
+            if reader.peek() == ",":
+                reader.pos += 1
+                continue
+            reader.expect("}")
+            return
+
+
+def iter_dataset_entries(path, key="training"):
+    """Entradas de dataset.json[key] una a una."""
+    for k, value in iter_top_level(path, stream_keys=(key,)):
+        if k == key:
+            yield from value
+            return
+
+
+def iter_splits(path):
+    """Folds de splits_final.json uno a uno (cada fold se carga completo)."""
+    with open(path, "r") as f:
+        yield from iter_array(_ChunkReader(f))
+
+
+def splits_sidecar_path(splits_path):
+    return Path(splits_path).with_suffix(".npz")
+
+
+def save_splits_sidecar(path, splits):
+    """
+    Versión binaria de splits_final.json: cada case_id se guarda una vez
+    y los folds como índices int32 sobre esa lista.
+    """
+    case_ids = sorted({c for fold in splits for key in ("train", "val") for c in fold[key]})
+    position = {c: i for i, c in enumerate(case_ids)}
+    arrays = {"case_ids": np.array(case_ids)}
+    for fold_idx, fold in enumerate(splits):
+        for key in ("train", "val"):
+            arrays[f"fold{fold_idx}_{key}"] = np.fromiter(
+                (position[c] for c in fold[key]), dtype=np.int32, count=len(fold[key])
+            )
+    np.savez_compressed(path, **arrays)
+
+
+def load_splits_sidecar(path):
+    with np.load(path) as npz:
+        case_ids = npz["case_ids"]
+        n_folds = sum(1 for k in npz.files if k.endswith("_train"))
+        return [
+            {key: case_ids[npz[f"fold{i}_{key}"]].tolist() for key in ("train", "val")}
+            for i in range(n_folds)
+        ]
+
+
+def load_splits(path):
+    """Carga splits_final.json, usando la versión .npz si existe y es más reciente."""
+    path = Path(path)
+    sidecar = splits_sidecar_path(path)
+    if sidecar.exists() and (not path.exists() or sidecar.stat().st_mtime >= path.stat().st_mtime):
+        return load_splits_sidecar(sidecar)
+    return list(iter_splits(path))
@@ -0,0 +1,245 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+DATASET = "Dataset001_MSLesSeg"
+
+LABEL_INDEX_FILENAME = "label_index.npz"
+CONNECTIVITY = 3  # 1 = 6-vecinos, 2 = 18-vecinos, 3 = 26-vecinos
+NUM_WORKERS = 4
+# ============================
+
+
+def load_mask(label_path):
+    """
+    Carga la máscara una sola vez en su dtype nativo (uint8 en nuestros
+    labelsTr/labelsTs), sin pasar por get_fdata() en float64.
+    Las máscaras 2D (Dataset002) se devuelven con un eje Z de tamaño 1.
+    """
+    img = nib.load(str(label_path))
+    mask = np.asanyarray(img.dataobj)
+    if mask.ndim == 2:
+        mask = mask[:, :, None]
+    spacing = np.ones(3, dtype=np.float32)
+    zooms = img.header.get_zooms()[:3]
+    spacing[: len(zooms)] = zooms
+    return mask, spacing
+
+
+def index_case(label_path):
+    """
+    Etiqueta las componentes conexas de la lesión de un caso y devuelve sus
+    estadísticas como arrays:
+      - volume_vox (L,), centroid (L, 3), bbox (L, 6) [x0, y0, z0, x1, y1, z1) con fin excluido
+      - slice_voxels (Z,), slice_lesions (Z,)
+    Todo se calcula con bincount sobre los vóxeles etiquetados, sin bucles por lesión.
+    """
+    mask, spacing = load_mask(label_path)
+    foreground = mask > 0
+
+    structure = ndimage.generate_binary_structure(3, CONNECTIVITY)
+    labels, n_lesions = ndimage.label(foreground, structure=structure)
+
+    coords = np.nonzero(labels)
+    lab = labels[coords]
+    volume_vox = np.bincount(lab, minlength=n_lesions + 1)[1:]
+
+    centroid = np.zeros((n_lesions, 3), dtype=np.float32)
+    if n_lesions > 0:
+        for axis in range(3):
+            sums = np.bincount(lab, weights=coords[axis], minlength=n_lesions + 1)[1:]
+            centroid[:, axis] = sums / volume_vox
+
+    bbox = np.zeros((n_lesions, 6), dtype=np.int16)
+    for i, sl in enumerate(ndimage.find_objects(labels)):
+        bbox[i] = [sl[0].start, sl[1].start, sl[2].start, sl[0].stop, sl[1].stop, sl[2].stop]
+
+    depth = mask.shape[2]
+    slice_voxels = np.count_nonzero(foreground, axis=(0, 1)).astype(np.int32)
+
+    # Una componente 26-conexa ocupa todas las z entre su z0 y z1, así que el nº
+    # de lesiones por slice sale de un array de diferencias sobre los bbox.
+    diff = np.zeros(depth + 1, dtype=np.int32)
+    np.add.at(diff, bbox[:, 2].astype(np.int64), 1)
+    np.add.at(diff, bbox[:, 5].astype(np.int64), -1)
+    slice_lesions = np.cumsum(diff[:-1]).astype(np.int16)
+
+    return {
+        "shape": np.array(mask.shape[:3], dtype=np.int32),
+        "spacing": spacing,
+        "volume_vox": volume_vox.astype(np.int32),
+        "centroid": centroid,
+        "bbox": bbox,
+        "slice_voxels": slice_voxels,
+        "slice_lesions": slice_lesions,
+    }
+
+
+def iter_label_paths(dataset_root):
+    """
+    Devuelve (case_id, subset, label_path) para todas las máscaras de
+    dataset.json (training) y de labelsTs (test) que existan.
+    """
+    dataset_root = Path(dataset_root)
+    with open(dataset_root / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+
+    for item in dataset_json["training"]:
+        label_path = dataset_root / item["label"].replace("./", "")
+        yield Path(item["image"]).name, "Tr", label_path
+
+    for entry in dataset_json["test"]:
+        image_rel = entry["image"] if isinstance(entry, dict) else entry
+        case_id = Path(image_rel).name
+        label_path = dataset_root / "labelsTs" / f"{case_id}{file_ending}"
+        if label_path.exists():
+            yield case_id, "Ts", label_path
+
+
+def build_label_index(dataset_root, num_workers=NUM_WORKERS):
+    """
+    Indexa todas las máscaras del dataset en paralelo y devuelve un LabelIndex.
+    """
+    items = list(iter_label_paths(dataset_root))
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        results = list(pool.map(index_case, [p for _, _, p in items]))
+
+    case_ids = [c for c, _, _ in items]
+    subsets = [s for _, s, _ in items]
+    return LabelIndex.from_cases(case_ids, subsets, results)
+
+
+class LabelIndex:
+    """
+    Tabla compacta de estadísticas de lesión (arrays numpy en un único .npz):
+      - por caso:   case_ids, subset, shape, spacing, n_lesions, volume_vox
+      - por lesión: lesion_case, lesion_volume_vox, lesion_centroid, lesion_bbox
+      - por slice:  slice_case, slice_z, slice_voxels, slice_lesions
+    Los arrays por lesión y por slice están ordenados por caso; lesion_offsets y
+    slice_offsets dan el rango [ini, fin) de cada caso.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self._case_pos = {c: i for i, c in enumerate(arrays["case_ids"].tolist())}
+
+    @classmethod
+    def from_cases(cls, case_ids, subsets, results):
+        n_lesions = np.array([len(r["volume_vox"]) for r in results], dtype=np.int32)
+        depths = np.array([len(r["slice_voxels"]) for r in results], dtype=np.int32)
+
+        def concat(key, empty_shape, dtype):
+            parts = [r[key] for r in results]
+            return np.concatenate(parts).astype(dtype) if parts else np.zeros(empty_shape, dtype=dtype)
+
+        arrays = {
+            "case_ids": np.array(case_ids),
+            "subset": np.array(subsets),
+            "shape": np.stack([r["shape"] for r in results]) if results else np.zeros((0, 3), np.int32),
+            "spacing": np.stack([r["spacing"] for r in results]) if results else np.zeros((0, 3), np.float32),
+            "n_lesions": n_lesions,
+            "volume_vox": np.array([r["volume_vox"].sum() for r in results], dtype=np.int64),
+            "lesion_case": np.repeat(np.arange(len(results), dtype=np.int32), n_lesions),
+            "lesion_volume_vox": concat("volume_vox", (0,), np.int32),
+            "lesion_centroid": concat("centroid", (0, 3), np.float32),
+            "lesion_bbox": concat("bbox", (0, 6), np.int16),
+            "lesion_offsets": np.concatenate([[0], np.cumsum(n_lesions)]).astype(np.int64),
+            "slice_case": np.repeat(np.arange(len(results), dtype=np.int32), depths),
+            "slice_z": np.concatenate([np.arange(d, dtype=np.int16) for d in depths]) if results else np.zeros(0, np.int16),
+            "slice_voxels": concat("slice_voxels", (0,), np.int32),
+            "slice_lesions": concat("slice_lesions", (0,), np.int16),
+            "slice_offsets": np.concatenate([[0], np.cumsum(depths)]).astype(np.int64),
+        }
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls({k: data[k] for k in data.files})
+
+    def save(self, path):
+        np.savez_compressed(path, **self.arrays)
+
+    @property
+    def case_ids(self):
+        return self.arrays["case_ids"].tolist()
+
+    def _pos(self, case_id):
+        return self._case_pos[case_id]
+
+    def case(self, case_id):
+        """Resumen de un caso: subset, shape, spacing, nº de lesiones y volumen."""
+        i = self._pos(case_id)
+        voxel_mm3 = float(np.prod(self.arrays["spacing"][i]))
+        return {
+            "case_id": case_id,
+            "subset": str(self.arrays["subset"][i]),
+            "shape": self.arrays["shape"][i].tolist(),
+            "spacing": self.arrays["spacing"][i].tolist(),
+            "n_lesions": int(self.arrays["n_lesions"][i]),
+            "volume_vox": int(self.arrays["volume_vox"][i]),
+            "volume_mm3": float(self.arrays["volume_vox"][i]) * voxel_mm3,
+        }
+
+    def lesions(self, case_id):
+        """Arrays por lesión del caso: volume_vox, centroid, bbox."""
+        i = self._pos(case_id)
+        a, b = self.arrays["lesion_offsets"][i], self.arrays["lesion_offsets"][i + 1]
+        return {
+            "volume_vox": self.arrays["lesion_volume_vox"][a:b],
+            "centroid": self.arrays["lesion_centroid"][a:b],
+            "bbox": self.arrays["lesion_bbox"][a:b],
+        }
+
+    def slices(self, case_id):
+        """Arrays por slice del caso: vóxeles de lesión y nº de lesiones en cada z."""
+        i = self._pos(case_id)
+        a, b = self.arrays["slice_offsets"][i], self.arrays["slice_offsets"][i + 1]
+        return {
+            "voxels": self.arrays["slice_voxels"][a:b],
+            "lesions": self.arrays["slice_lesions"][a:b],
+        }
+
+    def lesion_slices(self, case_id, min_voxels=1):
+        """Índices z del caso con al menos min_voxels vóxeles de lesión."""
+        return np.flatnonzero(self.slices(case_id)["voxels"] >= min_voxels)
+
+    def cases_with_volume(self, min_mm3=0.0, subset=None):
+        """case_ids cuyo volumen total de lesión (mm³) es >= min_mm3."""
+        volume_mm3 = self.arrays["volume_vox"] * np.prod(self.arrays["spacing"], axis=1)
+        keep = volume_mm3 >= min_mm3
+        if subset is not None:
+            keep &= self.arrays["subset"] == subset
+        return self.arrays["case_ids"][keep].tolist()
+
+
+def main():
+    dataset_root = BASE_RAW / DATASET
+    out_path = dataset_root / LABEL_INDEX_FILENAME
+
+    print(f"Indexando máscaras de {dataset_root} (conectividad={CONNECTIVITY})...")
+    index = build_label_index(dataset_root)
+    index.save(out_path)
+
+    n_cases = len(index.case_ids)
+    n_lesions = int(index.arrays["n_lesions"].sum())
+    empty = int((index.arrays["n_lesions"] == 0).sum())
+
+    print("\n========================================")
+    print(f" Índice de lesiones guardado en: {out_path}")
+    print(f" Casos: {n_cases} ({empty} sin lesiones)")
+    print(f" Lesiones (componentes conexas): {n_lesions}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+from case_catalog import parse_case_id
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+SOURCE_DATASET = "Dataset001_MSLesSeg"
+TARGET_DATASET = "Dataset010_MSLesSegLongitudinal"
+
+CACHE_DIR = BASE_RAW / SOURCE_DATASET / "longitudinal_cache"
+MANIFEST_FILENAME = "manifest.json"
+
+REFERENCE_CHANNEL = 0        # FLAIR: se registra y se resta este canal
+NEW_LESION_Z = 2.0           # aumento (en desviaciones típicas) a partir del cual se marca "nueva lesión"
+REGISTRATION_ITERATIONS = 200
+SITK_THREADS = 2             # hilos de SimpleITK por proceso
+NUM_WORKERS = 4
+# ============================
+
+DERIVED_CHANNELS = ["FLAIR_diff", "FLAIR_new"]
+
+
+def group_by_patient(case_ids):
+    """patient_id -> [case_ids] ordenados por timepoint (P1_T1, P1_T2, ...)."""
+    patients = {}
+    for case_id in case_ids:
+        patient_id, timepoint, _, _ = parse_case_id(case_id)
+        patients.setdefault(patient_id, []).append((timepoint or 0, case_id))
+    return {p: [c for _, c in sorted(visits)] for p, visits in patients.items()}
+
+
+def consecutive_pairs(patients):
+    """(visita anterior, visita actual) para cada paciente con más de una visita."""
+    return [(prev, cur) for visits in patients.values() for prev, cur in zip(visits, visits[1:])]
+
+
+def normalize_brain(array):
+    """z-score sobre los vóxeles no nulos (el fondo fuera del cerebro queda a 0)."""
+    mask = array != 0
+    if not mask.any():
+        return array
+    values = array[mask]
+    out = np.zeros_like(array)
+    out[mask] = (values - values.mean()) / (values.std() + 1e-8)
+    return out
+
+
+def register_rigid(fixed, moving, iterations=REGISTRATION_ITERATIONS):
+    """Transformación rígida (Euler 3D) de moving a fixed por información mutua, multirresolución."""
+    fixed = sitk.Cast(fixed, sitk.sitkFloat32)
+    moving = sitk.Cast(moving, sitk.sitkFloat32)
+    initial = sitk.CenteredTransformInitializer(
+        fixed, moving, sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
+    )
+
+    reg = sitk.ImageRegistrationMethod()
+    reg.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
+    reg.SetMetricSamplingStrategy(reg.RANDOM)
+    reg.SetMetricSamplingPercentage(0.1, seed=42)
+    reg.SetInterpolator(sitk.sitkLinear)
+    reg.SetOptimizerAsRegularStepGradientDescent(
+        learningRate=1.0, minStep=1e-4, numberOfIterations=iterations, relaxationFactor=0.5
+    )
+    reg.SetOptimizerScalesFromPhysicalShift()
+    reg.SetShrinkFactorsPerLevel([4, 2, 1])
+    reg.SetSmoothingSigmasPerLevel([2, 1, 0])
+    reg.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+    reg.SetInitialTransform(initial, inPlace=False)
+    transform = reg.Execute(fixed, moving)
+    return transform, reg.GetMetricValue()
+
+
+def cache_paths(cache_dir, prev_id, cur_id):
+    cache_dir = Path(cache_dir)
+    return {
+        "transform": cache_dir / f"{prev_id}_to_{cur_id}.tfm",
+        "diff": cache_dir / f"{cur_id}_diff.nii.gz",
+        "new": cache_dir / f"{cur_id}_new.nii.gz",
+    }
+
+
+def compute_pair(args):
+    """
+    Registra la visita anterior sobre la actual (canal de referencia), la
+    remuestrea al espacio de la actual y guarda en la caché:
+      diff: FLAIR_actual - FLAIR_anterior (ambas normalizadas)
+      new:  diff donde supera NEW_LESION_Z (hiperintensidad nueva), 0 en el resto
+    """
+    prev_id, cur_id, prev_path, cur_path, cache_dir = args
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(SITK_THREADS)
+    paths = cache_paths(cache_dir, prev_id, cur_id)
+
+    fixed = sitk.ReadImage(str(cur_path), sitk.sitkFloat32)
+    moving = sitk.ReadImage(str(prev_path), sitk.sitkFloat32)
+    transform, metric = register_rigid(fixed, moving)
+    registered = sitk.Resample(moving, fixed, transform, sitk.sitkLinear, 0.0, sitk.sitkFloat32)
+
+    cur = normalize_brain(sitk.GetArrayFromImage(fixed))
+    prev = normalize_brain(sitk.GetArrayFromImage(registered))
+    diff = np.where((cur != 0) & (prev != 0), cur - prev, 0).astype(np.float32)
+    new = np.where(diff > NEW_LESION_Z, diff, 0).astype(np.float32)
+
+    for key, array in (("diff", diff), ("new", new)):
+        img = sitk.GetImageFromArray(array)
+        img.CopyInformation(fixed)
+        sitk.WriteImage(img, str(paths[key]), useCompression=True)
+    sitk.WriteTransform(transform, str(paths["transform"]))
+
+    return cur_id, {
+        "previous": prev_id,
+        "transform": paths["transform"].name,
+        "diff": paths["diff"].name,
+        "new": paths["new"].name,
+        "metric": float(metric),
+        "source_mtimes": [os.path.getmtime(prev_path), os.path.getmtime(cur_path)],
+    }
+
+
+def load_manifest(cache_dir):
+    path = Path(cache_dir) / MANIFEST_FILENAME
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def is_cached(entry, prev_id, prev_path, cur_path, cache_dir):
+    if entry is None or entry["previous"] != prev_id:
+        return False
+    if entry["source_mtimes"] != [os.path.getmtime(prev_path), os.path.getmtime(cur_path)]:
+        return False
+    return all((Path(cache_dir) / entry[k]).exists() for k in ("transform", "diff", "new"))
+
+
+def build_cache(dataset_root, dataset_json, cache_dir=CACHE_DIR, num_workers=NUM_WORKERS):
+    """
+    Calcula (o reutiliza de la caché) los canales longitudinales de todos los
+    pares de visitas consecutivas. Devuelve el manifiesto:
+      case_id actual -> {"previous", "transform", "diff", "new", "metric", "source_mtimes"}
+    """
+    dataset_root = Path(dataset_root)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+
+    image_rel = {}
+    for item in dataset_json["training"]:
+        image_rel[Path(item["image"]).name] = item["image"].replace("./", "")
+    for entry in dataset_json.get("test", []):
+        image = entry["image"] if isinstance(entry, dict) else entry
+        image_rel[Path(image).name] = image.replace("./", "")
+
+    def reference_path(case_id):
+        return dataset_root / f"{image_rel[case_id]}_{REFERENCE_CHANNEL:04d}{file_ending}"
+
+    manifest = load_manifest(cache_dir)
+    pairs = consecutive_pairs(group_by_patient(image_rel))
+    jobs = []
+    for prev_id, cur_id in pairs:
+        prev_path, cur_path = reference_path(prev_id), reference_path(cur_id)
+        if not is_cached(manifest.get(cur_id), prev_id, prev_path, cur_path, cache_dir):
+            jobs.append((prev_id, cur_id, prev_path, cur_path, cache_dir))
+
+    print(f"{len(pairs)} pares de visitas consecutivas, {len(pairs) - len(jobs)} ya en caché, {len(jobs)} a calcular")
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for cur_id, entry in pool.map(compute_pair, jobs):
+            manifest[cur_id] = entry
+            print(f"  {entry['previous']} -> {cur_id}: métrica {entry['metric']:.4f}")
+
+    # Quitar entradas de pares que ya no existen
+    current = {cur for _, cur in pairs}
+    manifest = {k: v for k, v in manifest.items() if k in current}
+    with open(cache_dir / MANIFEST_FILENAME, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def write_zero_channels(reference_path, out_paths):
+    """Primera visita (sin anterior): canales derivados a 0 con la geometría de la referencia."""
+    ref = sitk.ReadImage(str(reference_path), sitk.sitkFloat32)
+    zeros = sitk.Image(ref.GetSize(), sitk.sitkFloat32)
+    zeros.CopyInformation(ref)
+    for path in out_paths:
+        sitk.WriteImage(zeros, str(path), useCompression=True)
+
+
+def link(src, dst):
+    dst = Path(dst)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    os.symlink(Path(src).resolve(), dst)
+
+
+def build_derived_dataset(source_root, dataset_json, manifest, target_root, cache_dir=CACHE_DIR):
+    """
+    Dataset derivado: canales originales (enlaces simbólicos) + FLAIR_diff y
+    FLAIR_new de la caché como canales nuevos. Mismas labels y case_ids.
+    """
+    source_root, target_root, cache_dir = Path(source_root), Path(target_root), Path(cache_dir)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    n_channels = len(dataset_json["channel_names"])
+
+    for sub in ["imagesTr", "labelsTr", "imagesTs", "labelsTs"]:
+        (target_root / sub).mkdir(parents=True, exist_ok=True)
+
+    entries = [(item["image"], item["label"]) for item in dataset_json["training"]]
+    entries += [
+        (e["image"], e["label"]) if isinstance(e, dict) else (e, None) for e in dataset_json.get("test", [])
+    ]
+    for image, label in entries:
+        image_rel = image.replace("./", "")
+        case_id = Path(image_rel).name
+        for c in range(n_channels):
+            name = f"{image_rel}_{c:04d}{file_ending}"
+            link(source_root / name, target_root / name)
+
+        derived = [target_root / f"{image_rel}_{n_channels + i:04d}{file_ending}" for i in range(len(DERIVED_CHANNELS))]
+        entry = manifest.get(case_id)
+        if entry is None:
+            write_zero_channels(source_root / f"{image_rel}_{REFERENCE_CHANNEL:04d}{file_ending}", derived)
+        else:
+            link(cache_dir / entry["diff"], derived[0])
+            link(cache_dir / entry["new"], derived[1])
+
+        if label is not None:
+            label_rel = label.replace("./", "")
+            link(source_root / label_rel, target_root / label_rel)
+        else:
+            # labelsTs no referenciadas en dataset.json (Dataset001)
+            label_ts = source_root / "labelsTs" / f"{case_id}{file_ending}"
+            if label_ts.exists():
+                link(label_ts, target_root / "labelsTs" / label_ts.name)
+
+    new_json = dict(dataset_json)
+    new_json["channel_names"] = dict(dataset_json["channel_names"])
+    for i, name in enumerate(DERIVED_CHANNELS):
+        new_json["channel_names"][str(n_channels + i)] = name
+    with open(target_root / "dataset.json", "w") as f:
+        json.dump(new_json, f, indent=4)
+
+
+def main():
+    source_root = BASE_RAW / SOURCE_DATASET
+    with open(source_root / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+
+    manifest = build_cache(source_root, dataset_json)
+    build_derived_dataset(source_root, dataset_json, manifest, BASE_RAW / TARGET_DATASET)
+
+    # Mismos case_ids: los splits del dataset original sirven tal cual
+    splits_src = BASE_PREPROCESSED / SOURCE_DATASET / "splits_final.json"
+    if splits_src.exists():
+        dst = BASE_PREPROCESSED / TARGET_DATASET
+        dst.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(splits_src, dst / "splits_final.json")
+    else:
+        print(f"[AVISO] No existe {splits_src}; nnU-Net generará splits nuevos para {TARGET_DATASET}.")
+
+    print("\n========================================")
+    print(f" Caché longitudinal en: {CACHE_DIR} ({len(manifest)} pares)")
+    print(f" Dataset derivado en: {BASE_RAW / TARGET_DATASET}")
+    print(f" Canales añadidos: {', '.join(DERIVED_CHANNELS)}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import nibabel as nib
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+MEMORY_BUDGET_GB = None      # None: fracción de la memoria disponible al arrancar
+MEMORY_BUDGET_FRACTION = 0.7
+MAX_WORKERS = os.cpu_count() or 1
+# ============================
+
+
+def available_memory_bytes():
+    """MemAvailable de /proc/meminfo (Linux); si no existe, la memoria física total."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def default_budget_bytes():
+    if MEMORY_BUDGET_GB is not None:
+        return int(MEMORY_BUDGET_GB * 1024 ** 3)
+    return int(available_memory_bytes() * MEMORY_BUDGET_FRACTION)
+
+
+def header_voxels(path):
+    """Nº de vóxeles de un NIfTI leyendo solo la cabecera."""
+    return math.prod(nib.load(str(path)).header.get_data_shape())
+
+
+def estimate_case_bytes(paths, itemsize=8, resident_volumes=None):
+    """
+    Pico de memoria estimado de un caso a partir de las cabeceras:
+      vóxeles del volumen más grande × itemsize del dtype de trabajo × resident_volumes
+    resident_volumes es el nº de volúmenes que el paso tiene vivos a la vez
+    (por defecto, todos los ficheros del caso).
+    """
+    voxels = max(header_voxels(p) for p in paths)
+    if resident_volumes is None:
+        resident_volumes = len(paths)
+    return int(voxels * itemsize * resident_volumes)
+
+
+class MemoryBudgetScheduler:
+    """
+    Reparte trabajos en un ProcessPoolExecutor sin que la suma de las memorias
+    estimadas de los trabajos en curso supere budget_bytes. Los trabajos se
+    ordenan de mayor a menor y, cuando el siguiente no cabe, se prueba con los
+    más pequeños (first-fit decreasing). Un trabajo mayor que todo el
+    presupuesto se ejecuta solo.
+    """
+
+    def __init__(self, budget_bytes=None, max_workers=MAX_WORKERS):
+        self.budget_bytes = default_budget_bytes() if budget_bytes is None else int(budget_bytes)
+        self.max_workers = max_workers
+        self.peak_bytes = 0
+        self.peak_workers = 0
+
+    def run(self, fn, jobs, estimates):
+        """
+        Ejecuta fn(*job) para cada job y devuelve (job, resultado) según
+        terminan. estimates: bytes estimados de cada job (misma longitud).
+        """
+        pending = sorted(zip(estimates, range(len(jobs))), reverse=True)
+        running = {}
+        in_use = 0
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                i = 0
+                while i < len(pending) and len(running) < self.max_workers:
+                    est, idx = pending[i]
+                    if in_use + est <= self.budget_bytes or not running:
+                        if est > self.budget_bytes:
+                            print(f"[AVISO] Trabajo {idx} estimado en {est / 1024 ** 3:.1f} GB, "
+                                  f"más que el presupuesto ({self.budget_bytes / 1024 ** 3:.1f} GB); se ejecuta solo.")
+                        running[pool.submit(fn, *jobs[idx])] = (idx, est)
+                        in_use += est
+                        pending.pop(i)
+                        if est > self.budget_bytes:
+                            break
+                    else:
+                        i += 1
+
+                self.peak_bytes = max(self.peak_bytes, in_use)
+                self.peak_workers = max(self.peak_workers, len(running))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx, est = running.pop(future)
+                    in_use -= est
+                    yield jobs[idx], future.result()
@@ -0,0 +1,234 @@
+"""
+Compatibilidad con nnU-Net sin tocar site-packages.
+
+Sustituye a patch_gradscaler.py / create_final_split_json.py, que reescribían
+nnunetv2/training/nnUNetTrainer/nnUNetTrainer.py en el venv. Al importar este
+módulo:
+  1) se expone GradScaler donde lo busque la versión instalada de nnU-Net
+     (torch.GradScaler, torch.amp.GradScaler o torch.cuda.amp.GradScaler),
+     con la firma adecuada para el torch instalado;
+  2) se registran los trainers de este repo para que nnU-Net los encuentre
+     por nombre (-tr nnUNetTrainerCPUAmp) sin copiarlos dentro del paquete.
+
+Entrenamiento (mismos argumentos que nnUNetv2_train):
+  python nnunet_compat.py 1 2d 0 -tr nnUNetTrainerCPUAmp -device cpu
+  python nnunet_compat.py 1 2d 0 -tr nnUNetTrainerPatchBank -device cpu  (tras patch_bank.py)
+Varios folds a la vez en un nodo CPU: train_folds.py.
+"""
+import os
+from contextlib import nullcontext
+
+import torch
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+# Precisión mixta en CPU: "bfloat16" o None para desactivarla
+CPU_AMP_DTYPE = "bfloat16"
+# ============================
+
+
+def _resolve_grad_scaler():
+    """
+    Devuelve una clase GradScaler que acepta tanto GradScaler() como
+    GradScaler("cuda"), que es como la instancian las distintas versiones de
+    nnUNetTrainer.
+    """
+    amp_scaler = getattr(torch.amp, "GradScaler", None)
+    if amp_scaler is not None:
+        return amp_scaler  # torch >= 2.3: ya acepta el dispositivo como primer argumento
+
+    from torch.cuda.amp import GradScaler as CudaGradScaler
+
+    class CompatGradScaler(CudaGradScaler):
+        def __init__(self, *args, device="cuda", **kwargs):
+            # GradScaler("cuda"): el dispositivo llega como primer posicional
+            if args and isinstance(args[0], str):
+                args = args[1:]
+            super().__init__(*args, **kwargs)
+
+    return CompatGradScaler
+
+
+def install_grad_scaler_shim():
+    scaler = _resolve_grad_scaler()
+    if not hasattr(torch, "GradScaler"):
+        torch.GradScaler = scaler
+    if not hasattr(torch.amp, "GradScaler"):
+        torch.amp.GradScaler = scaler
+
+
+# Tiene que ir antes de cualquier import de nnunetv2
+install_grad_scaler_shim()
+
+from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer  # noqa: E402
+
+
+def cpu_autocast_dtype():
+    """dtype de autocast en CPU si está configurado y el hardware lo soporta."""
+    if CPU_AMP_DTYPE != "bfloat16":
+        return None
+    try:
+        supported = torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        supported = False
+    return torch.bfloat16 if supported else None
+
+
+class _AutocastForward(torch.nn.Module):
+    """Envuelve la red: forward con autocast en CPU y salidas de vuelta a float32."""
+
+    def __init__(self, network, dtype):
+        super().__init__()
+        self.network = network
+        self.dtype = dtype
+
+    def forward(self, x):
+        with torch.autocast("cpu", dtype=self.dtype):
+            output = self.network(x)
+        if isinstance(output, (list, tuple)):
+            return [o.float() for o in output]
+        return output.float()
+
+
+class nnUNetTrainerCPUAmp(nnUNetTrainer):
+    """
+    nnUNetTrainer con autocast bfloat16 en CPU (si el procesador lo soporta).
+    bfloat16 tiene el mismo rango que float32, así que no hace falta GradScaler.
+    En GPU se comporta igual que nnUNetTrainer.
+    """
+
+    def _cpu_autocast(self):
+        dtype = cpu_autocast_dtype() if self.device.type == "cpu" else None
+        if dtype is None:
+            return nullcontext()
+        return torch.autocast("cpu", dtype=dtype)
+
+    def train_step(self, batch: dict) -> dict:
+        if self.device.type != "cpu":
+            return super().train_step(batch)
+
+        data = batch["data"].to(self.device, non_blocking=True)
+        target = batch["target"]
+        if isinstance(target, list):
+            target = [t.to(self.device, non_blocking=True) for t in target]
+        else:
+            target = target.to(self.device, non_blocking=True)
+
+        self.optimizer.zero_grad(set_to_none=True)
+        with self._cpu_autocast():
+            output = self.network(data)
+        # La pérdida en float32 para no perder precisión en Dice/CE
+        if isinstance(output, (list, tuple)):
+            output = [o.float() for o in output]
+        else:
+            output = output.float()
+        loss = self.loss(output, target)
+
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+        self.optimizer.step()
+        return {"loss": loss.detach().cpu().numpy()}
+
+    def validation_step(self, batch: dict) -> dict:
+        dtype = cpu_autocast_dtype() if self.device.type == "cpu" else None
+        if dtype is None:
+            return super().validation_step(batch)
+        # Como en train_step: autocast solo en el forward, pérdida y métricas en float32
+        network = self.network
+        self.network = _AutocastForward(network, dtype)
+        try:
+            return super().validation_step(batch)
+        finally:
+            self.network = network
+
+
+class nnUNetTrainerPatchBank(nnUNetTrainerCPUAmp):
+    """
+    Entrena leyendo del banco de parches de patch_bank.py en vez de recortar y
+    aumentar cada muestra con batchgenerators. La validación usa el dataloader
+    normal de nnU-Net.
+    """
+
+    def get_dataloaders(self):
+        from patch_bank import PatchBankLoader, bank_dir_for, check_bank_meta
+
+        plans_name = self.plans_manager.plans_name
+        bank_dir = bank_dir_for(self.preprocessed_dataset_folder_base, plans_name, self.configuration_name, self.fold)
+        if not (bank_dir / "meta.json").exists():
+            raise FileNotFoundError(
+                f"No existe el banco de parches {bank_dir}. Genéralo antes con patch_bank.py "
+                f"(PLANS={plans_name}, CONFIGURATION={self.configuration_name}, FOLD={self.fold})."
+            )
+        check_bank_meta(bank_dir, plans_name, self.configuration_name, self.configuration_manager.patch_size, self.fold)
+
+        dl_train, dl_val = super().get_dataloaders()
+        if hasattr(dl_train, "_finish"):
+            dl_train._finish()  # no se usa: se sustituye por el banco
+
+        scales = self._get_deep_supervision_scales() if self.enable_deep_supervision else None
+        return PatchBankLoader(bank_dir, self.batch_size, deep_supervision_scales=scales), dl_val
+
+
+COMPAT_TRAINERS = {
+    "nnUNetTrainerCPUAmp": nnUNetTrainerCPUAmp,
+    "nnUNetTrainerPatchBank": nnUNetTrainerPatchBank,
+}
+
+
+def register_trainers(trainers):
+    """
+    Hace que nnU-Net resuelva los nombres de 'trainers' (dict nombre -> clase)
+    a nuestras clases, tanto al entrenar como al cargar un modelo para predecir.
+    """
+    COMPAT_TRAINERS.update(trainers)
+
+
+def install_trainer_lookup():
+    import nnunetv2.inference.predict_from_raw_data as predict_from_raw_data
+    import nnunetv2.run.run_training as run_training
+
+    for module in (run_training, predict_from_raw_data):
+        original = module.recursive_find_python_class
+        if getattr(original, "_compat_lookup", False):
+            continue
+
+        def find(folder, class_name, current_module, _original=original):
+            if class_name in COMPAT_TRAINERS:
+                return COMPAT_TRAINERS[class_name]
+            return _original(folder, class_name, current_module)
+
+        find._compat_lookup = True
+        module.recursive_find_python_class = find
+
+
+install_trainer_lookup()
+
+
+def install_thread_limit():
+    """
+    run_training fija torch.set_num_threads(multiprocessing.cpu_count()) en
+    CPU, ignorando la afinidad del proceso. Si OMP_NUM_THREADS está definido
+    (p.ej. por train_folds.py) se respeta como máximo.
+    """
+    limit = os.environ.get("OMP_NUM_THREADS")
+    if not limit or getattr(torch.set_num_threads, "_compat_limit", False):
+        return
+    original = torch.set_num_threads
+
+    def set_num_threads(n, _original=original, _limit=int(limit)):
+        _original(min(int(n), _limit))
+
+    set_num_threads._compat_limit = True
+    torch.set_num_threads = set_num_threads
+
+
+def main():
+    from nnunetv2.run.run_training import run_training_entry
+
+    install_thread_limit()
+    run_training_entry()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from nibabel import orientations
+from scipy import ndimage
+
+from verify_dataset import expected_case_files
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+DATASET = "Dataset001_MSLesSeg"
+
+TARGET_AXCODES = ("R", "A", "S")   # orientación canónica (la de nib.as_closest_canonical)
+TARGET_SPACING = None              # None: mediana del spacing de todos los casos
+SPACING_TOL = 0.01                 # diferencia relativa de spacing que se tolera sin remuestrear
+ORIGINALS_DIRNAME = "original_geometry"  # copia de los ficheros originales de los casos modificados
+TRANSFORMS_FILENAME = "geometry_transforms.json"
+NUM_WORKERS = 4
+# ============================
+
+
+def header_geometry(path):
+    """(ejes, spacing, shape) de un NIfTI leyendo solo la cabecera."""
+    img = nib.load(str(path))
+    return nib.aff2axcodes(img.affine), np.array(img.header.get_zooms()[:3], dtype=np.float64), img.shape[:3]
+
+
+def scan_dataset(dataset_root, dataset_json):
+    """Geometría de cabecera del canal 0 de cada caso: {case_id: (ejes, spacing, shape)}."""
+    cases = expected_case_files(dataset_root, dataset_json)
+    return {case_id: header_geometry(channels[0]) for case_id, _, channels, _ in cases}
+
+
+def plan_normalization(geometry, target_axcodes=TARGET_AXCODES, target_spacing=None, tol=SPACING_TOL):
+    """
+    Casos que necesitan reorientar y/o remuestrear. El spacing se compara
+    después de reorientar (los zooms se permutan con los ejes).
+    Devuelve (target_spacing, {case_id: {"reorient", "resample"}}).
+    """
+    target_ornt = orientations.axcodes2ornt(target_axcodes)
+    reoriented_zooms = {}
+    for case_id, (axcodes, zooms, _) in geometry.items():
+        ornt = orientations.ornt_transform(orientations.axcodes2ornt(axcodes), target_ornt)
+        reoriented_zooms[case_id] = zooms[np.argsort(ornt[:, 0])]
+
+    if target_spacing is None:
+        target_spacing = np.median(np.stack(list(reoriented_zooms.values())), axis=0)
+    target_spacing = np.asarray(target_spacing, dtype=np.float64)
+
+    plan = {}
+    for case_id, (axcodes, _, _) in geometry.items():
+        reorient = tuple(axcodes) != tuple(target_axcodes)
+        resample = bool(np.any(np.abs(reoriented_zooms[case_id] - target_spacing) > tol * target_spacing))
+        if reorient or resample:
+            plan[case_id] = {"reorient": reorient, "resample": resample}
+    return target_spacing, plan
+
+
+def resample_to_spacing(data, affine, zooms, target_spacing, order):
+    """
+    Remuestreo vectorizado con ndimage.affine_transform (diagonal): el vóxel
+    i nuevo corresponde al i * target/zooms original (mismo origen).
+    order=1 para imágenes, 0 para máscaras.
+    """
+    scale = np.asarray(target_spacing) / np.asarray(zooms)
+    new_shape = tuple(int(round(n / s)) for n, s in zip(data.shape, scale))
+    out = ndimage.affine_transform(data, scale, output_shape=new_shape, order=order, mode="nearest")
+    new_affine = affine.copy()
+    new_affine[:3, :3] = affine[:3, :3] * scale
+    return out, new_affine
+
+
+def normalize_file(path, target_axcodes, target_spacing, resample, is_label):
+    """Reorienta (permutación/flip, sin interpolar) y, si hace falta, remuestrea un fichero."""
+    img = nib.load(str(path))
+    ornt = orientations.ornt_transform(
+        orientations.io_orientation(img.affine), orientations.axcodes2ornt(target_axcodes)
+    )
+    img = img.as_reoriented(ornt)
+    data = np.asanyarray(img.dataobj)
+    affine = img.affine
+    scale = None
+    if resample:
+        zooms = img.header.get_zooms()[:3]
+        scale = (np.asarray(target_spacing) / np.asarray(zooms)).tolist()
+        data, affine = resample_to_spacing(
+            data.astype(np.float32), affine, zooms, target_spacing, order=0 if is_label else 1
+        )
+        if is_label:
+            data = data.astype(np.uint8)
+    out = nib.Nifti1Image(data, affine, header=img.header)
+    out.set_data_dtype(np.uint8 if is_label else img.get_data_dtype())
+    return out, ornt, scale
+
+
+def normalize_case(args):
+    """
+    Normaliza todos los ficheros de un caso; los originales se mueven a originals_dir.
+    Si ya hay alguna copia del caso en originals_dir no se toca nada y se
+    devuelve record None: la copia existente es la geometría original de verdad.
+    """
+    case_id, channel_paths, label_path, dataset_root, target_axcodes, target_spacing, resample = args
+    dataset_root = Path(dataset_root)
+    originals_dir = dataset_root / ORIGINALS_DIRNAME
+
+    paths = [(p, False) for p in channel_paths] + ([(label_path, True)] if label_path else [])
+    backups = [originals_dir / Path(p).relative_to(dataset_root) for p, _ in paths]
+    existing = [b for b in backups if b.exists()]
+    if existing:
+        print(f"  [AVISO] {case_id}: ya existe {existing[0]}, no se sobrescribe. Caso omitido.")
+        return case_id, None
+
+    record = None
+    for (path, is_label), backup in zip(paths, backups):
+        original = nib.load(str(path))
+        out, ornt, scale = normalize_file(path, target_axcodes, target_spacing, resample, is_label)
+
+        backup.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(path), str(backup))
+        nib.save(out, str(path))
+
+        if record is None:
+            record = {
+                "original_axcodes": list(nib.aff2axcodes(original.affine)),
+                "original_shape": [int(s) for s in original.shape[:3]],
+                "original_affine": original.affine.tolist(),
+                "ornt_transform": ornt.tolist(),
+                "resampled": bool(resample),
+                "resample_scale": scale,  # vóxel nuevo i -> i * scale en el volumen reorientado
+                "normalized_shape": [int(s) for s in out.shape[:3]],
+                "normalized_affine": out.affine.tolist(),
+            }
+    return case_id, record
+
+
+def to_original_geometry(data, record, is_label=True):
+    """
+    Lleva un array en la geometría normalizada (p.ej. una predicción) a la
+    geometría original del caso: deshace el remuestreo y después la reorientación.
+    """
+    ornt = np.array(record["ornt_transform"])
+    if record["resampled"]:
+        # forma reorientada antes de remuestrear = forma original permutada
+        reoriented_shape = tuple(np.array(record["original_shape"])[ornt[:, 0].astype(int).argsort()])
+        inverse = np.reciprocal(np.array(record["resample_scale"], dtype=np.float64))
+        data = ndimage.affine_transform(
+            data.astype(np.float32), inverse, output_shape=reoriented_shape, order=0 if is_label else 1, mode="nearest"
+        )
+    inverse_ornt = orientations.ornt_transform(
+        orientations.axcodes2ornt(TARGET_AXCODES), orientations.axcodes2ornt(record["original_axcodes"])
+    )
+    data = orientations.apply_orientation(data, inverse_ornt)
+    return data.astype(np.uint8) if is_label else data
+
+
+def map_prediction_back(pred_path, record, out_path):
+    """Guarda una predicción hecha sobre el caso normalizado en la geometría original."""
+    data = to_original_geometry(np.asanyarray(nib.load(str(pred_path)).dataobj), record)
+    img = nib.Nifti1Image(data, np.array(record["original_affine"]))
+    img.set_data_dtype(np.uint8)
+    nib.save(img, str(out_path))
+
+
+def main():
+    dataset_root = BASE_RAW / DATASET
+    with open(dataset_root / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+
+    print(f"Leyendo cabeceras de {dataset_root}...")
+    geometry = scan_dataset(dataset_root, dataset_json)
+    target_spacing, plan = plan_normalization(geometry, target_spacing=TARGET_SPACING)
+    n_reorient = sum(p["reorient"] for p in plan.values())
+    n_resample = sum(p["resample"] for p in plan.values())
+    print(f"  Spacing objetivo: {np.round(target_spacing, 4).tolist()} mm, ejes {''.join(TARGET_AXCODES)}")
+    print(f"  {len(geometry) - len(plan)} casos ya normalizados, {n_reorient} a reorientar, {n_resample} a remuestrear")
+
+    transforms_path = dataset_root / TRANSFORMS_FILENAME
+    transforms = {}
+    if transforms_path.exists():
+        with open(transforms_path, "r") as f:
+            transforms = json.load(f)
+
+    # Un caso con registro ya se normalizó: volver a hacerlo perdería su geometría original
+    already = sorted(c for c in plan if c in transforms)
+    if already:
+        print(f"[AVISO] {len(already)} casos ya tienen registro en {TRANSFORMS_FILENAME} y no se vuelven a "
+              f"normalizar (p.ej. {already[0]}). Restaura {ORIGINALS_DIRNAME}/ y borra su registro para rehacerlos.")
+
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    jobs = []
+    for case_id, _, channels, label in expected_case_files(dataset_root, dataset_json):
+        if case_id not in plan or case_id in transforms:
+            continue
+        if label is None:
+            # labelsTs no referenciadas en dataset.json (Dataset001)
+            label_ts = dataset_root / "labelsTs" / f"{case_id}{file_ending}"
+            label = label_ts if label_ts.exists() else None
+        jobs.append((case_id, channels, label, dataset_root, TARGET_AXCODES, target_spacing, plan[case_id]["resample"]))
+    n_done = 0
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        for case_id, record in pool.map(normalize_case, jobs):
+            if record is None:
+                continue
+            transforms[case_id] = record
+            n_done += 1
+            print(f"  {case_id}: {''.join(record['original_axcodes'])} -> {''.join(TARGET_AXCODES)}"
+                  f"{' + remuestreo' if record['resampled'] else ''}")
+
+    with open(transforms_path, "w") as f:
+        json.dump({k: v for k, v in sorted(transforms.items())}, f, indent=4)
+
+    print("\n========================================")
+    print(f" Casos modificados: {n_done} (originales en {dataset_root / ORIGINALS_DIRNAME})")
+    print(f" Transformaciones en: {transforms_path}")
+    print(" Usar map_prediction_back() para llevar predicciones a la geometría original")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,41 @@
 import json
 import random
+import sys
 from pathlib import Path
 
 import nibabel as nib
 import numpy as np
 
+# prepare_dataset002_splits.py está en la raíz del repo
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from json_stream import ListSpool, StreamingJSONWriter, save_splits_sidecar, splits_sidecar_path, write_splits  # noqa: E402
+from prepare_dataset002_splits import create_splits_dataset2, load_splits_dataset1  # noqa: E402
+
 
 # ============================
 # CONFIGURACIÓN
 # ============================
 BASE_RAW = "nnUNet_raw"
+BASE_PREPROCESSED = "nnUNet_preprocessed"
 DATASET1 = "Dataset001_MSLesSeg"
-DATASET2 = "Dataset002_MSLesSeg"
-NUM_SLICES = 10
+SLICE_INDEX_FILENAME = "slice_index.json"  # z original y affine 3D de cada slice
+SPLITS_FILENAME = "splits_final.json"
+JSON_INDENT = 4               # None: dataset.json / splits_final.json compactos
+WRITE_SPLITS_SIDECAR = False  # True: además splits_final.npz (binario)
+
+# Datasets 2D a generar en la misma pasada (cada caso 3D se decodifica una vez):
+#   name:       carpeta destino en nnUNet_raw
+#   num_slices: slices muestreadas por caso
+#   channels:   claves de channel_names de Dataset001 a conservar (None = todas)
+#   seed:       semilla del muestreo (None = aleatorio, como antes)
+VARIANTS = [
+    {"name": "Dataset002_MSLesSeg", "num_slices": 10, "channels": None, "seed": None},
+    # {"name": "Dataset003_MSLesSeg", "num_slices": 20, "channels": ["0"], "seed": 1},  # solo FLAIR
+]
 # ============================
 
 
 src_path = Path(BASE_RAW) / DATASET1
-dst_path = Path(BASE_RAW) / DATASET2
-
-# Crear carpetas destino
-(dst_path / "imagesTr").mkdir(parents=True, exist_ok=True)
-(dst_path / "labelsTr").mkdir(parents=True, exist_ok=True)
-(dst_path / "imagesTs").mkdir(parents=True, exist_ok=True)
-(dst_path / "labelsTs").mkdir(parents=True, exist_ok=True)
 
 # Cargar dataset.json original
 with open(src_path / "dataset.json", "r") as f:
@@ -31,9 +43,129 @@ with open(src_path / "dataset.json", "r") as f:
 
 file_ending = original_json.get("file_ending", ".nii.gz")
 
-# nº de canales según channel_names
+# claves de canal según channel_names
 channel_keys = sorted(original_json["channel_names"].keys(), key=lambda x: int(x))
-num_channels = len(channel_keys)
+
+
+class VariantWriter:
+    """
+    Estado de uno de los datasets 2D de salida: configuración, generador
+    aleatorio propio, entradas de dataset.json e índice de slices.
+    Las entradas training/test se vuelcan a disco según se generan
+    (json_stream.ListSpool), no se acumulan en memoria.
+    """
+
+    def __init__(self, config):
+        self.name = config["name"]
+        self.num_slices = config["num_slices"]
+        self.channels = config["channels"] or channel_keys  # claves de Dataset001
+        self.rng = random.Random(config["seed"])
+        self.dst_path = Path(BASE_RAW) / self.name
+
+        # Crear carpetas destino
+        for sub in ["imagesTr", "labelsTr", "imagesTs", "labelsTs"]:
+            (self.dst_path / sub).mkdir(parents=True, exist_ok=True)
+
+        self.training = ListSpool(self.dst_path / ".training.jsonl.tmp")
+        self.test = ListSpool(self.dst_path / ".test.jsonl.tmp")
+        # Índice de slices: para cada caso base, la z de cada slice extraída y la
+        # geometría 3D original, para poder reconstruir las predicciones 2D en 3D.
+        # Mismo formato que virtual_2d_dataset.build_slice_index.
+        self.slice_index = {
+            "source_dataset": DATASET1,
+            "file_ending": file_ending,
+            "cases": {},
+        }
+
+    def write_case(self, base_id, vols, affine, lbl_data, lbl_affine, subset):
+        """
+        Muestrea las slices de este dataset y guarda sus ficheros 2D.
+        vols: dict clave de canal de Dataset001 -> volumen (X, Y, Z) ya decodificado
+        """
+        shape = next(iter(vols.values())).shape
+        depth = shape[2]
+        slice_indices = self.rng.sample(range(depth), self.num_slices)
+
+        self.slice_index["cases"][base_id] = {
+            "subset": subset,
+            "has_label": lbl_data is not None,
+            "shape": [int(s) for s in shape[:3]],
+            "affine": affine.tolist(),
+            "slices": [int(sl) for sl in slice_indices],  # posición i -> slice_id {base_id}_{i+1:03d}
+        }
+
+        entries = self.training if subset == "Tr" else self.test
+
+        for i, sl in enumerate(slice_indices):
+            slice_number = f"{i + 1:03d}"
+            slice_id = f"{base_id}_{slice_number}"  # p.ej. P1_T1_001
+
+            # Guardar cada canal seleccionado como imagen 2D (renumerados 0000, 0001, ...)
+            for new_idx, ck in enumerate(self.channels):
+                slice_img = vols[ck][:, :, sl]
+                nii_slice = nib.Nifti1Image(slice_img.astype(np.float32), affine)
+                img_name = f"{slice_id}_{new_idx:04d}{file_ending}"
+                img_save_path = self.dst_path / f"images{subset}" / img_name
+                nib.save(nii_slice, img_save_path)
+
+            # Guardar máscara si existe
+            if lbl_data is not None:
+                slice_lbl = lbl_data[:, :, sl]
+                nii_lbl = nib.Nifti1Image(slice_lbl.astype(np.uint8), lbl_affine)
+                lbl_name = f"{slice_id}{file_ending}"
+                lbl_save_path = self.dst_path / f"labels{subset}" / lbl_name
+                nib.save(nii_lbl, lbl_save_path)
+
+                entries.append(
+                    {
+                        "image": f"./images{subset}/{slice_id}",
+                        "label": f"./labels{subset}/{slice_id}{file_ending}",
+                    }
+                )
+            else:
+                # solo imagen (test sin label en dataset.json)
+                entries.append(f"./images{subset}/{slice_id}")
+
+    def finish(self, splits1):
+        """Escribe dataset.json, el índice de slices y splits_final.json."""
+        new_json = original_json.copy()
+        new_json["tensorImageSize"] = "2D"
+        new_json["channel_names"] = {
+            str(new_idx): original_json["channel_names"][ck] for new_idx, ck in enumerate(self.channels)
+        }
+        new_json["numTraining"] = len(self.training)
+        new_json["numTest"] = len(self.test)
+        new_json["training"] = self.training
+        new_json["test"] = self.test
+
+        # Las listas training/test se copian entrada a entrada desde su fichero temporal
+        with StreamingJSONWriter(self.dst_path / "dataset.json", indent=JSON_INDENT) as w:
+            for key, value in new_json.items():
+                if key in ("training", "test"):
+                    w.begin_list(key)
+                    for entry in value:
+                        w.append(entry)
+                    w.end_list()
+                else:
+                    w.write(key, value)
+        self.training.discard()
+        self.test.discard()
+
+        with open(self.dst_path / SLICE_INDEX_FILENAME, "w") as f:
+            json.dump(self.slice_index, f, indent=4)
+
+        if splits1 is not None:
+            slice_mapping = {
+                base_id: [f"{base_id}_{i + 1:03d}" for i in range(len(info["slices"]))]
+                for base_id, info in self.slice_index["cases"].items()
+                if info["subset"] == "Tr"
+            }
+            splits_dir = Path(BASE_PREPROCESSED) / self.name
+            splits_dir.mkdir(parents=True, exist_ok=True)
+            splits2 = create_splits_dataset2(splits1, slice_mapping)
+            write_splits(splits_dir / SPLITS_FILENAME, splits2, indent=JSON_INDENT)
+            if WRITE_SPLITS_SIDECAR:
+                save_splits_sidecar(splits_sidecar_path(splits_dir / SPLITS_FILENAME), splits2)
 
 
 def extract_slices_case(
@@ -41,26 +173,25 @@ def extract_slices_case(
     channel_paths: list[Path],
     label_path: Path | None,
     subset: str,
+    writers: list[VariantWriter],
 ):
     """
     base_id: por ejemplo 'P1_T1'
     channel_paths: lista con paths a ..._0000.nii.gz, ..._0001.nii.gz, ...
     label_path: path a labelsTr/labelsTs correspondiente o None
     subset: 'Tr' o 'Ts'
+    writers: datasets 2D de salida; todos reutilizan la misma decodificación
     """
-    # Cargar todos los canales y apilarlos como 4D (X,Y,Z,C)
-    vols = []
+    # Cargar una sola vez los canales que use algún dataset de salida
+    needed = {ck for w in writers for ck in w.channels}
+    vols = {}
     affine = None
-    for p in channel_paths:
+    for ck, p in zip(channel_keys, channel_paths):
         nii = nib.load(str(p))
-        data = nii.get_fdata()
         if affine is None:
             affine = nii.affine
-        vols.append(data)
-    vols = np.stack(vols, axis=-1)  # (X, Y, Z, C)
-
-    depth = vols.shape[2]
-    slice_indices = random.sample(range(depth), NUM_SLICES)
+        if ck in needed:
+            vols[ck] = nii.get_fdata(dtype=np.float32)
 
     lbl_data = None
     lbl_affine = None
@@ -69,111 +200,85 @@ def extract_slices_case(
         lbl_data = lbl_nii.get_fdata()
         lbl_affine = lbl_nii.affine
 
-    entries = []
-
-    for i, sl in enumerate(slice_indices):
-        slice_number = f"{i + 1:03d}"
-        slice_id = f"{base_id}_{slice_number}"  # p.ej. P1_T1_001
-
-        # Guardar cada canal como imagen 2D
-        for c_idx in range(num_channels):
-            slice_img = vols[:, :, sl, c_idx]
-            nii_slice = nib.Nifti1Image(slice_img.astype(np.float32), affine)
-            img_name = f"{slice_id}_{int(c_idx):04d}{file_ending}"
-            img_save_path = dst_path / f"images{subset}" / img_name
-            nib.save(nii_slice, img_save_path)
-
-        # Guardar máscara si existe
-        if lbl_data is not None:
-            slice_lbl = lbl_data[:, :, sl]
-            nii_lbl = nib.Nifti1Image(slice_lbl.astype(np.uint8), lbl_affine)
-            lbl_name = f"{slice_id}{file_ending}"
-            lbl_save_path = dst_path / f"labels{subset}" / lbl_name
-            nib.save(nii_lbl, lbl_save_path)
-
-            entries.append(
-                {
-                    "image": f"./images{subset}/{slice_id}",
-                    "label": f"./labels{subset}/{slice_id}{file_ending}",
-                }
-            )
-        else:
-            # solo imagen (test sin label en dataset.json)
-            entries.append(f"./images{subset}/{slice_id}")
-
-    return entries
-
-
-# ============================
-# PROCESAR TRAINING
-# ============================
-print("Procesando TRAIN...")
-new_training = []
-
-for item in original_json["training"]:
-    # Base sin extensión ni canal: imagesTr/P1_T1
-    img_base_rel = item["image"].replace("./", "")  # imagesTr/P1_T1
-    base_id = Path(img_base_rel).name               # P1_T1
-
-    # Construir paths a todos los canales de entrada
-    channel_paths = []
-    for ck in channel_keys:
-        cidx = int(ck)
-        channel_rel = f"{img_base_rel}_{cidx:04d}{file_ending}"  # imagesTr/P1_T1_0000.nii.gz
-        channel_paths.append(src_path / channel_rel)
-
-    # Label 3D
-    lbl_rel = item["label"].replace("./", "")  # labelsTr/P1_T1.nii.gz
-    label_path = src_path / lbl_rel
-
-    new_training.extend(
-        extract_slices_case(base_id, channel_paths, label_path, subset="Tr")
-    )
-
-
-# ============================
-# PROCESAR TEST
-# ============================
-print("Procesando TEST...")
-new_test = []
-
-for img_entry in original_json["test"]:
-    img_base_rel = img_entry.replace("./", "")  # imagesTs/P10_T1
-    base_id = Path(img_base_rel).name           # P10_T1
-
-    # Canales de test
-    channel_paths = []
-    for ck in channel_keys:
-        cidx = int(ck)
-        channel_rel = f"{img_base_rel}_{cidx:04d}{file_ending}"  # imagesTs/P10_T1_0000.nii.gz
-        channel_paths.append(src_path / channel_rel)
-
-    # LabelTs (si existe)
-    label_filename = base_id + file_ending      # P10_T1.nii.gz
-    label_path = src_path / "labelsTs" / label_filename
-    if not label_path.exists():
-        label_path = None
-
-    new_test.extend(
-        extract_slices_case(base_id, channel_paths, label_path, subset="Ts")
-    )
-
-
-# ============================
-# NUEVO dataset.json 2D
-# ============================
-new_json = original_json.copy()
-new_json["tensorImageSize"] = "2D"
-new_json["numTraining"] = len(new_training)
-new_json["numTest"] = len(new_test)
-new_json["training"] = new_training
-new_json["test"] = new_test
-
-with open(dst_path / "dataset.json", "w") as f:
-    json.dump(new_json, f, indent=4)
-
-print("\n========================================")
-print(" Dataset002_MSLesSeg generado correctamente")
-print(" Slices 2D creados en imagesTr/labelsTr e imagesTs/labelsTs")
-print(" dataset.json actualizado a 2D")
-print("========================================")
\ No newline at end of file
+    for writer in writers:
+        writer.write_case(base_id, vols, affine, lbl_data, lbl_affine, subset)
+
+
+def main():
+    writers = [VariantWriter(config) for config in VARIANTS]
+    print("Datasets 2D a generar: " + ", ".join(
+        f"{w.name} ({w.num_slices} slices, canales {w.channels})" for w in writers
+    ))
+
+    # ============================
+    # PROCESAR TRAINING
+    # ============================
+    print("Procesando TRAIN...")
+
+    for item in original_json["training"]:
+        # Base sin extensión ni canal: imagesTr/P1_T1
+        img_base_rel = item["image"].replace("./", "")  # imagesTr/P1_T1
+        base_id = Path(img_base_rel).name               # P1_T1
+
+        # Construir paths a todos los canales de entrada
+        channel_paths = []
+        for ck in channel_keys:
+            cidx = int(ck)
+            channel_rel = f"{img_base_rel}_{cidx:04d}{file_ending}"  # imagesTr/P1_T1_0000.nii.gz
+            channel_paths.append(src_path / channel_rel)
+
+        # Label 3D
+        lbl_rel = item["label"].replace("./", "")  # labelsTr/P1_T1.nii.gz
+        label_path = src_path / lbl_rel
+
+        extract_slices_case(base_id, channel_paths, label_path, "Tr", writers)
+
+    # ============================
+    # PROCESAR TEST
+    # ============================
+    print("Procesando TEST...")
+
+    for img_entry in original_json["test"]:
+        img_base_rel = img_entry.replace("./", "")  # imagesTs/P10_T1
+        base_id = Path(img_base_rel).name           # P10_T1
+
+        # Canales de test
+        channel_paths = []
+        for ck in channel_keys:
+            cidx = int(ck)
+            channel_rel = f"{img_base_rel}_{cidx:04d}{file_ending}"  # imagesTs/P10_T1_0000.nii.gz
+            channel_paths.append(src_path / channel_rel)
+
+        # LabelTs (si existe)
+        label_filename = base_id + file_ending      # P10_T1.nii.gz
+        label_path = src_path / "labelsTs" / label_filename
+        if not label_path.exists():
+            label_path = None
+
+        extract_slices_case(base_id, channel_paths, label_path, "Ts", writers)
+
+    # ============================
+    # NUEVOS dataset.json 2D + splits
+    # ============================
+    try:
+        splits1 = load_splits_dataset1()
+    except FileNotFoundError as e:
+        print(f"[AVISO] {e}. No se generan {SPLITS_FILENAME}.")
+        splits1 = None
+
+    for writer in writers:
+        writer.finish(splits1)
+
+    print("\n========================================")
+    for writer in writers:
+        print(f" {writer.name} generado correctamente "
+              f"({len(writer.training)} train, {len(writer.test)} test slices)")
+    print(" Slices 2D creados en imagesTr/labelsTr e imagesTs/labelsTs")
+    print(" dataset.json actualizado a 2D")
+    print(f" Índice de slices (z y affine originales) en {SLICE_INDEX_FILENAME}")
+    print(f" {SPLITS_FILENAME} expandido en {BASE_PREPROCESSED}/<dataset>")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,11 @@ import shutil
 import json
 import random
 
+import nibabel as nib
+import numpy as np
+
+from trim_files_to_extract_slices_from_center import load_volume
+
 # Ruta donde tienes tus datos recortados y renombrados tipo CASEID_0000.nii.gz
 # con estructura algo como: MSLesSeg-Dataset_Original/train/...
 SOURCE_ROOT = "/Users/candeladavilamoreno/Documents/GitHub/DACIU/MSLesSeg-Dataset_Original"
@@ -26,6 +31,10 @@ CHANNEL_MAP = {
     "0002": "T2",
 }
 
+# Formatos que puede dejar trim_files_to_extract_slices_from_center.py (OUTPUT_FORMAT).
+# nnU-Net no lee .npy: esos casos se convierten a .nii sin comprimir al copiarlos.
+SOURCE_FILE_ENDINGS = (".nii.gz", ".nii", ".npy")
+
 def get_case_id_from_filename(filename):
     """
     A partir de un filename tipo 'P1_T1_0000.nii.gz' o 'P1_T1.nii.gz'
@@ -47,12 +56,24 @@ def get_patient_id(case_id):
     """
     return case_id.split("_")[0]
 
+def nnunet_file_ending(source_ending):
+    """Extensión con la que el caso queda en nnUNet_raw (.npy -> .nii)."""
+    return ".nii" if source_ending == ".npy" else source_ending
+
+def copy_volume(src_path, dst_path):
+    """Copia un volumen; los .npy (+ sidecar .json) se reconstruyen como NIfTI con load_volume."""
+    if src_path.endswith(".npy"):
+        data, affine, header = load_volume(src_path)
+        nib.save(nib.Nifti1Image(np.asarray(data), affine, header=header), dst_path)
+    else:
+        shutil.copy2(src_path, dst_path)
+
 def collect_cases(source_train_dir):
     """
     Recorre SOURCE_ROOT/train y encuentra todos los CASEID
-    que tienen al menos el canal 0000.
+    que tienen al menos el canal 0000 (en cualquiera de SOURCE_FILE_ENDINGS).
     Devuelve:
-      - cases: dict case_id -> info (dir, channels, label_path, patient_id)
+      - cases: dict case_id -> info (dir, channels, label_path, patient_id, file_ending)
       - patients: dict patient_id -> [case_ids]
     """
     cases = {}
@@ -60,7 +81,8 @@ def collect_cases(source_train_dir):
 
     for root, dirs, files in os.walk(source_train_dir):
         for f in files:
-            if f.endswith(".nii.gz") and "_0000.nii.gz" in f:
+            ending = next((e for e in SOURCE_FILE_ENDINGS if f.endswith("_0000" + e)), None)
+            if ending is not None:
                 case_id = get_case_id_from_filename(f)
                 patient_id = get_patient_id(case_id)
 
@@ -70,13 +92,13 @@ def collect_cases(source_train_dir):
                 # Construimos paths esperados
                 channels = {}
                 for ch_id in CHANNEL_MAP.keys():
-                    ch_filename = f"{case_id}_{ch_id}.nii.gz"
+                    ch_filename = f"{case_id}_{ch_id}{ending}"
                     ch_path = os.path.join(case_dir, ch_filename)
                     if os.path.exists(ch_path):
                         channels[ch_id] = ch_path
 
                 # Segmentación (MASK) esperada: CASEID.nii.gz
-                label_filename = f"{case_id}.nii.gz"
+                label_filename = f"{case_id}{ending}"
                 label_path = os.path.join(case_dir, label_filename)
                 if not os.path.exists(label_path):
                     print(f"[AVISO] No se encontró máscara para {case_id} en {label_path}. Este caso se ignora.")
@@ -87,6 +109,7 @@ def collect_cases(source_train_dir):
                     "channels": channels,
                     "label": label_path,
                     "patient_id": patient_id,
+                    "file_ending": ending,
                 }
 
                 patients.setdefault(patient_id, []).append(case_id)
@@ -138,20 +161,19 @@ def copy_case_to_nnUNet(case_id, case_info, images_dir, labels_dir=None):
     Copia los canales de un caso (0000,0001,0002) a images_dir.
     Si labels_dir no es None, también copia la máscara CASEID.nii.gz ahí.
     """
+    file_ending = nnunet_file_ending(case_info["file_ending"])
+
     # Canales
     for ch_id, src_path in case_info["channels"].items():
-        base_name = os.path.basename(src_path)  # P1_T1_0000.nii.gz
-        dst_path = os.path.join(images_dir, base_name)
-        shutil.copy2(src_path, dst_path)
+        dst_path = os.path.join(images_dir, f"{case_id}_{ch_id}{file_ending}")  # P1_T1_0000.nii.gz
+        copy_volume(src_path, dst_path)
 
     # Máscara
     if labels_dir is not None and case_info["label"] is not None:
-        label_src = case_info["label"]
-        label_name = os.path.basename(label_src)  # P1_T1.nii.gz
-        label_dst = os.path.join(labels_dir, label_name)
-        shutil.copy2(label_src, label_dst)
+        label_dst = os.path.join(labels_dir, f"{case_id}{file_ending}")  # P1_T1.nii.gz
+        copy_volume(case_info["label"], label_dst)
 
-def build_dataset_json(dataset_root, train_case_ids, test_case_ids):
+def build_dataset_json(dataset_root, train_case_ids, test_case_ids, file_ending=".nii.gz"):
     """
     Crea dataset.json en dataset_root con la información de canales y labels.
     train_case_ids y test_case_ids son listas de CASEID (strings).
@@ -171,7 +193,7 @@ def build_dataset_json(dataset_root, train_case_ids, test_case_ids):
     for case_id in sorted(train_case_ids):
         training_entries.append({
             "image": f"./imagesTr/{case_id}",
-            "label": f"./labelsTr/{case_id}.nii.gz"
+            "label": f"./labelsTr/{case_id}{file_ending}"
         })
 
     test_entries = [f"./imagesTs/{case_id}" for case_id in sorted(test_case_ids)]
@@ -187,6 +209,7 @@ def build_dataset_json(dataset_root, train_case_ids, test_case_ids):
         "labels": labels,
         "numTraining": len(train_case_ids),
         "numTest": len(test_case_ids),
+        "file_ending": file_ending,
         "training": training_entries,
         "test": test_entries
     }
@@ -203,6 +226,10 @@ def main():
 
     # 1) Recoger casos y pacientes
     cases, patients = collect_cases(source_train_dir)
+    source_endings = {info["file_ending"] for info in cases.values()}
+    if len(source_endings) > 1:
+        raise ValueError(f"Casos con formatos distintos en {source_train_dir}: {sorted(source_endings)}")
+    file_ending = nnunet_file_ending(source_endings.pop()) if source_endings else ".nii.gz"
 
     # 2) Dividir pacientes en train/val y test externo
     trainval_patients, test_patients = split_patients(patients, num_test=13, seed=42)
@@ -231,7 +258,7 @@ def main():
     print(f"Total casos TEST externo (con máscara copiada a labelsTs): {len(test_case_ids)}")
 
     # 6) Construir dataset.json
-    build_dataset_json(dataset_root, train_case_ids, test_case_ids)
+    build_dataset_json(dataset_root, train_case_ids, test_case_ids, file_ending)
 
     print("\n✅ Todo listo. Ahora puedes ejecutar:")
     print(f"  nnUNetv2_plan_and_preprocess -d {DATASET_ID} --verify_dataset_integrity")
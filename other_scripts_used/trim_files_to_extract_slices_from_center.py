@@ -1,7 +1,16 @@
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import nibabel as nib
 import numpy as np
 
+# memory_scheduler.py está en la raíz del repo
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from memory_scheduler import MemoryBudgetScheduler, estimate_case_bytes  # noqa: E402
+
 # Directorio origen con las resonancias originales (.nii.gz)
 SOURCE_ROOT = "/Volumes/MB_Candela/DACIU"  # train/test aquí
 
@@ -24,6 +33,31 @@ CHANNEL_IDS = {
     # MASK no va aquí porque es la segmentación (label), no un canal de entrada
 }
 
+# Formato de la copia "caliente" (la que leen las etapas siguientes):
+#   "nii.gz": NIfTI comprimido (comportamiento original, no se puede hacer memmap)
+#   "nii":    NIfTI sin comprimir, se abre con nib.load(..., mmap=True)
+#   "npy":    array crudo .npy + sidecar .json con affine y cabecera (np.load(..., mmap_mode="r"))
+# dataset_preparation_for_training.py acepta los tres: .nii.gz/.nii se copian tal cual
+# y .npy se convierte a .nii con load_volume (file_ending del dataset.json en consecuencia)
+OUTPUT_FORMAT = "nii.gz"
+
+# Copia "fría" comprimida (.nii.gz) para archivo, escrita en segundo plano.
+# Solo se usa si OUTPUT_FORMAT != "nii.gz". None -> no se genera.
+ARCHIVE_ROOT = DEST_ROOT + "_archive"
+ARCHIVE_WORKERS = 2
+
+# Casos en paralelo con presupuesto de memoria (memory_scheduler.py).
+# NUM_WORKERS = 1 -> secuencial, con la copia de archivo en segundo plano (ARCHIVE_WORKERS).
+# NUM_WORKERS > 1 -> cada worker escribe su copia de archivo de forma síncrona (sin archiver),
+#   así que con OUTPUT_FORMAT != "nii.gz" solo compensa si hay núcleos y memoria de sobra.
+# MEMORY_BUDGET_GB = None -> 70% de la RAM disponible.
+NUM_WORKERS = 1
+MEMORY_BUDGET_GB = None
+# Volúmenes float64 vivos a la vez en process_case: FLAIR + modalidad actual + recorte float32.
+# Las modalidades y la MASK se procesan de una en una, así que la estimación es
+# (vóxeles del mayor fichero del caso, FLAIR, T1, T2 o MASK) × 8 bytes × RESIDENT_VOLUMES
+RESIDENT_VOLUMES = 3
+
 def crop_along_z(data, affine, z_start, z_end):
     """
     Recorta el volumen 'data' en el eje Z (última dimensión) entre
@@ -41,7 +75,74 @@ def crop_along_z(data, affine, z_start, z_end):
 
     return cropped, new_affine
 
-def process_case(case_id, modality_paths, dest_dir):
+def _report_archive_error(future):
+    exc = future.exception()
+    if exc is not None:
+        print(f"  [AVISO] Falló la escritura de una copia de archivo: {exc}")
+
+def save_volume(data, affine, header, out_base, archive_base=None, archiver=None):
+    """
+    Guarda un volumen en el formato OUTPUT_FORMAT.
+    out_base: ruta de salida sin extensión (p.ej. .../P1_T1_0000)
+    archive_base: ruta sin extensión para la copia .nii.gz de archivo (o None)
+    archiver: ThreadPoolExecutor donde se encola la compresión de la copia de archivo
+    Devuelve la ruta de la copia caliente.
+    """
+    img = nib.Nifti1Image(data, affine, header=header)
+
+    if OUTPUT_FORMAT == "nii.gz":
+        out_path = out_base + ".nii.gz"
+        nib.save(img, out_path)
+        return out_path
+
+    if OUTPUT_FORMAT == "nii":
+        out_path = out_base + ".nii"
+        nib.save(img, out_path)
+    elif OUTPUT_FORMAT == "npy":
+        out_path = out_base + ".npy"
+        np.save(out_path, np.ascontiguousarray(data))
+        sidecar = {
+            "shape": list(data.shape),
+            "dtype": str(data.dtype),
+            "affine": np.asarray(affine).tolist(),
+            "zooms": [float(z) for z in img.header.get_zooms()],
+            # cabecera NIfTI completa (348 bytes) para poder reconstruirla tal cual
+            "header": img.header.binaryblock.hex(),
+        }
+        with open(out_base + ".json", "w") as f:
+            json.dump(sidecar, f, indent=4)
+    else:
+        raise ValueError(f"OUTPUT_FORMAT desconocido: {OUTPUT_FORMAT}")
+
+    if archive_base is not None:
+        os.makedirs(os.path.dirname(archive_base), exist_ok=True)
+        if archiver is not None:
+            # zlib libera el GIL, así que la compresión no bloquea el recorte del siguiente caso
+            future = archiver.submit(nib.save, img, archive_base + ".nii.gz")
+            future.add_done_callback(_report_archive_error)
+        else:
+            nib.save(img, archive_base + ".nii.gz")
+
+    return out_path
+
+def load_volume(path):
+    """
+    Carga un volumen guardado por save_volume sin descomprimir nada:
+      - .npy: memmap de solo lectura + affine del sidecar
+      - .nii: memmap vía nibabel
+      - .nii.gz: decodificación completa (copia de archivo)
+    Devuelve (data, affine, header).
+    """
+    if path.endswith(".npy"):
+        with open(path[:-4] + ".json", "r") as f:
+            sidecar = json.load(f)
+        header = nib.Nifti1Header(binaryblock=bytes.fromhex(sidecar["header"]))
+        return np.load(path, mmap_mode="r"), np.array(sidecar["affine"]), header
+
+    img = nib.load(path, mmap=True)
+    return np.asanyarray(img.dataobj), img.affine, img.header
+
+def process_case(case_id, modality_paths, dest_dir, archive_dir=None, archiver=None):
     """
     Recorta el 80% central en Z para todas las modalidades disponibles
     y guarda los ficheros siguiendo el formato de nnU-Net:
@@ -52,6 +153,8 @@ def process_case(case_id, modality_paths, dest_dir):
     case_id: identificador del caso (por ejemplo 'P1_T1' o 'P54')
     modality_paths: dict modalidad -> ruta .nii.gz original
     dest_dir: carpeta de salida para este caso
+    archive_dir: carpeta para la copia comprimida de archivo (o None)
+    archiver: ThreadPoolExecutor para escribir la copia de archivo en segundo plano
     """
     print(f"\nProcesando caso '{case_id}' con modalidades:")
     for m, p in modality_paths.items():
@@ -63,6 +166,12 @@ def process_case(case_id, modality_paths, dest_dir):
     affine_ref = flair_img.affine
     header_ref = flair_img.header
 
+    # El recorte asume que el tercer eje del array es el axial (S/I)
+    axcodes = nib.aff2axcodes(affine_ref)
+    if axcodes[2] not in ("S", "I"):
+        print(f"  [AVISO] Orientación {''.join(axcodes)}: el eje 3 no es axial, el recorte en Z no sería superior-inferior. "
+              "Normaliza la orientación antes (normalize_geometry.py).")
+
     nz = flair_data.shape[2]
     z_start = int(0.10 * nz)
     z_end   = int(0.90 * nz)
@@ -92,11 +201,15 @@ def process_case(case_id, modality_paths, dest_dir):
         cropped_data, new_affine = crop_along_z(data, affine, z_start, z_end)
 
         channel_id = CHANNEL_IDS[modality]
-        out_name = f"{case_id}_{channel_id}.nii.gz"
-        out_path = os.path.join(dest_dir, out_name)
-
-        out_img = nib.Nifti1Image(cropped_data.astype(np.float32), new_affine, header=header)
-        nib.save(out_img, out_path)
+        out_name = f"{case_id}_{channel_id}"
+        out_path = save_volume(
+            cropped_data.astype(np.float32),
+            new_affine,
+            header,
+            os.path.join(dest_dir, out_name),
+            os.path.join(archive_dir, out_name) if archive_dir else None,
+            archiver,
+        )
         print(f"    Guardado canal {modality} en: {out_path}")
 
     # 2) Guardar segmentación (MASK) si existe
@@ -115,17 +228,25 @@ def process_case(case_id, modality_paths, dest_dir):
             # Aseguramos que la segmentación sea un mapa entero (0,1,2,...) como exige nnU-Net
             cropped_mask_int = np.rint(cropped_mask).astype(np.uint8)
 
-            out_name = f"{case_id}.nii.gz"  # sin sufijo de canal
-            out_path = os.path.join(dest_dir, out_name)
-
-            out_mask_img = nib.Nifti1Image(cropped_mask_int, new_affine_mask, header=header)
-            nib.save(out_mask_img, out_path)
+            out_name = case_id  # sin sufijo de canal
+            out_path = save_volume(
+                cropped_mask_int,
+                new_affine_mask,
+                header,
+                os.path.join(dest_dir, out_name),
+                os.path.join(archive_dir, out_name) if archive_dir else None,
+                archiver,
+            )
             print(f"    Guardada MASK (segmentación) en: {out_path}")
     else:
         print("  [INFO] No hay MASK para este caso, solo se han guardado las imágenes de entrada.")
 
-def main():
-    os.makedirs(DEST_ROOT, exist_ok=True)
+def collect_jobs(use_archive):
+    """
+    Recorre SOURCE_ROOT (train y test) y devuelve los argumentos de
+    process_case para cada caso: (case_id, modality_paths, dest_dir, archive_dir).
+    """
+    jobs = []
 
     # Recorremos tanto train como test
     for split in ["train", "test"]:
@@ -135,14 +256,11 @@ def main():
             print(f"[AVISO] No existe {source_split_dir}, se omite.")
             continue
 
-        print(f"\n=== Procesando split: {split} ===")
-
         for root, dirs, files in os.walk(source_split_dir):
             flair_suffix = MODALITY_SUFFIXES["FLAIR"]
             flair_files = [f for f in files if f.endswith(flair_suffix)]
 
             for flair_file in flair_files:
-                flair_path = os.path.join(root, flair_file)
                 # CASE_IDENTIFIER: nombre base sin sufijo de modalidad
                 case_id = flair_file[:-len(flair_suffix)]  # quita "_FLAIR.nii.gz"
 
@@ -164,7 +282,38 @@ def main():
                 case_dest_dir = os.path.join(DEST_ROOT, rel_root)
                 os.makedirs(case_dest_dir, exist_ok=True)
 
-                process_case(case_id, modality_paths, case_dest_dir)
+                case_archive_dir = os.path.join(ARCHIVE_ROOT, rel_root) if use_archive else None
+
+                jobs.append((case_id, modality_paths, case_dest_dir, case_archive_dir))
+
+    return jobs
+
+def main():
+    os.makedirs(DEST_ROOT, exist_ok=True)
+
+    use_archive = OUTPUT_FORMAT != "nii.gz" and ARCHIVE_ROOT is not None
+    jobs = collect_jobs(use_archive)
+    print(f"\n=== {len(jobs)} casos a procesar ===")
+
+    if NUM_WORKERS > 1:
+        # Cada worker escribe su copia de archivo de forma síncrona (sin archiver)
+        estimates = [estimate_case_bytes(list(job[1].values()), resident_volumes=RESIDENT_VOLUMES) for job in jobs]
+        budget = int(MEMORY_BUDGET_GB * 1024 ** 3) if MEMORY_BUDGET_GB is not None else None
+        scheduler = MemoryBudgetScheduler(budget, max_workers=NUM_WORKERS)
+        print(f"Presupuesto de memoria: {scheduler.budget_bytes / 1024 ** 3:.1f} GB, hasta {NUM_WORKERS} casos a la vez")
+        for _ in scheduler.run(process_case, jobs, estimates):
+            pass
+        print(f"Pico estimado: {scheduler.peak_bytes / 1024 ** 3:.1f} GB con {scheduler.peak_workers} casos en paralelo")
+    else:
+        archiver = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) if use_archive else None
+        for job in jobs:
+            process_case(*job, archiver)
+
+        if archiver is not None:
+            print("\nEsperando a que terminen las copias comprimidas de archivo...")
+            archiver.shutdown(wait=True)
+    if use_archive:
+        print("Copias .nii.gz de archivo guardadas en:", ARCHIVE_ROOT)
 
     print("\n Proceso completado. Volúmenes recortados y renombrados guardados en:", DEST_ROOT)
 
@@ -0,0 +1,284 @@
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+DATASET = "Dataset001_MSLesSeg"
+PLANS = "nnUNetPlans"
+CONFIGURATION = "2d"
+FOLD = 0
+
+PATCHES_PER_CASE = 250
+FOREGROUND_PERCENT = 0.33   # igual que oversample_foreground_percent de nnU-Net
+BANK_DTYPE = "float16"      # float16 reduce a la mitad el tamaño del banco
+SEED = 42
+NUM_WORKERS = 4
+# ============================
+
+
+def bank_dir_for(preprocessed_dataset_dir, plans_name, configuration, fold):
+    """
+    Carpeta del banco. Va por plans y configuración, no por data_identifier:
+    unos plans ajustados (tune_plans_cpu.py) comparten data_identifier pero
+    cambian patch_size.
+    """
+    return Path(preprocessed_dataset_dir) / f"patchbank_{plans_name}_{configuration}_fold{fold}"
+
+
+def check_bank_meta(bank_dir, plans_name, configuration, patch_size, fold):
+    """Lee meta.json y comprueba que el banco se hizo para estos plans/configuración/patch/fold."""
+    with open(Path(bank_dir) / "meta.json", "r") as f:
+        meta = json.load(f)
+    expected = {
+        "plans": plans_name,
+        "configuration": configuration,
+        "patch_size": [int(p) for p in patch_size],
+        "fold": fold,
+    }
+    mismatched = {k: (meta.get(k), v) for k, v in expected.items() if meta.get(k) != v}
+    if mismatched:
+        details = ", ".join(f"{k}: banco {got} != entrenamiento {want}" for k, (got, want) in mismatched.items())
+        raise ValueError(f"El banco de parches {bank_dir} no corresponde a este entrenamiento ({details}). "
+                         "Regenéralo con patch_bank.py.")
+    return meta
+
+
+def load_preprocessed_case(data_dir, case_id):
+    """
+    Carga un caso preprocesado por nnU-Net: (data (C, Z, Y, X), seg (1, Z, Y, X), properties).
+    Usa los .npy desempaquetados (memmap) si existen; si no, el .npz.
+    """
+    data_dir = Path(data_dir)
+    npy = data_dir / f"{case_id}.npy"
+    if npy.exists():
+        data = np.load(npy, mmap_mode="r")
+        seg = np.load(data_dir / f"{case_id}_seg.npy", mmap_mode="r")
+    else:
+        with np.load(data_dir / f"{case_id}.npz") as npz:
+            data, seg = npz["data"], npz["seg"]
+    with open(data_dir / f"{case_id}.pkl", "rb") as f:
+        properties = pickle.load(f)
+    return data, seg, properties
+
+
+def foreground_locations(seg, properties):
+    """
+    Coordenadas (N, 4) [canal, z, y, x] de vóxeles de lesión. Se reutilizan las
+    class_locations que nnU-Net ya guarda en el .pkl; si no están, se calculan.
+    """
+    locations = properties.get("class_locations") or {}
+    coords = [np.asarray(v) for k, v in locations.items() if int(k) > 0 and len(v)]
+    if coords:
+        return np.concatenate(coords)
+    return np.argwhere(seg > 0)
+
+
+def crop_with_padding(array, starts, patch_size):
+    """
+    Recorta array[:, starts:starts+patch] en los ejes espaciales finales,
+    rellenando con 0 lo que caiga fuera del volumen.
+    """
+    lead = array.ndim - len(patch_size)
+    out = np.zeros(array.shape[:lead] + tuple(patch_size), dtype=array.dtype)
+    src, dst = [slice(None)] * lead, [slice(None)] * lead
+    for start, size, dim in zip(starts, patch_size, array.shape[lead:]):
+        lo, hi = max(start, 0), min(start + size, dim)
+        src.append(slice(lo, hi))
+        dst.append(slice(lo - start, hi - start))
+    out[tuple(dst)] = array[tuple(src)]
+    return out
+
+
+def sample_case_patches(data, seg, properties, patch_size, n_patches, rng, fg_percent=FOREGROUND_PERCENT):
+    """
+    Extrae n_patches parches de un caso. Una fracción fg_percent se centra en
+    vóxeles de lesión y el resto en posiciones aleatorias. Con patch 2D sobre
+    datos 3D se elige primero la slice z y se recorta en el plano.
+    """
+    is_2d = len(patch_size) == 2
+    spatial = data.shape[1:]
+    fg = foreground_locations(seg, properties)
+
+    images = np.empty((n_patches, data.shape[0], *patch_size), dtype=np.float32)
+    labels = np.empty((n_patches, 1, *patch_size), dtype=np.int8)
+
+    n_fg = int(round(n_patches * fg_percent)) if len(fg) else 0
+    for i in range(n_patches):
+        if i < n_fg:
+            center = fg[rng.integers(len(fg))][1:]
+        else:
+            center = [rng.integers(s) for s in spatial]
+
+        if is_2d:
+            z = int(center[0])
+            starts = [int(c) - p // 2 for c, p in zip(center[1:], patch_size)]
+            images[i] = crop_with_padding(data[:, z], starts, patch_size)
+            labels[i] = crop_with_padding(seg[:, z], starts, patch_size)
+        else:
+            starts = [int(c) - p // 2 for c, p in zip(center, patch_size)]
+            images[i] = crop_with_padding(data, starts, patch_size)
+            labels[i] = crop_with_padding(seg, starts, patch_size)
+
+    # nnU-Net marca con -1 lo que queda fuera de la máscara de normalización
+    np.maximum(labels, 0, out=labels)
+    return images, labels
+
+
+def _fill_case(args):
+    data_dir, bank_dir, case_id, offset, patch_size, n_patches, seed = args
+    data, seg, properties = load_preprocessed_case(data_dir, case_id)
+    rng = np.random.default_rng(seed)
+    images, labels = sample_case_patches(data, seg, properties, patch_size, n_patches, rng)
+
+    bank_images = np.load(Path(bank_dir) / "images.npy", mmap_mode="r+")
+    bank_labels = np.load(Path(bank_dir) / "labels.npy", mmap_mode="r+")
+    bank_images[offset:offset + n_patches] = images.astype(bank_images.dtype)
+    bank_labels[offset:offset + n_patches] = labels
+    bank_images.flush()
+    bank_labels.flush()
+    return case_id, int((labels > 0).any(axis=tuple(range(1, labels.ndim))).sum())
+
+
+def build_patch_bank(preprocessed_dataset_dir, plans_name, configuration, fold,
+                     patches_per_case=PATCHES_PER_CASE, seed=SEED, num_workers=NUM_WORKERS):
+    """
+    Construye el banco de parches de los casos de entrenamiento de un fold:
+      images.npy (N, C, *patch) BANK_DTYPE, labels.npy (N, 1, *patch) int8, meta.json
+    Los .npy se reservan con open_memmap y cada worker escribe su rango.
+    """
+    preprocessed_dataset_dir = Path(preprocessed_dataset_dir)
+    with open(preprocessed_dataset_dir / f"{plans_name}.json", "r") as f:
+        plans = json.load(f)
+    with open(preprocessed_dataset_dir / "splits_final.json", "r") as f:
+        splits = json.load(f)
+    with open(preprocessed_dataset_dir / "dataset.json", "r") as f:
+        num_channels = len(json.load(f)["channel_names"])
+
+    config = plans["configurations"][configuration]
+    patch_size = tuple(config["patch_size"])
+    data_dir = preprocessed_dataset_dir / config["data_identifier"]
+    bank_dir = bank_dir_for(preprocessed_dataset_dir, plans_name, configuration, fold)
+    bank_dir.mkdir(parents=True, exist_ok=True)
+
+    train_cases = sorted(splits[fold]["train"])
+    n_total = len(train_cases) * patches_per_case
+    np.lib.format.open_memmap(
+        bank_dir / "images.npy", mode="w+", dtype=BANK_DTYPE, shape=(n_total, num_channels, *patch_size)
+    )
+    np.lib.format.open_memmap(
+        bank_dir / "labels.npy", mode="w+", dtype=np.int8, shape=(n_total, 1, *patch_size)
+    )
+
+    jobs = [
+        (data_dir, bank_dir, case_id, i * patches_per_case, patch_size, patches_per_case, seed + i)
+        for i, case_id in enumerate(train_cases)
+    ]
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        fg_counts = dict(pool.map(_fill_case, jobs))
+
+    meta = {
+        "plans": plans_name,
+        "configuration": configuration,
+        "fold": fold,
+        "patch_size": list(patch_size),
+        "num_patches": n_total,
+        "patches_per_case": patches_per_case,
+        "cases": train_cases,
+        "foreground_patches": int(sum(fg_counts.values())),
+    }
+    with open(bank_dir / "meta.json", "w") as f:
+        json.dump(meta, f, indent=4)
+    return bank_dir, meta
+
+
+class PatchBankLoader:
+    """
+    Dataloader de entrenamiento que lee batches aleatorios del banco (memmap)
+    y aplica aumentos baratos vectorizados sobre el batch entero:
+      - flips aleatorios por eje espacial
+      - jitter de intensidad (escala y desplazamiento por muestra y canal)
+    Devuelve dicts {"data", "target"} como los dataloaders de nnU-Net; si se
+    pasan deep_supervision_scales, "target" es la lista de segmentaciones
+    submuestreadas que espera la pérdida con deep supervision.
+    """
+
+    def __init__(self, bank_dir, batch_size, deep_supervision_scales=None, flip=True,
+                 intensity_scale=0.1, intensity_shift=0.1, seed=None):
+        self.images = np.load(Path(bank_dir) / "images.npy", mmap_mode="r")
+        self.labels = np.load(Path(bank_dir) / "labels.npy", mmap_mode="r")
+        self.batch_size = batch_size
+        self.deep_supervision_scales = deep_supervision_scales
+        self.flip = flip
+        self.intensity_scale = intensity_scale
+        self.intensity_shift = intensity_shift
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.images) // self.batch_size
+
+    def _augment(self, data, seg):
+        n = data.shape[0]
+        if self.flip:
+            for axis in range(2, data.ndim):
+                mask = self.rng.random(n) < 0.5
+                if mask.any():
+                    data[mask] = np.flip(data[mask], axis=axis)
+                    seg[mask] = np.flip(seg[mask], axis=axis)
+
+        if self.intensity_scale or self.intensity_shift:
+            shape = (n, data.shape[1]) + (1,) * (data.ndim - 2)
+            data *= self.rng.uniform(1 - self.intensity_scale, 1 + self.intensity_scale, shape).astype(np.float32)
+            data += self.rng.normal(0, self.intensity_shift, shape).astype(np.float32)
+        return data, seg
+
+    def _targets(self, seg):
+        import torch
+
+        if self.deep_supervision_scales is None:
+            return torch.from_numpy(seg)
+        targets = []
+        for scales in self.deep_supervision_scales:
+            steps = [max(int(round(1 / s)), 1) for s in scales]
+            sl = (slice(None), slice(None)) + tuple(slice(None, None, st) for st in steps)
+            targets.append(torch.from_numpy(np.ascontiguousarray(seg[sl])))
+        return targets
+
+    def __next__(self):
+        import torch
+
+        # índices ordenados: lecturas del memmap más secuenciales
+        idx = np.sort(self.rng.choice(len(self.images), self.batch_size, replace=False))
+        data = np.asarray(self.images[idx], dtype=np.float32)
+        seg = np.asarray(self.labels[idx], dtype=np.float32)
+        data, seg = self._augment(data, seg)
+        return {"data": torch.from_numpy(np.ascontiguousarray(data)), "target": self._targets(seg)}
+
+    def _finish(self):
+        # nnUNetTrainer.on_train_end lo llama para cerrar los augmenters
+        pass
+
+
+def main():
+    dataset_dir = BASE_PREPROCESSED / DATASET
+    print(f"Construyendo banco de parches {CONFIGURATION} (fold {FOLD}, {PATCHES_PER_CASE} parches/caso)...")
+    bank_dir, meta = build_patch_bank(dataset_dir, PLANS, CONFIGURATION, FOLD)
+
+    print("\n========================================")
+    print(f" Banco de parches en: {bank_dir}")
+    print(f" Parches: {meta['num_patches']} de {len(meta['cases'])} casos, patch={meta['patch_size']}")
+    print(f" Parches con lesión: {meta['foreground_patches']}")
+    print(f" Entrenar con: python nnunet_compat.py {DATASET} {CONFIGURATION} {FOLD} -tr nnUNetTrainerPatchBank")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
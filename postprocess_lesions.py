@@ -0,0 +1,223 @@
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from evaluate_predictions import CONNECTIVITY, lesion_scores
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+BASE_RESULTS = Path("nnUNet_results")
+DATASET = "Dataset001_MSLesSeg"
+CONFIGURATION = "3d_fullres"
+TRAINER = "nnUNetTrainer"
+PLANS = "nnUNetPlans"
+MODEL_DIR = BASE_RESULTS / DATASET / f"{TRAINER}__{PLANS}__{CONFIGURATION}"
+
+# Probabilidades de validación: fold_X/validation/<case>.npz (nnUNetv2_train ... --npz)
+LESION_CHANNEL = 1
+THRESHOLDS = [0.3, 0.4, 0.5, 0.6, 0.7]
+MIN_SIZES_MM3 = [0, 3, 5, 10, 20, 50]
+OBJECTIVE = "lesion_f1"     # métrica media a maximizar; desempate por dice
+CACHE_DIRNAME = "postprocessing_cache"   # dentro de model_dir
+OUTPUT_JSON = MODEL_DIR / "lesion_postprocessing.json"
+NUM_WORKERS = 4
+# ============================
+
+
+def label_components(mask):
+    """Componentes conexas (misma conectividad que evaluate_predictions) y su tamaño en vóxeles."""
+    structure = ndimage.generate_binary_structure(mask.ndim, CONNECTIVITY)
+    labels, _ = ndimage.label(mask, structure=structure)
+    return labels, np.bincount(labels.ravel())
+
+
+def keep_table(sizes, min_voxels):
+    """Tabla booleana por componente: True si su tamaño es >= min_voxels (el fondo nunca)."""
+    keep = sizes >= min_voxels
+    keep[0] = False
+    return keep
+
+
+def filter_components(labels, sizes, min_voxels):
+    """Máscara con solo las componentes de tamaño >= min_voxels (tabla de búsqueda sobre labels)."""
+    return keep_table(sizes, min_voxels)[labels]
+
+
+def min_voxels_for(min_size_mm3, spacing):
+    return math.ceil(min_size_mm3 / float(np.prod(spacing))) if min_size_mm3 > 0 else 0
+
+
+def postprocess(probabilities, spacing, threshold, min_size_mm3):
+    """Umbral de probabilidad + eliminación de lesiones menores de min_size_mm3."""
+    labels, sizes = label_components(probabilities >= threshold)
+    return filter_components(labels, sizes, min_voxels_for(min_size_mm3, spacing))
+
+
+def remove_small_lesions(mask, spacing, min_size_mm3):
+    """Elimina de una máscara binaria las lesiones menores de min_size_mm3."""
+    if min_size_mm3 <= 0:
+        return mask
+    labels, sizes = label_components(mask)
+    return filter_components(labels, sizes, min_voxels_for(min_size_mm3, spacing)).astype(mask.dtype)
+
+
+def load_lesion_probabilities(npz_path, channel=LESION_CHANNEL):
+    """Probabilidad de lesión de un .npz de nnU-Net, de (z, y, x) a (x, y, z) como las máscaras NIfTI."""
+    with np.load(npz_path) as npz:
+        return np.ascontiguousarray(npz["probabilities"][channel].transpose(2, 1, 0), dtype=np.float16)
+
+
+def cached_components(case_id, probabilities, threshold, cache_dir, source_mtime):
+    """
+    labels y tamaños de probabilities >= threshold. Se guardan en
+    cache_dir/<case>_t<threshold>.npz y se reutilizan mientras el .npz de
+    probabilidades no cambie: ampliar MIN_SIZES_MM3 no vuelve a etiquetar.
+    """
+    cache_path = Path(cache_dir) / f"{case_id}_t{threshold:.3f}.npz"
+    if cache_path.exists() and cache_path.stat().st_mtime >= source_mtime:
+        with np.load(cache_path) as npz:
+            return npz["labels"], npz["sizes"]
+    labels, sizes = label_components(probabilities >= threshold)
+    # int32 basta: nunca hay tantas componentes
+    labels = labels.astype(np.int32)
+    np.savez_compressed(cache_path, labels=labels, sizes=sizes)
+    return labels, sizes
+
+
+def combo_metrics(sizes, keep, overlap, pairs, vol_gt, n_gt, voxel_mm3):
+    """
+    Métricas de evaluate_predictions.compute_metrics (sin distancias) de la
+    predicción keep[labels], sin construirla ni volver a etiquetar:
+      overlap[i] = vóxeles de gt dentro de la componente i de la predicción
+      pairs      = (componente gt, componente pred) que se solapan
+    """
+    vol_pred = int(sizes[keep].sum())
+    inter = int(overlap[keep].sum())
+    dice = 2.0 * inter / (vol_gt + vol_pred) if (vol_gt + vol_pred) > 0 else 1.0
+
+    n_pred = int(np.count_nonzero(keep))
+    tp_pred = int(np.count_nonzero(keep & (overlap > 0)))
+    tp_gt = np.unique(pairs[0][keep[pairs[1]]]).size
+    precision, recall, f1 = lesion_scores(n_gt, n_pred, tp_gt, tp_pred)
+    return {
+        "dice": dice,
+        "lesion_precision": precision,
+        "lesion_recall": recall,
+        "lesion_f1": f1,
+        "n_lesions_gt": n_gt,
+        "n_lesions_pred": n_pred,
+        "avd_mm3": abs(vol_pred - vol_gt) * voxel_mm3,
+    }
+
+
+def search_case(args):
+    """
+    Métricas del caso para cada (umbral, tamaño mínimo). gt se etiqueta una
+    vez por caso y la predicción una vez por umbral; cada tamaño mínimo solo
+    cambia la tabla keep sobre las componentes ya etiquetadas.
+    """
+    case_id, prob_path, label_path, thresholds, min_sizes, cache_dir = args
+    gt_img = nib.load(str(label_path))
+    gt = np.asanyarray(gt_img.dataobj) > 0
+    spacing = np.array(gt_img.header.get_zooms()[:3], dtype=np.float64)
+    probabilities = load_lesion_probabilities(prob_path)
+    if probabilities.shape != gt.shape:
+        raise ValueError(f"{case_id}: probabilidades {probabilities.shape} y máscara {gt.shape} no coinciden")
+
+    gt_labels, _ = label_components(gt)
+    n_gt = int(gt_labels.max())
+    vol_gt = int(np.count_nonzero(gt))
+    voxel_mm3 = float(np.prod(spacing))
+
+    rows = []
+    source_mtime = Path(prob_path).stat().st_mtime
+    for threshold in thresholds:
+        labels, sizes = cached_components(case_id, probabilities, threshold, cache_dir, source_mtime)
+        overlap = np.bincount(labels[gt], minlength=sizes.size)
+        both = (labels > 0) & gt
+        pairs = np.unique(np.stack([gt_labels[both], labels[both]]), axis=1)
+        for min_size in min_sizes:
+            keep = keep_table(sizes, min_voxels_for(min_size, spacing))
+            metrics = combo_metrics(sizes, keep, overlap, pairs, vol_gt, n_gt, voxel_mm3)
+            rows.append({"threshold": threshold, "min_size_mm3": min_size, **metrics})
+    return case_id, rows
+
+
+def validation_jobs(model_dir, labels_dir, splits, thresholds, min_sizes, cache_dir):
+    """Un trabajo por caso de validación de cada fold de splits_final.json con probabilidades guardadas."""
+    jobs = []
+    for fold, split in enumerate(splits):
+        validation_dir = Path(model_dir) / f"fold_{fold}" / "validation"
+        for case_id in split["val"]:
+            prob_path = validation_dir / f"{case_id}.npz"
+            if not prob_path.exists():
+                print(f"[AVISO] Fold {fold}: falta {prob_path} (¿entrenado sin --npz?)")
+                continue
+            label_path = Path(labels_dir) / f"{case_id}.nii.gz"
+            jobs.append((case_id, prob_path, label_path, thresholds, min_sizes, cache_dir))
+    return jobs
+
+
+def grid_search(model_dir=MODEL_DIR, thresholds=THRESHOLDS, min_sizes=MIN_SIZES_MM3,
+                objective=OBJECTIVE, num_workers=NUM_WORKERS):
+    """
+    Búsqueda en rejilla de (umbral, tamaño mínimo) sobre los casos de
+    validación de todos los folds. Devuelve (mejor combinación, tabla de medias).
+    """
+    with open(BASE_PREPROCESSED / DATASET / "splits_final.json", "r") as f:
+        splits = json.load(f)
+    cache_dir = Path(model_dir) / CACHE_DIRNAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    jobs = validation_jobs(model_dir, BASE_RAW / DATASET / "labelsTr", splits, thresholds, min_sizes, cache_dir)
+    if not jobs:
+        raise FileNotFoundError(
+            f"No hay probabilidades de validación en {model_dir}/fold_*/validation/*.npz: "
+            "entrena con --npz (o nnUNetv2_train ... --val --npz) antes de buscar el post-procesado."
+        )
+
+    per_combo = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for case_id, rows in pool.map(search_case, jobs):
+            for row in rows:
+                per_combo.setdefault((row["threshold"], row["min_size_mm3"]), []).append(row)
+
+    table = []
+    for (threshold, min_size), rows in sorted(per_combo.items()):
+        entry = {"threshold": threshold, "min_size_mm3": min_size, "n_cases": len(rows)}
+        for metric in ("dice", "lesion_precision", "lesion_recall", "lesion_f1", "avd_mm3"):
+            entry[metric] = float(np.nanmean([r[metric] for r in rows]))
+        table.append(entry)
+
+    best = max(table, key=lambda e: (e[objective], e["dice"]))
+    return best, table
+
+
+def main():
+    print(f"Búsqueda de post-procesado en {MODEL_DIR} "
+          f"({len(THRESHOLDS)} umbrales x {len(MIN_SIZES_MM3)} tamaños mínimos)...")
+    best, table = grid_search()
+
+    # Referencia: umbral 0.5 sin filtrar (lo que hace nnU-Net por defecto)
+    baseline = next((e for e in table if e["threshold"] == 0.5 and e["min_size_mm3"] == 0), None)
+    with open(OUTPUT_JSON, "w") as f:
+        json.dump({"objective": OBJECTIVE, "best": best, "baseline": baseline, "grid": table}, f, indent=4)
+
+    print("\n========================================")
+    print(f" Mejor: umbral {best['threshold']}, tamaño mínimo {best['min_size_mm3']} mm³")
+    print(f"   {OBJECTIVE}={best[OBJECTIVE]:.4f}  dice={best['dice']:.4f}")
+    if baseline is not None:
+        print(f" Sin post-procesado (0.5, 0): {OBJECTIVE}={baseline[OBJECTIVE]:.4f}  dice={baseline['dice']:.4f}")
+    print(f" Resultados en: {OUTPUT_JSON}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
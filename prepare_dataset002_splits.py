@@ -1,6 +1,9 @@
 import json
 from pathlib import Path
-from collections import defaultdict
+
+from case_catalog import CaseCatalog, parse_case_id
+from case_table import CaseTable
+from json_stream import load_splits, save_splits_sidecar, splits_sidecar_path, write_splits
 
 # ============================
 # CONFIGURACIÓN
@@ -13,6 +16,9 @@ DATASET1 = "Dataset001_MSLesSeg"
 DATASET2 = "Dataset002_MSLesSeg"
 
 SPLITS_FILENAME = "splits_final.json"
+CATALOG_PATH = BASE_RAW / "case_catalog.sqlite"  # de case_catalog.py; si no existe o está desfasado se escanea imagesTr
+JSON_INDENT = 4               # None: splits_final.json compacto
+WRITE_SPLITS_SIDECAR = False  # True: además splits_final.npz (binario, ver json_stream.py)
 # ============================
 
 
@@ -20,6 +26,7 @@ def load_splits_dataset1():
     """
     Carga splits_final.json del Dataset001.
     Se intenta primero en nnUNet_preprocessed, si no existe se busca en nnUNet_raw.
+    Se lee fold a fold (json_stream.load_splits), o desde splits_final.npz si está al día.
     """
     src_pre = BASE_PREPROCESSED / DATASET1 / SPLITS_FILENAME
     src_raw = BASE_RAW / DATASET1 / SPLITS_FILENAME
@@ -34,44 +41,59 @@ def load_splits_dataset1():
         )
 
     print(f"Usando splits de: {splits_path}")
-    with open(splits_path, "r") as f:
-        splits = json.load(f)
-    return splits
+    return load_splits(splits_path)
+
+
+def catalog_is_stale(catalog_path, sources):
+    """True si el catálogo es más antiguo que alguno de los ficheros/carpetas de 'sources'."""
+    catalog_mtime = Path(catalog_path).stat().st_mtime
+    return any(p.exists() and p.stat().st_mtime > catalog_mtime for p in sources)
 
 
-def build_slice_mapping_dataset2():
+def build_case_table_dataset2():
     """
-    Explora nnUNet_raw/Dataset002_MSLesSeg/imagesTr y construye:
-      base_id -> [case_ids_slice]
-    donde:
+    Tabla de casos (case_table.CaseTable) con las slices de imagesTr del Dataset002:
       fichero: P1_T1_001_0000.nii.gz
       base_id: P1_T1
       case_id_slice: P1_T1_001   (lo que aparece en dataset.json)
+    Se consulta el catálogo de casos; si no existe, o es más antiguo que
+    dataset.json o imagesTr del Dataset002, se recorre imagesTr.
     """
-    images_tr = BASE_RAW / DATASET2 / "imagesTr"
+    dataset_dir = BASE_RAW / DATASET2
+    images_tr = dataset_dir / "imagesTr"
+    dataset_json = dataset_dir / "dataset.json"
+
+    if CATALOG_PATH.exists() and catalog_is_stale(CATALOG_PATH, [dataset_json, images_tr]):
+        print(f"[AVISO] {CATALOG_PATH} es más antiguo que {DATASET2}; se recorre imagesTr.")
+    elif CATALOG_PATH.exists():
+        catalog = CaseCatalog(CATALOG_PATH, dataset=DATASET2)
+        table = CaseTable.from_catalog(catalog, subset="Tr")
+        catalog.close()
+        if len(table):
+            print(f"Encontrados {len(table.bases)} casos base en Dataset002 (catálogo {CATALOG_PATH}).")
+            return table
+
     if not images_tr.exists():
         raise FileNotFoundError(f"No existe carpeta {images_tr}")
 
-    mapping = defaultdict(set)
+    file_ending = ".nii.gz"
+    if dataset_json.exists():
+        with open(dataset_json, "r") as f:
+            file_ending = json.load(f).get("file_ending", file_ending)
 
-    for nii_path in images_tr.glob("*.nii.gz"):
-        stem = nii_path.stem  # p.ej. P1_T1_001_0000
-        parts = stem.split("_")
-        if len(parts) < 3:
+    suffix = f"_0000{file_ending}"
+    case_ids = set()
+    for img_path in images_tr.glob(f"*{suffix}"):
+        stem = img_path.name[: -len(suffix)]  # p.ej. P1_T1_001
+        if parse_case_id(stem)[2] is None:
             # no es del formato esperado
             continue
+        case_ids.add(stem)
 
-        channel = parts[-1]        # 0000
-        slice_idx = parts[-2]      # 001
-        base_id = "_".join(parts[:-2])  # P1_T1
-        case_id_slice = f"{base_id}_{slice_idx}"  # P1_T1_001
-
-        mapping[base_id].add(case_id_slice)
-
-    # ordenar los IDs de slices
-    mapping = {k: sorted(v) for k, v in mapping.items()}
-    print(f"Encontrados {len(mapping)} casos base en Dataset002 (imagesTr).")
-    return mapping
+    case_ids = sorted(case_ids)
+    table = CaseTable.from_case_ids(case_ids, ["Tr"] * len(case_ids), [True] * len(case_ids))
+    print(f"Encontrados {len(table.bases)} casos base en Dataset002 (imagesTr).")
+    return table
 
 
 def create_splits_dataset2(splits1, slice_mapping):
@@ -113,11 +135,13 @@ def main():
     # 1) Cargar splits del Dataset001
     splits1 = load_splits_dataset1()
 
-    # 2) Construir mapping base_id -> slices en Dataset002
-    slice_mapping = build_slice_mapping_dataset2()
+    # 2) Tabla de casos (slices) del Dataset002
+    table = build_case_table_dataset2()
 
-    # 3) Crear nuevos splits
-    splits2 = create_splits_dataset2(splits1, slice_mapping)
+    # 3) Expandir cada caso base de los splits a todas sus slices
+    splits2 = table.splits_to_json(table.expand_splits(splits1))
+    for fold_idx, fold in enumerate(splits2):
+        print(f"Fold {fold_idx}: {len(fold['train'])} train, {len(fold['val'])} val (slices)")
 
     # 4) Crear carpetas de Dataset002 en preprocessed y results
     dst_pre = BASE_PREPROCESSED / DATASET2
@@ -128,8 +152,9 @@ def main():
 
     # 5) Guardar nuevo splits_final.json en preprocessed/Dataset002
     dst_splits_path = dst_pre / SPLITS_FILENAME
-    with open(dst_splits_path, "w") as f:
-        json.dump(splits2, f, indent=4)
+    write_splits(dst_splits_path, splits2, indent=JSON_INDENT)
+    if WRITE_SPLITS_SIDECAR:
+        save_splits_sidecar(splits_sidecar_path(dst_splits_path), splits2)
 
     print("\n===================================")
     print(f"Nuevo {SPLITS_FILENAME} guardado en: {dst_splits_path}")
@@ -0,0 +1,135 @@
+import json
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from virtual_2d_dataset import load_slice_index, slice_id_for
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_RESULTS = Path("nnUNet_results")
+
+DATASET2 = "Dataset002_MSLesSeg"
+SLICE_INDEX_PATH = BASE_RAW / DATASET2 / "slice_index.json"
+
+PREDICTIONS_DIR = BASE_RESULTS / DATASET2 / "predictions_imagesTs"
+OUTPUT_DIR = BASE_RESULTS / DATASET2 / "predictions_imagesTs_3d"
+
+# Valor de las z no muestreadas. 0 = fondo; usar p.ej. 255 para marcarlas como "sin predicción".
+FILL_VALUE = 0
+# "sparse": se admiten z sin predicción (el muestreo de From3D_2D.py)
+# "full":   cada z del volumen debe tener su slice predicha
+MODE = "sparse"
+COVERAGE_FILENAME = "coverage.json"
+# ============================
+
+
+def is_up_to_date(out_path, slice_paths):
+    """
+    Caché de reconstrucción: el volumen ya reconstruido se reutiliza si es más
+    reciente que todas sus slices.
+    """
+    if not out_path.exists():
+        return False
+    out_mtime = out_path.stat().st_mtime
+    return all(p.stat().st_mtime <= out_mtime for p in slice_paths)
+
+
+def load_slice(path):
+    data = np.asanyarray(nib.load(str(path)).dataobj)
+    return data.reshape(data.shape[:2])  # (X, Y) o (X, Y, 1) -> (X, Y)
+
+
+def case_slice_paths(base_id, info, predictions_dir, file_ending):
+    """Lista [(z_original, path)] de las slices predichas que existen para el caso."""
+    found = []
+    for pos, z in enumerate(info["slices"]):
+        path = Path(predictions_dir) / f"{slice_id_for(base_id, pos)}{file_ending}"
+        if path.exists():
+            found.append((z, path))
+    return found
+
+
+def reassemble_case(base_id, info, slice_paths, fill_value=FILL_VALUE, mode=MODE):
+    """
+    Reconstruye el volumen 3D de un caso a partir de sus slices predichas
+    (slice_paths = [(z, path)], ver case_slice_paths).
+    Devuelve (volumen, affine). Las slices se colocan en su z original con una
+    única asignación vectorizada.
+    """
+    shape = tuple(info["shape"])
+    zs = np.array([z for z, _ in slice_paths], dtype=np.int64)
+    if mode == "full" and sorted(zs.tolist()) != list(range(shape[2])):
+        raise ValueError(
+            f"Modo 'full': el caso {base_id} tiene {len(zs)} de {shape[2]} slices predichas."
+        )
+
+    stack = np.stack([load_slice(p) for _, p in slice_paths], axis=-1)
+    if stack.dtype == np.bool_:
+        stack = stack.astype(np.uint8)
+    volume = np.full(shape, fill_value, dtype=stack.dtype)
+    volume[:, :, zs] = stack
+    return volume, np.asarray(info["affine"], dtype=np.float64)
+
+
+def reassemble_all(slice_index, predictions_dir, output_dir, subset=None):
+    """
+    Reconstruye todos los casos del índice (opcionalmente solo un subset) y
+    guarda {base_id}{file_ending} en output_dir con la affine 3D original.
+    Devuelve dict base_id -> z cubiertas.
+    """
+    file_ending = slice_index["file_ending"]
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    coverage = {}
+    reused = 0
+    for base_id, info in slice_index["cases"].items():
+        if subset is not None and info["subset"] != subset:
+            continue
+
+        slice_paths = case_slice_paths(base_id, info, predictions_dir, file_ending)
+        if not slice_paths:
+            continue
+        coverage[base_id] = sorted(int(z) for z, _ in slice_paths)
+
+        out_path = output_dir / f"{base_id}{file_ending}"
+        if is_up_to_date(out_path, [p for _, p in slice_paths]):
+            reused += 1
+            continue
+
+        volume, affine = reassemble_case(base_id, info, slice_paths)
+        nib.save(nib.Nifti1Image(volume, affine), str(out_path))
+
+    with open(output_dir / COVERAGE_FILENAME, "w") as f:
+        json.dump(coverage, f, indent=4)
+
+    if reused:
+        print(f"[INFO] {reused} casos ya reconstruidos y actualizados, se reutilizan.")
+    return coverage
+
+
+def main():
+    if not SLICE_INDEX_PATH.exists():
+        raise FileNotFoundError(
+            f"No existe {SLICE_INDEX_PATH}. Regenera Dataset002 con From3D_2D.py "
+            "o el índice con virtual_2d_dataset.py."
+        )
+    slice_index = load_slice_index(SLICE_INDEX_PATH)
+
+    print(f"Reconstruyendo predicciones 2D de {PREDICTIONS_DIR} en 3D (modo {MODE})...")
+    coverage = reassemble_all(slice_index, PREDICTIONS_DIR, OUTPUT_DIR)
+
+    n_slices = sum(len(zs) for zs in coverage.values())
+    print("\n========================================")
+    print(f" Casos reconstruidos: {len(coverage)} ({n_slices} slices colocadas)")
+    print(f" Volúmenes 3D en: {OUTPUT_DIR}")
+    print(f" z cubiertas por caso en: {OUTPUT_DIR / COVERAGE_FILENAME}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+BASE_RESULTS = Path("nnUNet_results")
+DATASET = "Dataset001_MSLesSeg"
+CONFIGURATION = "2d"
+TRAINER = "nnUNetTrainerCPUAmp"
+PLANS = "nnUNetPlans"
+FOLDS = None                 # None: todos los folds de splits_final.json
+
+CPUS = None                  # None: los núcleos de la afinidad actual del proceso
+DA_PROCESSES_PER_FOLD = 2    # workers de data augmentation de nnU-Net (nnUNet_n_proc_DA) por fold
+UNPACK_PROCESSES = 8
+POLL_SECONDS = 60
+LOG_DIR = BASE_RESULTS / DATASET / "train_folds_logs"
+# ============================
+
+EPOCH_RE = re.compile(r"Epoch (\d+)")
+PSEUDO_DICE_RE = re.compile(r"Pseudo dice \[([^\]]*)\]")
+
+
+def load_splits(dataset_dir):
+    with open(Path(dataset_dir) / "splits_final.json", "r") as f:
+        return json.load(f)
+
+
+def split_cpus(cpus, n_groups):
+    """Reparte la lista de núcleos en n_groups bloques contiguos y disjuntos."""
+    cpus = sorted(cpus)
+    if len(cpus) < n_groups:
+        raise ValueError(f"Hay {len(cpus)} núcleos para {n_groups} folds: se necesita al menos uno por fold.")
+    size, extra = divmod(len(cpus), n_groups)
+    groups, start = [], 0
+    for i in range(n_groups):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+def unpack_once(dataset_dir, plans_name, configuration, num_processes=UNPACK_PROCESSES):
+    """
+    Descomprime los .npz preprocesados a .npy antes de lanzar los folds. Así
+    cada trainer encuentra los .npy (no vuelve a desempaquetar) y los abre con
+    memmap: los cinco procesos comparten las mismas páginas de solo lectura.
+    """
+    from nnunetv2.training.dataloading.utils import unpack_dataset
+
+    with open(Path(dataset_dir) / f"{plans_name}.json", "r") as f:
+        data_identifier = json.load(f)["configurations"][configuration]["data_identifier"]
+    data_dir = Path(dataset_dir) / data_identifier
+    unpack_dataset(str(data_dir), unpack_segmentation=True, overwrite_existing=False, num_processes=num_processes)
+    return data_dir
+
+
+def fold_env(cpus, da_processes=DA_PROCESSES_PER_FOLD):
+    """Variables de entorno de un fold: hilos de torch/BLAS = núcleos propios menos los de DA."""
+    threads = str(max(1, len(cpus) - da_processes))
+    env = dict(os.environ)
+    env.update({
+        "OMP_NUM_THREADS": threads,
+        "MKL_NUM_THREADS": threads,
+        "OPENBLAS_NUM_THREADS": threads,
+        "nnUNet_n_proc_DA": str(da_processes),
+    })
+    return env
+
+
+def launch_fold(fold, cpus, log_path):
+    """Lanza el entrenamiento de un fold (vía nnunet_compat.py) fijado a 'cpus'."""
+    cmd = [
+        sys.executable, str(Path(__file__).resolve().parent / "nnunet_compat.py"),
+        DATASET, CONFIGURATION, str(fold), "-tr", TRAINER, "-p", PLANS, "-device", "cpu",
+    ]
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        cmd,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        env=fold_env(cpus),
+        # se hereda en los workers de DA que cree nnU-Net
+        preexec_fn=lambda: os.sched_setaffinity(0, cpus),
+    )
+    process.log_file = log
+    return process
+
+
+def process_tree(pid):
+    """pid y todos sus descendientes (según /proc/<pid>/task/*/children)."""
+    pids, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        pids.append(p)
+        for task in Path(f"/proc/{p}/task").glob("*"):
+            try:
+                stack.extend(int(c) for c in (task / "children").read_text().split())
+            except OSError:
+                pass
+    return pids
+
+
+def tree_usage(pid):
+    """(RSS total en bytes, tiempo de CPU total en s) del árbol de procesos."""
+    page = os.sysconf("SC_PAGE_SIZE")
+    ticks = os.sysconf("SC_CLK_TCK")
+    rss, cpu = 0, 0.0
+    for p in process_tree(pid):
+        try:
+            rss += int(Path(f"/proc/{p}/statm").read_text().split()[1]) * page
+            # campos 14-15 (utime, stime) después del nombre entre paréntesis
+            fields = Path(f"/proc/{p}/stat").read_text().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+        except OSError:
+            pass
+    return rss, cpu
+
+
+def log_progress(log_path):
+    """Última época y último pseudo dice que aparecen en el log del fold."""
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 64 * 1024))
+            tail = f.read().decode(errors="replace")
+    except OSError:
+        return None, None
+    epochs = EPOCH_RE.findall(tail)
+    dice = PSEUDO_DICE_RE.findall(tail)
+    return (int(epochs[-1]) if epochs else None), (dice[-1].strip() if dice else None)
+
+
+def collect_results(folds):
+    """Dice medio de cada fold desde fold_X/validation/summary.json de nnU-Net."""
+    model_dir = BASE_RESULTS / DATASET / f"{TRAINER}__{PLANS}__{CONFIGURATION}"
+    results = {}
+    for fold in folds:
+        summary_path = model_dir / f"fold_{fold}" / "validation" / "summary.json"
+        if not summary_path.exists():
+            print(f"[AVISO] No existe {summary_path}")
+            continue
+        with open(summary_path, "r") as f:
+            summary = json.load(f)
+        results[fold] = summary["foreground_mean"]
+    return model_dir, results
+
+
+def run_folds(folds, cpus):
+    groups = split_cpus(cpus, len(folds))
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+    running = {}
+    for fold, group in zip(folds, groups):
+        log_path = LOG_DIR / f"fold_{fold}.log"
+        running[fold] = (launch_fold(fold, group, log_path), log_path, group)
+        print(f"  Fold {fold}: núcleos {group[0]}-{group[-1]} ({len(group)}), log {log_path}")
+
+    last_cpu = {fold: 0.0 for fold in folds}
+    last_time = time.time()
+    return_codes = {}
+    while running:
+        time.sleep(POLL_SECONDS)
+        now = time.time()
+        print(f"\n[{time.strftime('%H:%M:%S')}]")
+        for fold, (process, log_path, group) in list(running.items()):
+            code = process.poll()
+            if code is not None:
+                process.log_file.close()
+                return_codes[fold] = code
+                del running[fold]
+                print(f"  Fold {fold}: terminado (código {code})")
+                continue
+            rss, cpu = tree_usage(process.pid)
+            usage = (cpu - last_cpu[fold]) / (now - last_time) / len(group)
+            last_cpu[fold] = cpu
+            epoch, dice = log_progress(log_path)
+            print(f"  Fold {fold}: época {epoch}, pseudo dice [{dice}], "
+                  f"RSS {rss / 1024 ** 3:.1f} GB, uso CPU {100 * usage:.0f}%")
+        last_time = now
+    return return_codes
+
+
+def main():
+    dataset_dir = BASE_PREPROCESSED / DATASET
+    folds = FOLDS if FOLDS is not None else list(range(len(load_splits(dataset_dir))))
+    cpus = CPUS if CPUS is not None else sorted(os.sched_getaffinity(0))
+
+    print(f"Desempaquetando {CONFIGURATION} una sola vez para todos los folds...")
+    unpack_once(dataset_dir, PLANS, CONFIGURATION)
+
+    print(f"Lanzando {len(folds)} folds en paralelo sobre {len(cpus)} núcleos:")
+    return_codes = run_folds(folds, cpus)
+
+    model_dir, results = collect_results(folds)
+    summary = {
+        "return_codes": {str(k): v for k, v in return_codes.items()},
+        "foreground_mean": {str(k): v for k, v in results.items()},
+    }
+    dices = [r["Dice"] for r in results.values() if "Dice" in r]
+    if dices:
+        summary["mean_dice"] = sum(dices) / len(dices)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    with open(model_dir / "folds_summary.json", "w") as f:
+        json.dump(summary, f, indent=4)
+
+    print("\n========================================")
+    for fold in folds:
+        dice = results.get(fold, {}).get("Dice")
+        print(f" Fold {fold}: código {return_codes.get(fold)}, Dice {dice if dice is not None else '-'}")
+    if dices:
+        print(f" Dice medio: {summary['mean_dice']:.4f}")
+    print(f" Resumen en: {model_dir / 'folds_summary.json'}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
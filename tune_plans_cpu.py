@@ -0,0 +1,256 @@
+import copy
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import pydoc
+import resource
+import sys
+import time
+from pathlib import Path
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+DATASET = "Dataset001_MSLesSeg"
+
+SOURCE_PLANS = "nnUNetPlans"
+TUNED_PLANS = "nnUNetPlans_cpuTuned"
+CONFIGURATIONS = ["2d", "3d_fullres"]
+
+# Candidatos: factores sobre el patch planificado (se redondea a múltiplos
+# del stride total de la red) y tamaños de batch
+PATCH_SCALES = [0.75, 1.0]
+BATCH_SIZES = {
+    "2d": [8, 16, 32, 64, 106],
+    "3d_fullres": [1, 2, 4],
+}
+
+MEMORY_BUDGET_GB = 32.0   # pico de RSS permitido por proceso de entrenamiento
+NUM_THREADS = os.cpu_count()
+WARMUP_ITERS = 1
+TIMED_ITERS = 3
+CANDIDATE_TIMEOUT_S = 600
+# ============================
+
+
+def load_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def build_network(architecture, input_channels, num_classes):
+    """
+    Instancia la red de la configuración igual que nnU-Net: clase y kwargs de
+    plans["configurations"][c]["architecture"], resolviendo los imports.
+    """
+    import torch  # noqa: F401  (pydoc.locate necesita torch importado)
+
+    kwargs = dict(architecture["arch_kwargs"])
+    for key in architecture["_kw_requires_import"]:
+        if kwargs.get(key) is not None:
+            kwargs[key] = pydoc.locate(kwargs[key])
+    network_class = pydoc.locate(architecture["network_class_name"])
+    return network_class(
+        input_channels=input_channels,
+        num_classes=num_classes,
+        deep_supervision=True,
+        **kwargs,
+    )
+
+
+def stride_multiples(architecture):
+    """Producto de strides por eje: el patch tiene que ser múltiplo de esto."""
+    strides = architecture["arch_kwargs"]["strides"]
+    dims = len(strides[0])
+    totals = [1] * dims
+    for stage in strides:
+        for d in range(dims):
+            totals[d] *= stage[d]
+    return totals
+
+
+def candidate_patches(planned_patch, multiples, scales=PATCH_SCALES):
+    patches = []
+    for scale in scales:
+        patch = [max(m, int(round(p * scale / m)) * m) for p, m in zip(planned_patch, multiples)]
+        if patch not in patches:
+            patches.append(patch)
+    return patches
+
+
+def _benchmark_worker(architecture, input_channels, num_classes, patch, batch_size, num_threads):
+    """
+    Se ejecuta en un proceso nuevo por candidato: así el pico de RSS
+    (ru_maxrss) es el de este candidato y un OOM no tumba el benchmark.
+    """
+    import torch
+
+    torch.set_num_threads(num_threads)
+    network = build_network(architecture, input_channels, num_classes)
+    network.train()
+    optimizer = torch.optim.SGD(network.parameters(), lr=1e-2, momentum=0.99, nesterov=True)
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    x = torch.randn(batch_size, input_channels, *patch)
+    target = torch.randint(0, num_classes, (batch_size, *patch))
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        output = network(x)
+        main = output[0] if isinstance(output, (list, tuple)) else output
+        loss = loss_fn(main, target)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(WARMUP_ITERS):
+        step()
+    t0 = time.perf_counter()
+    for _ in range(TIMED_ITERS):
+        step()
+    elapsed = time.perf_counter() - t0
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss va en bytes en macOS y en KB en Linux
+    peak_gb = peak_rss / 1024 ** 3 if sys.platform == "darwin" else peak_rss / 1024 ** 2
+    return {"seconds_per_step": elapsed / TIMED_ITERS, "peak_rss_gb": peak_gb}
+
+
+def _benchmark_entry(conn, *args):
+    try:
+        conn.send((True, _benchmark_worker(*args)))
+    except Exception as exc:  # p.ej. RuntimeError por falta de memoria
+        conn.send((False, str(exc)))
+    finally:
+        conn.close()
+
+
+def benchmark_candidate(architecture, input_channels, num_classes, patch, batch_size):
+    """
+    Lanza el candidato en un proceso aparte y espera su resultado. Si el
+    proceso muere sin responder (p.ej. el OOM killer) se descarta en el
+    momento en vez de esperar a CANDIDATE_TIMEOUT_S.
+    """
+    ctx = mp.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(
+        target=_benchmark_entry,
+        args=(sender, architecture, input_channels, num_classes, patch, batch_size, NUM_THREADS),
+    )
+    proc.start()
+    sender.close()
+
+    deadline = time.monotonic() + CANDIDATE_TIMEOUT_S
+    try:
+        while not receiver.poll(1.0):
+            if not proc.is_alive() and not receiver.poll():
+                proc.join()
+                print(f"    [AVISO] El proceso del candidato murió (exitcode {proc.exitcode}, ¿sin memoria?)")
+                return None
+            if time.monotonic() > deadline:
+                print(f"    [AVISO] El candidato superó {CANDIDATE_TIMEOUT_S} s")
+                return None
+        ok, result = receiver.recv()
+    except EOFError:
+        proc.join()
+        print(f"    [AVISO] El proceso del candidato murió (exitcode {proc.exitcode}, ¿sin memoria?)")
+        return None
+    finally:
+        receiver.close()
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+
+    if not ok:
+        print(f"    [AVISO] Falló el candidato: {result}")
+        return None
+    return result
+
+
+def tune_configuration(name, config, input_channels, num_classes):
+    """
+    Mide todos los candidatos de una configuración y devuelve (mejor, resultados).
+    Se ordena por muestras/s equivalentes al patch planificado
+    (muestras/s * vóxeles del patch / vóxeles del patch planificado), para que
+    un patch más pequeño no gane solo por ser más barato por muestra.
+    """
+    architecture = config["architecture"]
+    planned_patch = config["patch_size"]
+    planned_voxels = float(math.prod(planned_patch))
+    patches = candidate_patches(planned_patch, stride_multiples(architecture))
+
+    results = []
+    for patch, batch_size in itertools.product(patches, BATCH_SIZES[name]):
+        print(f"  {name}: patch={patch} batch={batch_size} ...", end=" ", flush=True)
+        res = benchmark_candidate(architecture, input_channels, num_classes, patch, batch_size)
+        if res is None:
+            print("descartado")
+            continue
+        samples_per_s = batch_size / res["seconds_per_step"]
+        res.update(
+            {
+                "patch_size": patch,
+                "batch_size": batch_size,
+                "samples_per_s": samples_per_s,
+                "equivalent_samples_per_s": samples_per_s * math.prod(patch) / planned_voxels,
+                "within_budget": res["peak_rss_gb"] <= MEMORY_BUDGET_GB,
+            }
+        )
+        results.append(res)
+        print(f"{samples_per_s:.2f} muestras/s, {res['peak_rss_gb']:.1f} GB")
+
+    valid = [r for r in results if r["within_budget"]]
+    best = max(valid, key=lambda r: r["equivalent_samples_per_s"]) if valid else None
+    return best, results
+
+
+def main():
+    dataset_dir = BASE_PREPROCESSED / DATASET
+    plans = load_json(dataset_dir / f"{SOURCE_PLANS}.json")
+    dataset_json = load_json(dataset_dir / "dataset.json")
+
+    input_channels = len(dataset_json["channel_names"])
+    num_classes = len(dataset_json["labels"])
+
+    tuned = copy.deepcopy(plans)
+    tuned["plans_name"] = TUNED_PLANS
+    report = {}
+
+    for name in CONFIGURATIONS:
+        if name not in plans["configurations"]:
+            print(f"[AVISO] La configuración {name} no está en {SOURCE_PLANS}, se omite.")
+            continue
+        config = plans["configurations"][name]
+        print(f"\nConfiguración {name}: planificado patch={config['patch_size']} batch={config['batch_size']}")
+
+        best, results = tune_configuration(name, config, input_channels, num_classes)
+        report[name] = {"best": best, "candidates": results}
+        if best is None:
+            print(f"[AVISO] Ningún candidato de {name} cabe en {MEMORY_BUDGET_GB} GB; se deja como estaba.")
+            continue
+
+        # Mismo data_identifier: se reutilizan los datos ya preprocesados
+        tuned["configurations"][name]["patch_size"] = best["patch_size"]
+        tuned["configurations"][name]["batch_size"] = best["batch_size"]
+
+    out_plans = dataset_dir / f"{TUNED_PLANS}.json"
+    with open(out_plans, "w") as f:
+        json.dump(tuned, f, indent=4)
+    with open(dataset_dir / f"{TUNED_PLANS}_benchmark.json", "w") as f:
+        json.dump(report, f, indent=4)
+
+    print("\n========================================")
+    for name, r in report.items():
+        if r["best"] is not None:
+            b = r["best"]
+            print(f" {name}: patch={b['patch_size']} batch={b['batch_size']} "
+                  f"({b['samples_per_s']:.2f} muestras/s, {b['peak_rss_gb']:.1f} GB)")
+    print(f" Plans guardados en: {out_plans}")
+    print(f" Entrenar con: nnUNetv2_train {DATASET} <config> <fold> -p {TUNED_PLANS}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
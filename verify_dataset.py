@@ -0,0 +1,210 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+DATASET = "Dataset001_MSLesSeg"
+
+LABEL_SAMPLE_SLICES = 8   # slices de la máscara leídas para comprobar valores
+FULL_LABEL_CHECK = False  # True: decodificar la máscara entera
+AFFINE_TOL = 1e-4
+SPACING_TOL = 1e-4
+NUM_WORKERS = 8
+# ============================
+
+
+def expected_case_files(dataset_root, dataset_json):
+    """
+    Lista de casos de dataset.json con sus ficheros esperados:
+    (case_id, subset, [paths de canales _0000.._000N], label_path o None).
+    """
+    dataset_root = Path(dataset_root)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    channel_keys = sorted(dataset_json["channel_names"].keys(), key=lambda x: int(x))
+
+    def channels_for(image_rel):
+        return [dataset_root / f"{image_rel}_{int(k):04d}{file_ending}" for k in channel_keys]
+
+    cases = []
+    for item in dataset_json["training"]:
+        image_rel = item["image"].replace("./", "")
+        label_path = dataset_root / item["label"].replace("./", "")
+        cases.append((Path(image_rel).name, "Tr", channels_for(image_rel), label_path))
+
+    for entry in dataset_json.get("test", []):
+        image_rel = (entry["image"] if isinstance(entry, dict) else entry).replace("./", "")
+        label_path = dataset_root / entry["label"].replace("./", "") if isinstance(entry, dict) else None
+        cases.append((Path(image_rel).name, "Ts", channels_for(image_rel), label_path))
+    return cases
+
+
+def check_dataset_json(dataset_root, dataset_json):
+    errors = []
+    for key in ["channel_names", "labels", "numTraining", "file_ending", "training"]:
+        if key not in dataset_json:
+            errors.append(f"dataset.json: falta la clave '{key}'")
+    if len(dataset_json.get("training", [])) != dataset_json.get("numTraining"):
+        errors.append(
+            f"dataset.json: numTraining={dataset_json.get('numTraining')} pero hay "
+            f"{len(dataset_json.get('training', []))} entradas en 'training'"
+        )
+    if "numTest" in dataset_json and len(dataset_json.get("test", [])) != dataset_json["numTest"]:
+        errors.append(
+            f"dataset.json: numTest={dataset_json['numTest']} pero hay {len(dataset_json.get('test', []))} entradas en 'test'"
+        )
+    return errors
+
+
+def check_stray_files(dataset_root, cases, file_ending):
+    """Ficheros en imagesTr/labelsTr/imagesTs/labelsTs que no corresponden a ningún caso."""
+    expected = set()
+    for _, _, channel_paths, label_path in cases:
+        expected.update(str(p) for p in channel_paths)
+        if label_path is not None:
+            expected.add(str(label_path))
+
+    warnings = []
+    for sub in ["imagesTr", "labelsTr", "imagesTs", "labelsTs"]:
+        folder = Path(dataset_root) / sub
+        if not folder.is_dir():
+            continue
+        stray = [p.name for p in folder.glob(f"*{file_ending}") if str(p) not in expected]
+        if stray:
+            warnings.append(f"{sub}: {len(stray)} ficheros sin caso en dataset.json (p.ej. {stray[0]})")
+    return warnings
+
+
+def sample_label_values(img, n_slices=LABEL_SAMPLE_SLICES, full=False):
+    """
+    Valores presentes en la máscara. Por defecto solo se leen n_slices slices
+    equiespaciadas (dataobj[..., ::paso]) en lugar de decodificar todo el volumen.
+    """
+    if full or img.ndim < 3:
+        return np.unique(np.asanyarray(img.dataobj))
+    step = max(1, img.shape[2] // n_slices)
+    return np.unique(img.dataobj[:, :, ::step])
+
+
+def check_case(args):
+    """
+    Comprueba un caso leyendo solo cabeceras (shape, affine, spacing) y,
+    para la máscara, una muestra de slices. Devuelve (case_id, errores, avisos).
+    Avisos: el eje 3 no es axial (las slices 2D no serían axiales) o una
+    máscara de entrenamiento sin lesión en lo leído.
+    """
+    case_id, subset, channel_paths, label_path, allowed_labels, full_label_check = args
+    errors, warnings = [], []
+
+    missing = [p.name for p in channel_paths if not p.exists()]
+    if missing:
+        errors.append(f"faltan canales: {missing}")
+    if label_path is not None and not label_path.exists():
+        errors.append(f"falta la máscara {label_path.name}")
+    if errors:
+        return case_id, errors, warnings
+
+    images = [nib.load(str(p)) for p in channel_paths]  # carga perezosa: solo cabecera
+    ref = images[0]
+    ref_name = channel_paths[0].name
+
+    others = list(zip(channel_paths[1:], images[1:]))
+    label_img = nib.load(str(label_path)) if label_path is not None else None
+    if label_img is not None:
+        others.append((label_path, label_img))
+
+    axcodes = nib.aff2axcodes(ref.affine)
+    if axcodes[2] not in ("S", "I"):
+        warnings.append(f"orientación {''.join(axcodes)}: el eje 3 no es axial (normalize_geometry.py)")
+
+    for path, img in others:
+        if img.shape != ref.shape:
+            errors.append(f"{path.name}: shape {img.shape} distinto de {ref_name} {ref.shape}")
+        if not np.allclose(img.affine, ref.affine, atol=AFFINE_TOL):
+            errors.append(f"{path.name}: affine distinta de {ref_name}")
+        if not np.allclose(img.header.get_zooms(), ref.header.get_zooms(), atol=SPACING_TOL):
+            errors.append(
+                f"{path.name}: spacing {img.header.get_zooms()} distinto de {ref_name} {ref.header.get_zooms()}"
+            )
+
+    if label_img is not None:
+        values = sample_label_values(label_img, full=full_label_check)
+        unexpected = sorted(set(values.tolist()) - allowed_labels)
+        if unexpected:
+            errors.append(f"{label_path.name}: valores de label no declarados en dataset.json: {unexpected}")
+        if not np.allclose(values, np.rint(values)):
+            errors.append(f"{label_path.name}: la máscara tiene valores no enteros")
+        if subset == "Tr" and not np.any(values > 0):
+            where = "" if full_label_check else f" en las {LABEL_SAMPLE_SLICES} slices muestreadas"
+            warnings.append(f"{label_path.name}: máscara sin lesión{where}")
+
+    return case_id, errors, warnings
+
+
+def verify_dataset(dataset_root, full_label_check=FULL_LABEL_CHECK, num_workers=NUM_WORKERS):
+    """
+    Verificación rápida de un dataset de nnUNet_raw. Devuelve
+    (errores globales, avisos globales, {case_id: errores}).
+    """
+    dataset_root = Path(dataset_root)
+    with open(dataset_root / "dataset.json", "r") as f:
+        dataset_json = json.load(f)
+
+    errors = check_dataset_json(dataset_root, dataset_json)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    cases = []
+    for case_id, subset, channels, label in expected_case_files(dataset_root, dataset_json):
+        if subset == "Ts" and label is None:
+            # labelsTs no referenciadas en dataset.json (Dataset001); normalize_geometry.py también las reescribe
+            label_ts = dataset_root / "labelsTs" / f"{case_id}{file_ending}"
+            label = label_ts if label_ts.exists() else None
+        cases.append((case_id, subset, channels, label))
+    warnings = check_stray_files(dataset_root, cases, file_ending)
+
+    allowed_labels = {int(v) for v in dataset_json["labels"].values() if not isinstance(v, (list, tuple))}
+    jobs = [(c, s, ch, lbl, allowed_labels, full_label_check) for c, s, ch, lbl in cases]
+
+    case_errors = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for case_id, errs, warns in pool.map(check_case, jobs, chunksize=4):
+            if errs:
+                case_errors[case_id] = errs
+            warnings.extend(f"{case_id}: {w}" for w in warns)
+
+    return errors, warnings, case_errors
+
+
+def main():
+    dataset_root = BASE_RAW / DATASET
+    t0 = time.time()
+    print(f"Verificando {dataset_root} (solo cabeceras, máscaras {'completas' if FULL_LABEL_CHECK else 'muestreadas'})...")
+    errors, warnings, case_errors = verify_dataset(dataset_root)
+    elapsed = time.time() - t0
+
+    for w in warnings:
+        print(f"[AVISO] {w}")
+    for e in errors:
+        print(f"[ERROR] {e}")
+    for case_id, errs in sorted(case_errors.items()):
+        for e in errs:
+            print(f"[ERROR] {case_id}: {e}")
+
+    n_errors = len(errors) + sum(len(e) for e in case_errors.values())
+    print("\n========================================")
+    print(f" Verificación terminada en {elapsed:.1f} s")
+    print(f" Errores: {n_errors}  Avisos: {len(warnings)}")
+    print("========================================")
+
+    if n_errors:
+        raise RuntimeError(f"El dataset {DATASET} tiene {n_errors} errores de integridad.")
+    print(f"Dataset correcto. Se puede usar nnUNetv2_plan_and_preprocess -d {int(DATASET[7:10])} sin --verify_dataset_integrity")
+
+
+if __name__ == "__main__":
+    main()
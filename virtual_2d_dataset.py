@@ -0,0 +1,338 @@
+import json
+import random
+from collections import OrderedDict
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from prepare_dataset002_splits import create_splits_dataset2, load_splits_dataset1
+
+# ============================
+# CONFIGURACIÓN
+# ============================
+BASE_RAW = Path("nnUNet_raw")
+BASE_PREPROCESSED = Path("nnUNet_preprocessed")
+
+DATASET1 = "Dataset001_MSLesSeg"
+DATASET2 = "Dataset002_MSLesSeg"
+
+NUM_SLICES = 10
+SEED = 42
+CACHE_SIZE = 4  # nº de casos 3D decodificados que se mantienen en memoria
+
+SLICE_INDEX_FILENAME = "slice_index.json"
+SPLITS_FILENAME = "splits_final.json"
+# ============================
+
+
+def read_dataset_json(dataset_root):
+    with open(Path(dataset_root) / "dataset.json", "r") as f:
+        return json.load(f)
+
+
+def iter_source_cases(dataset_root, dataset_json):
+    """
+    Recorre los casos 3D de dataset.json igual que From3D_2D.py y devuelve
+    tuplas (base_id, subset, channel_paths, label_path).
+    label_path es None si el caso no tiene máscara (test sin labelsTs).
+    """
+    dataset_root = Path(dataset_root)
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    channel_keys = sorted(dataset_json["channel_names"].keys(), key=lambda x: int(x))
+
+    def channels_for(img_base_rel):
+        return [
+            dataset_root / f"{img_base_rel}_{int(ck):04d}{file_ending}"
+            for ck in channel_keys
+        ]
+
+    for item in dataset_json["training"]:
+        img_base_rel = item["image"].replace("./", "")   # imagesTr/P1_T1
+        base_id = Path(img_base_rel).name                # P1_T1
+        label_path = dataset_root / item["label"].replace("./", "")
+        yield base_id, "Tr", channels_for(img_base_rel), label_path
+
+    for img_entry in dataset_json["test"]:
+        img_base_rel = img_entry.replace("./", "")       # imagesTs/P10_T1
+        base_id = Path(img_base_rel).name                # P10_T1
+        label_path = dataset_root / "labelsTs" / f"{base_id}{file_ending}"
+        if not label_path.exists():
+            label_path = None
+        yield base_id, "Ts", channels_for(img_base_rel), label_path
+
+
+def slice_id_for(base_id, position):
+    """Mismo nombre que genera From3D_2D.py: P1_T1 + posición 0 -> P1_T1_001."""
+    return f"{base_id}_{position + 1:03d}"
+
+
+def slice_affine(affine, z):
+    """
+    Affine de la slice z de un volumen: se desplaza el origen a lo largo del
+    eje Z igual que en crop_along_z.
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    new_affine = affine.copy()
+    new_affine[:3, 3] = affine[:3, 3] + affine[:3, 2] * z
+    return new_affine
+
+
+def build_slice_index(dataset_root, num_slices=NUM_SLICES, seed=SEED):
+    """
+    Construye el índice de slices (caso, z) leyendo solo las cabeceras NIfTI.
+    Formato:
+      {
+        "source_dataset": "Dataset001_MSLesSeg",
+        "file_ending": ".nii.gz",
+        "cases": {
+          "P1_T1": {"subset": "Tr", "has_label": true, "shape": [X, Y, Z],
+                    "affine": [[...]], "slices": [z1, z2, ...]}
+        }
+      }
+    La posición de cada z en "slices" da el sufijo del slice_id (P1_T1_001, ...).
+    """
+    dataset_root = Path(dataset_root)
+    dataset_json = read_dataset_json(dataset_root)
+    rng = random.Random(seed)
+
+    cases = {}
+    for base_id, subset, channel_paths, label_path in iter_source_cases(dataset_root, dataset_json):
+        ref = nib.load(str(channel_paths[0]))  # solo cabecera, sin decodificar vóxeles
+        shape = [int(s) for s in ref.shape[:3]]
+        depth = shape[2]
+        slices = rng.sample(range(depth), min(num_slices, depth))
+        cases[base_id] = {
+            "subset": subset,
+            "has_label": label_path is not None,
+            "shape": shape,
+            "affine": ref.affine.tolist(),
+            "slices": slices,
+        }
+
+    return {
+        "source_dataset": dataset_root.name,
+        "file_ending": dataset_json.get("file_ending", ".nii.gz"),
+        "cases": cases,
+    }
+
+
+def save_slice_index(slice_index, path):
+    with open(path, "w") as f:
+        json.dump(slice_index, f, indent=4)
+
+
+def load_slice_index(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class VolumeCache:
+    """
+    LRU pequeño de casos 3D decodificados (canales + máscara).
+    Los .nii sin comprimir se abren como memmap; los .nii.gz se decodifican
+    una única vez mientras el caso permanece en la caché.
+    """
+
+    def __init__(self, max_cases=CACHE_SIZE):
+        self.max_cases = max_cases
+        self._cases = OrderedDict()
+
+    @staticmethod
+    def _open(path):
+        img = nib.load(str(path), mmap=True)
+        return np.asanyarray(img.dataobj)
+
+    def get(self, base_id, channel_paths, label_path):
+        if base_id in self._cases:
+            self._cases.move_to_end(base_id)
+            return self._cases[base_id]
+
+        channels = [self._open(p) for p in channel_paths]
+        label = self._open(label_path) if label_path is not None else None
+        self._cases[base_id] = (channels, label)
+
+        while len(self._cases) > self.max_cases:
+            self._cases.popitem(last=False)
+        return self._cases[base_id]
+
+
+class VirtualSliceDataset:
+    """
+    Dataset 2D virtual: sirve las slices del índice directamente desde los
+    volúmenes 3D de Dataset001, sin escribir Dataset002 a disco.
+
+    Cada muestra es un dict con:
+      - "slice_id": P1_T1_001
+      - "image": array float32 (C, X, Y)
+      - "label": array uint8 (X, Y) o None
+      - "affine": affine 4x4 de la slice
+
+    Si el índice trae "weights" (dedup_slices.py con MODE = "weight"),
+    sample_indices muestrea con esos pesos.
+    """
+
+    def __init__(self, dataset_root, slice_index, subset=None, cache_size=CACHE_SIZE):
+        self.dataset_root = Path(dataset_root)
+        self.slice_index = slice_index
+        self.cache = VolumeCache(cache_size)
+
+        dataset_json = read_dataset_json(self.dataset_root)
+        self._paths = {
+            base_id: (channel_paths, label_path)
+            for base_id, _, channel_paths, label_path in iter_source_cases(self.dataset_root, dataset_json)
+        }
+
+        # Ordenadas por caso para que los accesos secuenciales aprovechen la caché
+        self.samples = []
+        weights = []
+        for base_id, info in slice_index["cases"].items():
+            if subset is not None and info["subset"] != subset:
+                continue
+            dropped = set(info.get("dropped", ()))  # casi duplicadas (dedup_slices.py)
+            case_weights = info.get("weights")
+            for pos, z in enumerate(info["slices"]):
+                if pos not in dropped:
+                    self.samples.append((slice_id_for(base_id, pos), base_id, z))
+                    weights.append(case_weights[pos] if case_weights else 1.0)
+        self._by_slice_id = {s[0]: i for i, s in enumerate(self.samples)}
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        slice_id, base_id, z = self.samples[idx]
+        channel_paths, label_path = self._paths[base_id]
+        channels, label = self.cache.get(base_id, channel_paths, label_path)
+
+        image = np.stack([np.asarray(ch[:, :, z], dtype=np.float32) for ch in channels], axis=0)
+        slice_lbl = None
+        if label is not None:
+            slice_lbl = np.rint(np.asarray(label[:, :, z])).astype(np.uint8)
+
+        affine = slice_affine(self.slice_index["cases"][base_id]["affine"], z)
+        return {"slice_id": slice_id, "image": image, "label": slice_lbl, "affine": affine}
+
+    def get(self, slice_id):
+        return self[self._by_slice_id[slice_id]]
+
+    def sample_indices(self, n, seed=None):
+        """
+        n índices con reemplazo y probabilidad proporcional a self.weights:
+        cada grupo de slices casi duplicadas pesa lo mismo que una slice única.
+        """
+        rng = np.random.default_rng(seed)
+        return rng.choice(len(self), size=n, replace=True, p=self.weights / self.weights.sum())
+
+
+def slice_mapping_from_index(slice_index, subset="Tr"):
+    """
+    Mapping base_id -> [case_ids_slice] para
+    prepare_dataset002_splits.create_splits_dataset2, sin explorar disco.
+    """
+    mapping = {}
+    for base_id, info in slice_index["cases"].items():
+        if info["subset"] != subset:
+            continue
+        dropped = set(info.get("dropped", ()))
+        mapping[base_id] = sorted(
+            slice_id_for(base_id, pos) for pos in range(len(info["slices"])) if pos not in dropped
+        )
+    return mapping
+
+
+def export_dataset_json(slice_index, source_dataset_json, out_dir):
+    """
+    Escribe el dataset.json 2D equivalente al que genera From3D_2D.py.
+    """
+    file_ending = slice_index["file_ending"]
+    new_training = []
+    new_test = []
+
+    for base_id, info in slice_index["cases"].items():
+        subset = info["subset"]
+        dropped = set(info.get("dropped", ()))  # casi duplicadas (dedup_slices.py)
+        for pos in range(len(info["slices"])):
+            if pos in dropped:
+                continue
+            slice_id = slice_id_for(base_id, pos)
+            if info.get("has_label", True):
+                entry = {
+                    "image": f"./images{subset}/{slice_id}",
+                    "label": f"./labels{subset}/{slice_id}{file_ending}",
+                }
+            else:
+                # solo imagen (test sin label en dataset.json)
+                entry = f"./images{subset}/{slice_id}"
+            if subset == "Tr":
+                new_training.append(entry)
+            else:
+                new_test.append(entry)
+
+    new_json = source_dataset_json.copy()
+    new_json["tensorImageSize"] = "2D"
+    new_json["numTraining"] = len(new_training)
+    new_json["numTest"] = len(new_test)
+    new_json["training"] = new_training
+    new_json["test"] = new_test
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(out_dir / "dataset.json", "w") as f:
+        json.dump(new_json, f, indent=4)
+    return out_dir / "dataset.json"
+
+
+def export_splits(slice_index, out_dir):
+    """
+    Expande los splits de Dataset001 a slices usando el índice.
+    """
+    splits2 = create_splits_dataset2(load_splits_dataset1(), slice_mapping_from_index(slice_index))
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(out_dir / SPLITS_FILENAME, "w") as f:
+        json.dump(splits2, f, indent=4)
+    return out_dir / SPLITS_FILENAME
+
+
+def main():
+    src_path = BASE_RAW / DATASET1
+    dst_raw = BASE_RAW / DATASET2
+    index_path = dst_raw / SLICE_INDEX_FILENAME
+
+    # 1) Cargar o construir el índice de slices (solo cabeceras)
+    if index_path.exists():
+        print(f"Usando índice de slices existente: {index_path}")
+        slice_index = load_slice_index(index_path)
+    else:
+        # Un Dataset002 ya materializado (From3D_2D.py sin índice) tiene sus propias z aleatorias:
+        # un índice nuevo con los mismos slice_id apuntaría a otras z y reassemble_slices.py /
+        # dedup_slices.py usarían posiciones equivocadas sin avisar.
+        images_tr = dst_raw / "imagesTr"
+        if images_tr.is_dir() and any(images_tr.iterdir()):
+            raise RuntimeError(
+                f"{images_tr} ya tiene slices pero no existe {index_path}: no se puede saber de qué z "
+                f"salió cada una. Usa otro DATASET2 para el dataset virtual o regenera {DATASET2} con From3D_2D.py."
+            )
+        print(f"Construyendo índice de slices ({NUM_SLICES} por caso, seed={SEED})...")
+        slice_index = build_slice_index(src_path, NUM_SLICES, SEED)
+        dst_raw.mkdir(parents=True, exist_ok=True)
+        save_slice_index(slice_index, index_path)
+
+    # 2) Exportar dataset.json y splits_final.json compatibles
+    dataset_json_path = export_dataset_json(slice_index, read_dataset_json(src_path), dst_raw)
+    splits_path = export_splits(slice_index, BASE_PREPROCESSED / DATASET2)
+
+    n_slices = sum(len(info["slices"]) for info in slice_index["cases"].values())
+    print("\n========================================")
+    print(f" Índice de slices: {index_path} ({n_slices} slices)")
+    print(f" dataset.json 2D: {dataset_json_path}")
+    print(f" {SPLITS_FILENAME}: {splits_path}")
+    print(" Las slices se sirven bajo demanda con VirtualSliceDataset.")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()